@@ -0,0 +1,249 @@
+"""End-to-end benchmark of the bridge
+
+Runs src/main.py against the dStiny emulator and the mvune stand-in of
+src/emulators.py and measures both directions:
+
+* ds_to_mvune: scene telegram sent by the dStiny -> method call received
+  by the mvune controller
+* mvune_to_ds: value change emitted by the mvune controller -> status
+  poll ('g' telegram) received by the dStiny
+* serial: pass-through read sent by the dStiny -> reply ('q' telegram),
+  handled by the serial thread alone. Its jitter (standard deviation) shows
+  how much the mvune side disturbs the serial link; `--load` keeps the
+  mvune side busy decoding large waitForEvents payloads meanwhile.
+
+Compare the single-process bridge with `-- --multiprocess`.
+
+Usage: python benchmarks/e2e.py [-n EVENTS] [-L PAYLOADS/s]
+                                [-- extra main.py options]
+"""
+import os
+import sys
+import threading
+import time
+from optparse import OptionParser
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'src'))
+
+import dstiny  # noqa: E402
+import emulators  # noqa: E402
+
+
+def percentile(values, p):
+    if not values:
+        return float('nan')
+    values = sorted(values)
+    return values[int(round(p * (len(values) - 1)))]
+
+
+def process_usage(pid):
+    """ Return (cpu seconds, rss kB, peak rss kB) of a running process
+    """
+    with open('/proc/%d/stat' % pid) as f:
+        fields = f.read().rsplit(')', 1)[1].split()
+    ticks = os.sysconf('SC_CLK_TCK')
+    cpu = (int(fields[11]) + int(fields[12])) / float(ticks)
+    rss = peak = 0
+    with open('/proc/%d/status' % pid) as f:
+        for line in f:
+            if line.startswith('VmRSS:'):
+                rss = int(line.split()[1])
+            elif line.startswith('VmHWM:'):
+                peak = int(line.split()[1])
+    return cpu, rss, peak
+
+
+def bridge_usage(pid):
+    """ process_usage summed over a process and its children
+    """
+    pids = [pid]
+    for name in os.listdir('/proc'):
+        if name.isdigit():
+            try:
+                with open('/proc/%s/stat' % name) as f:
+                    if int(f.read().rsplit(')', 1)[1].split()[1]) == pid:
+                        pids.append(int(name))
+            except (IOError, ValueError):
+                pass
+    return [sum(u) for u in zip(*[process_usage(p) for p in pids])]
+
+
+def run_direction(n, trigger, timeout, settle):
+    """ Fire `trigger(k, done)` n times, waiting for each to be answered
+
+    `done` is a threading.Event the trigger arranges to be set when the
+    answer arrives. The bridge gets `settle` seconds after each answer to
+    process the echoes of the event. Return the list of latencies, the
+    number of lost events and the time spent waiting for answers.
+    """
+    latencies = []
+    lost = 0
+    busy = 0.0
+    for k in range(n):
+        done = threading.Event()
+        start = time.time()
+        trigger(k, done)
+        if done.wait(timeout):
+            latencies.append(done.timestamp - start)
+        else:
+            lost += 1
+        busy += time.time() - start
+        time.sleep(settle)
+    return latencies, lost, busy
+
+
+def ds_to_mvune(bridge, n, timeout, settle):
+    pending = {}
+
+    def on_call(timestamp, method, value):
+        done = pending.pop('call', None)
+        if done is not None and method == 'setExhaustAir':
+            done.timestamp = timestamp
+            done.set()
+
+    bridge.mvune.listeners.append(on_call)
+
+    def trigger(k, done):
+        pending['call'] = done
+        # alternate scenes, the bridge skips calls that change nothing
+        bridge.tiny.scene(dstiny.EXHOOD_FAN_FLAP_dSxid, 1 + k % 2)
+
+    try:
+        return run_direction(n, trigger, timeout, settle)
+    finally:
+        bridge.mvune.listeners.remove(on_call)
+
+
+def mvune_to_ds(bridge, n, timeout, settle):
+    pending = {}
+
+    def on_telegram(timestamp, Tel):
+        if Tel.cmdch == 'g':
+            done = pending.pop('poll', None)
+            if done is not None:
+                done.timestamp = timestamp
+                done.set()
+
+    bridge.tiny.listeners.append(on_telegram)
+
+    def trigger(k, done):
+        pending['poll'] = done
+        sid, field = emulators.STANDIN_METHODS['setExhaustAir']
+        bridge.mvune.push(sid, field, 30 + k % 2 * 10)
+
+    try:
+        return run_direction(n, trigger, timeout, settle)
+    finally:
+        bridge.tiny.listeners.remove(on_telegram)
+
+
+def serial(bridge, n, timeout, settle):
+    pending = {}
+
+    def on_telegram(timestamp, Tel):
+        if Tel.cmdch == 'q':
+            done = pending.pop('reply', None)
+            if done is not None:
+                done.timestamp = timestamp
+                done.set()
+
+    bridge.tiny.listeners.append(on_telegram)
+
+    def trigger(k, done):
+        pending['reply'] = done
+        bridge.tiny.passThrough(dstiny.EXHOOD_FAN_FLAP_dSxid, 0x03,
+                                dstiny.fan_scenes_regs[k % 10])
+
+    try:
+        return run_direction(n, trigger, timeout, settle)
+    finally:
+        bridge.tiny.listeners.remove(on_telegram)
+
+
+def load_payload(n_services=500):
+    """ waitForEvents events of services unknown to the bridge: decoded,
+    but never forwarded
+    """
+    changed = {}
+    for i in range(n_services):
+        changed["L%d" % i] = {"intensity": i, "state": "on",
+                              "name": "load service %d" % i}
+    return [{"eventName": "notification.OMValueChange",
+             "changedObjects": changed}]
+
+
+def start_load(bridge, rate):
+    """ Push `rate` large payloads per second until the returned event is
+    set
+    """
+    stop = threading.Event()
+    events = load_payload()
+
+    def run():
+        while not stop.wait(1.0 / rate):
+            bridge.mvune.pushEvents(events)
+
+    t = threading.Thread(target=run, name="load")
+    t.daemon = True
+    t.start()
+    return stop
+
+
+def stdev(values):
+    if len(values) < 2:
+        return float('nan')
+    mean = sum(values) / len(values)
+    return (sum((v - mean) ** 2 for v in values) / (len(values) - 1)) ** 0.5
+
+
+def report(name, latencies, lost, elapsed, out):
+    out.write("%-12s n=%d lost=%d events/s=%.1f p50=%.2fms p99=%.2fms "
+              "jitter=%.2fms\n"
+              % (name, len(latencies), lost, len(latencies) / elapsed,
+                 percentile(latencies, 0.5) * 1000,
+                 percentile(latencies, 0.99) * 1000,
+                 stdev(latencies) * 1000))
+
+
+def main(argv):
+    parser = OptionParser(
+        usage="%prog [-n EVENTS] [-L PAYLOADS/s] [-- main.py options]")
+    parser.add_option("-n", "--events", dest="events", type="int",
+                      default=100, help="events per direction")
+    parser.add_option("-t", "--timeout", dest="timeout", type="float",
+                      default=5.0, help="seconds to wait for each answer")
+    parser.add_option("-s", "--settle", dest="settle", type="float",
+                      default=0.2, help="pause in seconds after each answer")
+    parser.add_option("-L", "--load", dest="load", type="float", default=0,
+                      help="large mvune payloads per second pushed during "
+                      "the serial phase")
+    (options, args) = parser.parse_args(argv)
+
+    bridge = emulators.BridgeProcess(args)
+    try:
+        bridge.wait_online()
+        cpu0 = bridge_usage(bridge.proc.pid)[0]
+        for name, run in (("ds_to_mvune", ds_to_mvune),
+                          ("mvune_to_ds", mvune_to_ds),
+                          ("serial", serial)):
+            stop = None
+            if name == "serial" and options.load:
+                stop = start_load(bridge, options.load)
+            try:
+                latencies, lost, busy = run(bridge, options.events,
+                                            options.timeout, options.settle)
+            finally:
+                if stop is not None:
+                    stop.set()
+            report(name, latencies, lost, busy, sys.stdout)
+            time.sleep(0.5)  # let the echoes of this phase drain
+        cpu, rss, peak = bridge_usage(bridge.proc.pid)
+        sys.stdout.write("bridge cpu=%.2fs rss=%dkB peak_rss=%dkB\n"
+                         % (cpu - cpu0, rss, peak))
+    finally:
+        bridge.close()
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,116 @@
+"""Memory overhead of the messages handled by the bridge
+
+Reports for the telegrams decoded by dstiny.getTel and the events handed
+from the mvune thread to the dStiny thread:
+
+* the size of one instance (object, attribute storage and argument list)
+* the memory retained per message while N of them are held, e.g. in a
+  backed-up queue, measured as the growth of the process RSS
+* the number of garbage-collected objects allocated per message
+
+A dict-backed telegram class is measured alongside for comparison.
+
+Usage: python benchmarks/memory.py [-n MESSAGES]
+"""
+import gc
+import os
+import sys
+from optparse import OptionParser
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'src'))
+
+import dstiny  # noqa: E402
+import main as bridge  # noqa: E402
+from e2e import process_usage  # noqa: E402
+
+LINE = dstiny.dSTel('i', 1, [0x00, 0x04, 0x08, 0x05, 0x02]).get()
+
+
+class DictTel:
+    """ Telegram with its attributes in a per-instance dict
+    """
+
+    def __init__(self, cmdch, dSidx, args):
+        self.cmdch = cmdch
+        self.dSidx = dSidx
+        self.args = args
+        self.timestamp = None
+
+
+def instance_size(obj):
+    size = sys.getsizeof(obj)
+    if hasattr(obj, '__dict__'):
+        size += sys.getsizeof(obj.__dict__)
+    args = getattr(obj, 'args', None)
+    if args is not None:
+        size += sys.getsizeof(args)
+    return size
+
+
+def rss():
+    return process_usage(os.getpid())[1] * 1024
+
+
+def retained(make, n):
+    """ Return (bytes retained, gc objects allocated) per message while
+    `n` messages made by `make(k)` are held
+    """
+    gc.collect()
+    objects = len(gc.get_objects())
+    before = rss()
+    held = [make(k) for k in xrange(n)]
+    after = rss()
+    allocated = len(gc.get_objects()) - objects - 1  # the list `held`
+    del held
+    return float(after - before) / n, float(allocated) / n
+
+
+def cases():
+    crc8 = dstiny.crc8
+
+    def event(k):
+        return bridge.Event(dstiny.EXHOOD_FAN_FLAP_dSxid, k & 0xFFFF,
+                            dstiny.DS_POLL_STATUS_INFO, "Status")
+
+    def tel(k):
+        return dstiny.decodeTel(LINE, crc8)
+
+    def dict_tel(k):
+        Tel = dstiny.decodeTel(LINE, crc8)
+        return DictTel(Tel.cmdch, Tel.dSidx, Tel.args)
+
+    return [("dSTel (decoded)", tel),
+            ("main.Event", event),
+            ("dict-backed telegram", dict_tel)]
+
+
+def run(n=100000):
+    """ Return {case: (instance bytes, retained bytes, gc objects)} per
+    message
+    """
+    results = {}
+    for name, make in cases():
+        results[name] = (instance_size(make(0)),) + retained(make, n)
+    return results
+
+
+def main(argv):
+    parser = OptionParser(usage="%prog [-n MESSAGES]")
+    parser.add_option("-n", dest="n", type="int", default=100000,
+                      help="number of messages held at once")
+    (options, args) = parser.parse_args(argv)
+
+    results = run(options.n)
+    sys.stdout.write("%-24s %10s %12s %10s\n"
+                     % ("message", "instance", "retained", "gc objects"))
+    for name, make in cases():
+        size, kept, objects = results[name]
+        sys.stdout.write("%-24s %8d B %10.1f B %10.2f\n"
+                         % (name, size, kept, objects))
+    sys.stdout.write("%d messages held at once, %.1f MB RSS\n"
+                     % (options.n, rss() / 1e6))
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,271 @@
+"""Microbenchmarks of the bridge hot paths
+
+Times the functions run for every message: telegram encoding and decoding,
+a constant command written through write_read_verify, parse_dSCommand
+(pass-through read and write, scene), Mvune.decodeEvent on a
+waitForEvents payload and the Event hand-off between the threads. The
+serial port and the HTTP responses are replaced by in-memory loopbacks, so
+only the bridge code is measured.
+
+Each case is reported relative to a fixed pure-Python calibration loop,
+which makes the numbers comparable across machines. tests/test_benchmarks.py
+fails when a case is slower than its stored baseline by more than the
+threshold.
+
+Usage: python benchmarks/micro.py [--save] [--threshold 1.0]
+"""
+import gc
+import json
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import time
+from optparse import OptionParser
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'src'))
+
+import dstiny  # noqa: E402
+import main as bridge  # noqa: E402
+import mvune  # noqa: E402
+
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        'baseline.json')
+THRESHOLD = 1.0  # fail when twice as slow as the baseline
+
+
+class LoopbackSerial:
+    """ Serial port answering every telegram with itself
+    """
+
+    def __init__(self):
+        self.last = ''
+
+    def open(self):
+        pass
+
+    def close(self):
+        pass
+
+    def write(self, data):
+        self.last = data
+
+    def readline(self):
+        return self.last
+
+
+class LoopbackPort:
+    def __init__(self):
+        self.ser = LoopbackSerial()
+
+
+class CannedResponse:
+    def __init__(self, body):
+        self.body = body
+        self.content = json.dumps(body)
+
+    def json(self):
+        return self.body
+
+
+class LoopbackMvune(mvune.Mvune):
+    """ Mvune controller whose requests always succeed
+    """
+
+    def request(self, method, url):
+        return CannedResponse({"success": True})
+
+
+def waitForEvents_payload(n_services=12):
+    """ waitForEvents response with value changes of several services
+    """
+    changed = {}
+    for i in range(n_services):
+        changed["S%d" % i] = {"intensity": i, "state": "on"}
+    changed["S1"] = {"exhaustAirFromField": 55, "state": "on"}
+    changed["S2"] = {"supplyAirFromField": 33, "maxSupplyAir": 1}
+    return {"events": [
+        {"eventName": "notification.OMValueChange",
+         "changedObjects": changed},
+        {"eventName": "notification.Heartbeat"},
+    ]}
+
+
+def calibration():
+    total = 0
+    d = {}
+    for i in range(200):
+        d[i & 15] = total
+        total += i * 3 % 7
+    return total
+
+
+def setup():
+    """ Return the benchmark cases as a list of (name, function) and a
+    cleanup function
+    """
+    tmp = tempfile.mkdtemp(prefix='ds-mvune-micro-')
+    conffile = os.path.join(tmp, 'scenes.conf')
+    shutil.copy(os.path.join(ROOT, '__scenes.conf'), conffile)
+
+    logging.getLogger('micro').addHandler(logging.NullHandler())
+    logging.getLogger('micro').propagate = False
+
+    ctr = LoopbackMvune('127.0.0.1', 'hood', 'window', 'light', 'micro')
+    ctr.registered_services = {
+        "S1": [u"exhaustAirDeviceService_haube"],
+        "S2": [u"supplyAirDeviceService_haube"],
+        "S3": [u"lightingDeviceService"]}
+    tiny = dstiny.dstiny(LoopbackPort(), ctr, 'micro', conffile)
+    # scene registers in a register file: a write through the conf file
+    # rewrites scenes.conf and times the disk instead of the bridge
+    tiny_regs = dstiny.dstiny(LoopbackPort(), ctr, 'micro', conffile,
+                              regfile=os.path.join(tmp, 'registers'))
+
+    tel = dstiny.dSTel('g', 1, [0x07, 0x09, 0x00])
+    line = dstiny.dSTel('c', 1, [0x06, 0x19, 0x00, 0x1E, 0x00]).get()
+    ptp_read = dstiny.dSTel('p', 1, [0x03, 0x7F, 0x12, 0x00, 0x00])
+    ptp_write = dstiny.dSTel('p', 1, [0x02, 0x7F, 0x12, 0x16, 0x00])
+    scenes = [dstiny.dSTel('i', 1, [0x00, 0x04, 0x08, s, 0x02])
+              for s in (1, 2)]
+    payload = waitForEvents_payload()
+    q = bridge.EventQueue()
+
+    def scene():
+        for s in scenes:
+            tiny.parse_dSCommand(s)
+            # the echo of the controller updates the current level
+            ctr.set_fan_current_level(-1)
+
+    def event_handoff():
+        e = bridge.Event(dstiny.EXHOOD_FAN_FLAP_dSxid, 0x1E00,
+                       dstiny.DS_POLL_STATUS_INFO, "Status")
+        bridge.post_event(q, e)
+        q.get()
+        q.task_done()
+
+    cases = [
+        ("dSTel.get", tel.get),
+        ("dstiny.getTel", lambda: tiny.getTel(line)),
+        ("dstiny.genStatusPollEvent",
+         lambda: tiny.genStatusPollEvent(dstiny.EXHOOD_FAN_FLAP_dSxid,
+                                         dstiny.DS_POLL_STATUS_INFO,
+                                         const=True)),
+        ("parse_dSCommand.ptp_read", lambda: tiny.parse_dSCommand(ptp_read)),
+        ("parse_dSCommand.ptp_write",
+         lambda: tiny_regs.parse_dSCommand(ptp_write)),
+        ("parse_dSCommand.scene", scene),
+        ("Mvune.decodeEvent", lambda: ctr.decodeEvent(payload)),
+        ("Event.handoff", event_handoff),
+    ]
+    return cases, lambda: shutil.rmtree(tmp, ignore_errors=True)
+
+
+def measure(fn, duration=0.05):
+    """ Return a loop count filling about `duration` seconds and the time
+    per call of that loop
+    """
+    n = 1
+    while True:
+        elapsed = timed(fn, n)
+        if elapsed >= duration / 4:
+            break
+        n *= 4
+    per_call = elapsed / n
+    return max(1, int(duration / max(per_call, 1e-9))), per_call
+
+
+def timed(fn, n):
+    # without garbage collection pauses, like timeit
+    gc.disable()
+    try:
+        start = time.time()
+        for _ in xrange(n):
+            fn()
+        return time.time() - start
+    finally:
+        gc.enable()
+
+
+def run(duration=0.05, repeat=5):
+    """ Return {case: (seconds per call, ratio to the calibration loop)}
+
+    The calibration loop runs alternately with each case and the best of
+    `repeat` runs is kept for both.
+    """
+    cases, cleanup = setup()
+    results = {}
+    try:
+        n_ref, best_ref = measure(calibration, duration)
+        for name, fn in cases:
+            n, best = measure(fn, duration)
+            ref = best_ref
+            for _ in range(repeat):
+                ref = min(ref, timed(calibration, n_ref) / n_ref)
+                best = min(best, timed(fn, n) / n)
+            results[name] = (best, best / ref)
+    finally:
+        cleanup()
+    return results
+
+
+def load_baseline(filename=BASELINE):
+    with open(filename) as f:
+        return json.load(f)
+
+
+def save_baseline(runs, filename=BASELINE):
+    """ Store the median ratio of each case over several `runs`
+    """
+    baseline = {}
+    for name in runs[0]:
+        ratios = sorted(r[name][1] for r in runs)
+        baseline[name] = round(ratios[len(ratios) // 2], 4)
+    with open(filename, 'w') as f:
+        json.dump(baseline, f, indent=2, sort_keys=True,
+                  separators=(',', ': '))
+        f.write("\n")
+
+
+def compare(results, baseline, threshold=THRESHOLD):
+    """ Return the cases slower than the baseline by more than `threshold`
+    as a list of (case, baseline ratio, current ratio)
+    """
+    regressions = []
+    for name, ratio in sorted(baseline.items()):
+        if name in results and results[name][1] > ratio * (1 + threshold):
+            regressions.append((name, ratio, results[name][1]))
+    return regressions
+
+
+def main(argv):
+    parser = OptionParser(usage="%prog [--save] [--threshold T]")
+    parser.add_option("--save", dest="save", action="store_true",
+                      default=False, help="store the results as baseline")
+    parser.add_option("--threshold", dest="threshold", type="float",
+                      default=THRESHOLD,
+                      help="allowed slowdown relative to the baseline")
+    (options, args) = parser.parse_args(argv)
+
+    results = run()
+    baseline = {}
+    if os.path.exists(BASELINE):
+        baseline = load_baseline()
+    for name in sorted(results):
+        t, ratio = results[name]
+        sys.stdout.write("%-28s %10.2fus  x%-8.2f baseline x%s\n"
+                         % (name, t * 1e6, ratio,
+                            baseline.get(name, '-')))
+    if options.save:
+        save_baseline([results, run(), run()])
+        sys.stdout.write("baseline written to %s\n" % BASELINE)
+    else:
+        for name, old, new in compare(results, baseline, options.threshold):
+            sys.stdout.write("REGRESSION %s: x%.2f -> x%.2f\n"
+                             % (name, old, new))
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,206 @@
+"""Soak test of the bridge
+
+Drives sustained synthetic traffic through the bridge of src/simulator.py
+(the loops of main.py in this process, in simulated time) and takes a
+memory snapshot at regular intervals of simulated time:
+
+* RSS of the process
+* number of gc-tracked objects, per type
+
+Every simulated second it also samples the events waiting for the dStiny
+thread: their number and the age of the oldest value, i.e. how late the
+dSS is on the mvune side.
+
+The first snapshot is taken after a warm-up that runs the traffic until
+the bounded buffers (trace ring, iteration windows of the watchdog) are
+full, however long that takes at the given rate. The report lists the
+snapshots and the types that grew the most since the first one, with the
+containers referring to a sample of them. The exit status is 1 if the RSS
+or the number of objects grew by more than the budget.
+
+Python 2 has no tracemalloc: growth is attributed to object types and
+their referrers rather than to allocation sites.
+
+Usage: python benchmarks/soak.py [-H HOURS] [-n SNAPSHOTS] [-r EVENTS/s]
+                                 [-i SECONDS] [--rss-budget KB]
+                                 [--object-budget N]
+"""
+import collections
+import gc
+import inspect
+import logging
+import os
+import random
+import sys
+import time
+from optparse import OptionParser
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'src'))
+
+import dstiny  # noqa: E402
+import emulators  # noqa: E402
+import simulator  # noqa: E402
+from e2e import process_usage  # noqa: E402
+from tracing import TRACER  # noqa: E402
+from watchdog import WATCHDOG  # noqa: E402
+
+TOP = 10  # types listed in the report
+
+
+def traffic(sim, rate, seed=1):
+    """ Return the synthetic traffic generator: scenes, mvune value changes
+    and pass-through reads in random order, `rate` per simulated second on
+    average, without waiting for the answers
+    """
+    rng = random.Random(seed)
+    sid, field = emulators.STANDIN_METHODS['setExhaustAir']
+
+    def run():
+        k = 0
+        while True:
+            sim.clock.sleep(rng.expovariate(rate))
+            k += 1
+            action = rng.random()
+            if action < 0.4:
+                sim.tiny.scene(dstiny.EXHOOD_FAN_FLAP_dSxid, 1 + k % 2)
+            elif action < 0.8:
+                sim.mvune.push(sid, field, rng.randint(0, 100))
+            else:
+                sim.tiny.passThrough(dstiny.EXHOOD_FAN_FLAP_dSxid, 0x03,
+                                     dstiny.fan_scenes_regs[k % 10])
+    return run
+
+
+def buffers_full():
+    """ Whether the trace ring and the watchdog windows are full
+    """
+    buffers = [loop.durations for loop in WATCHDOG.loops]
+    if TRACER.enabled:
+        buffers.append(TRACER.spans)
+    return all(len(b) == b.maxlen for b in buffers)
+
+
+def warm_up(sim, step=60.0, limit=86400.0):
+    """ Run the simulation until the bounded buffers are full, for at most
+    `limit` simulated seconds
+    """
+    end = sim.clock.time() + limit
+    while not buffers_full() and sim.clock.time() < end:
+        sim.clock.run(sim.clock.time() + step)
+
+
+def snapshot():
+    """ Return (RSS in kB, {type name: gc-tracked objects})
+    """
+    gc.collect()
+    counts = collections.Counter(type(o).__name__ for o in gc.get_objects())
+    del counts["Counter"]  # the snapshots themselves
+    return process_usage(os.getpid())[1], counts
+
+
+def holders(name, limit=3):
+    """ Types of the objects referring to the newest objects of type `name`
+    """
+    objects = [o for o in gc.get_objects() if type(o).__name__ == name]
+    found = collections.Counter()
+    for o in objects[-limit:]:
+        for r in gc.get_referrers(o):
+            if r is not objects and not inspect.isframe(r):
+                found[type(r).__name__] += 1
+    del objects
+    return ", ".join("%s" % n for n, _ in found.most_common(3))
+
+
+def run(hours=1.0, snapshots=6, rate=1.0, event_interval=5):
+    """ Return the simulator, the list of (simulated time, RSS kB, object
+    counts) snapshots, the first one after the warm-up, and the largest
+    (queue depth, staleness in seconds) sampled
+    """
+    sim = simulator.Simulation(event_interval)
+    sim.start()
+    sim.run(sim.wait_online)
+    sim.clock.spawn(traffic(sim, rate), name="traffic")
+    worst = [0, 0.0]
+
+    def sample_queue():
+        while True:
+            sim.clock.sleep(1.0)
+            oldest = sim.queue.oldest()
+            worst[0] = max(worst[0], sim.queue.qsize())
+            if oldest is not None:
+                worst[1] = max(worst[1], sim.clock.time() - oldest)
+
+    sim.clock.spawn(sample_queue, name="sample-queue")
+    interval = hours * 3600.0 / snapshots
+    warm_up(sim)
+    rss, counts = snapshot()
+    results = [(sim.clock.time(), rss, counts)]
+    for k in range(snapshots):
+        sim.clock.run(sim.clock.time() + interval)
+        rss, counts = snapshot()
+        results.append((sim.clock.time(), rss, counts))
+    sim.close()
+    return sim, results, tuple(worst)
+
+
+def main(argv):
+    parser = OptionParser(usage="%prog [-H HOURS] [-n SNAPSHOTS] "
+                          "[-r EVENTS/s] [--rss-budget KB] "
+                          "[--object-budget N]")
+    parser.add_option("-H", "--hours", dest="hours", type="float",
+                      default=24.0, help="simulated hours of traffic")
+    parser.add_option("-n", "--snapshots", dest="snapshots", type="int",
+                      default=12, help="snapshots after the warm-up")
+    parser.add_option("-r", "--rate", dest="rate", type="float",
+                      default=1.0, help="events per simulated second")
+    parser.add_option("-i", "--event-interval", dest="event_interval",
+                      type="float", default=5,
+                      help="pacing of the bridge between status pushes")
+    parser.add_option("--rss-budget", dest="rss_budget", type="int",
+                      default=2048, help="allowed RSS growth in kB")
+    parser.add_option("--object-budget", dest="object_budget", type="int",
+                      default=1000, help="allowed growth of gc objects")
+    (options, args) = parser.parse_args(argv)
+
+    logging.getLogger().addHandler(logging.NullHandler())
+    logging.getLogger().setLevel(logging.WARNING)
+
+    start = time.time()
+    sim, results, (depth, staleness) = run(
+        options.hours, options.snapshots, options.rate,
+        options.event_interval)
+    out = sys.stdout
+    out.write("%10s %10s %10s\n" % ("hours", "rss", "objects"))
+    for t, rss, counts in results:
+        out.write("%10.2f %8dkB %10d\n" % (t / 3600.0, rss,
+                                           sum(counts.values())))
+
+    t0, rss0, counts0 = results[0]
+    t1, rss1, counts1 = results[-1]
+    growth = collections.Counter(counts1)
+    growth.subtract(counts0)
+    out.write("\ntop growth since %.2fh:\n" % (t0 / 3600.0))
+    for name, n in growth.most_common(TOP):
+        if n <= 0:
+            break
+        out.write("%+8d %-24s held by %s\n" % (n, name, holders(name)))
+
+    rss_growth = rss1 - rss0
+    object_growth = sum(counts1.values()) - sum(counts0.values())
+    out.write("\nrss %+dkB (budget %dkB), objects %+d (budget %d), "
+              "queue depth max %d, staleness max %.1fs, serial overruns "
+              "%d, simulated %.1fh in %.1fs\n"
+              % (rss_growth, options.rss_budget, object_growth,
+                 options.object_budget, depth, staleness,
+                 sim.tiny.serial.overruns, t1 / 3600.0,
+                 time.time() - start))
+    if rss_growth > options.rss_budget \
+            or object_growth > options.object_budget:
+        out.write("FAIL: growth over budget\n")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,195 @@
+"""Logging off the hot path
+
+The serial and mvune threads only put log records into a bounded queue; a
+background thread formats them and writes them to the size-rotated log file
+and the console. When the queue is full records are dropped and counted
+instead of blocking the caller.
+
+Optionally, every telegram read from or written to the dstiny and every
+mvune long-poll payload is appended to a compact binary trace with the same
+background scheme (see replay.py for replaying it). A trace file starts
+with `TRACE_MAGIC` followed by records of the form
+
+    <d: timestamp> <B: channel> <I: length> <length bytes>
+
+(little endian) where channel is one of the `CHANNEL_*` constants.
+"""
+import atexit
+import logging
+import logging.handlers
+import Queue
+import struct
+import sys
+import threading
+import time
+
+
+TRACE_MAGIC = "DSTT\x02"
+TRACE_HEADER = struct.Struct("<dBI")
+
+CHANNEL_DSTINY_RX = 0  # pc <- dstiny
+CHANNEL_DSTINY_TX = 1  # pc -> dstiny
+CHANNEL_MVUNE_EVENTS = 2  # waitForEvents response body
+CHANNEL_MVUNE_MODEL = 3  # getObjectModelAndAjaxSessionId response body
+
+FILE_FORMAT = '%(asctime)s %(name)-12s %(levelname)-8s %(message)s'
+CONSOLE_FORMAT = '%(name)-12s: %(levelname)-8s %(message)s'
+
+
+class QueueHandler(logging.Handler):
+    """ Hands records over to a QueueListener without formatting them
+    """
+
+    def __init__(self, queue):
+        logging.Handler.__init__(self)
+        self.queue = queue
+        self.dropped = 0
+
+    def emit(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except Queue.Full:
+            self.dropped += 1
+
+    def handle(self, record):
+        # no handler lock needed, the queue is thread-safe
+        rv = self.filter(record)
+        if rv:
+            self.emit(record)
+        return rv
+
+
+class QueueListener:
+    """ Background thread passing queued records to the real handlers
+    """
+
+    _stop = object()
+
+    def __init__(self, queue, handlers):
+        self.queue = queue
+        self.handlers = handlers
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run, name="log-writer")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            record = self.queue.get()
+            if record is self._stop:
+                break
+            for handler in self.handlers:
+                if record.levelno >= handler.level:
+                    handler.handle(record)
+
+    def stop(self):
+        if self.thread is not None:
+            self.queue.put(self._stop)
+            self.thread.join()
+            self.thread = None
+            for handler in self.handlers:
+                handler.close()
+
+
+class TelegramTrace:
+    """ Binary trace of the bridge traffic, written in the background
+    """
+
+    def __init__(self, filename, maxsize=10000):
+        self.fp = open(filename, 'ab')
+        if self.fp.tell() == 0:
+            self.fp.write(TRACE_MAGIC)
+        self.queue = Queue.Queue(maxsize)
+        self.dropped = 0
+        self.thread = threading.Thread(target=self._run,
+                                       name="telegram-trace")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def record(self, channel, data, timestamp=None):
+        if timestamp is None:
+            timestamp = time.time()
+        try:
+            self.queue.put_nowait((timestamp, channel, data))
+        except Queue.Full:
+            self.dropped += 1
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            write_record(self.fp, *item)
+            if self.queue.empty():
+                self.fp.flush()
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        self.fp.close()
+
+
+def write_record(fp, timestamp, channel, data):
+    fp.write(TRACE_HEADER.pack(timestamp, channel, len(data)))
+    fp.write(data)
+
+
+def read_trace(fp):
+    """ Iterate over the (timestamp, channel, data) records of a trace
+    """
+    if fp.read(len(TRACE_MAGIC)) != TRACE_MAGIC:
+        raise ValueError("not a telegram trace")
+    while True:
+        header = fp.read(TRACE_HEADER.size)
+        if len(header) < TRACE_HEADER.size:
+            return
+        timestamp, channel, length = TRACE_HEADER.unpack(header)
+        yield timestamp, channel, fp.read(length)
+
+
+_telegram_trace = None
+
+
+def trace_telegram(channel, data):
+    """ Add a telegram or mvune payload to the binary trace, if one is
+    configured
+    """
+    if _telegram_trace is not None:
+        _telegram_trace.record(channel, data)
+
+
+def setup(logfile, max_bytes=10 * 1024 * 1024, backups=5,
+          telegram_trace=None, maxsize=10000):
+    """ Configure the root logger to write through a background thread
+
+    DEBUG and above go to `logfile`, rotated every `max_bytes`; INFO and
+    above go to the console.
+    """
+    global _telegram_trace
+
+    file_handler = logging.handlers.RotatingFileHandler(
+        logfile, mode='a', maxBytes=max_bytes, backupCount=backups)
+    file_handler.setLevel(logging.DEBUG)
+    file_handler.setFormatter(
+        logging.Formatter(FILE_FORMAT, datefmt='%Y-%m-%d %H:%M:%S'))
+
+    console = logging.StreamHandler(sys.stderr)
+    console.setLevel(logging.INFO)
+    console.setFormatter(logging.Formatter(CONSOLE_FORMAT))
+
+    queue = Queue.Queue(maxsize)
+    listener = QueueListener(queue, [file_handler, console])
+    listener.start()
+
+    root = logging.getLogger('')
+    root.setLevel(logging.DEBUG)
+    root.addHandler(QueueHandler(queue))
+    atexit.register(listener.stop)
+
+    if telegram_trace:
+        _telegram_trace = TelegramTrace(telegram_trace)
+        atexit.register(_telegram_trace.close)
+
+    return listener
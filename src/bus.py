@@ -0,0 +1,141 @@
+"""In-process publish/subscribe of what the bridge sees
+
+The serial and mvune threads publish each change once on `BUS`, as an
+immutable record:
+
+    Telegram        dS telegram received from ('rx') or sent to ('tx') the
+                    dStiny
+    MvuneChange     outputs decoded from a waitForEvents response, -1 for
+                    the ones not in it
+    FsmTransition   state change of the dStiny FSM of main.dstiny_thread
+
+Every subscriber has its own bounded buffer and reads it from its own
+thread. Publishing never blocks nor waits for a subscriber; when a buffer
+is full, its policy decides what is lost:
+
+    DROP_NEWEST   the new record
+    DROP_OLDEST   the oldest buffered record
+    COALESCE      buffered records are replaced by newer ones with the same
+                  key (by default their type), so only the latest of each
+                  kind waits
+
+Publishing to a record type nobody subscribed to costs a dict lookup.
+"""
+import collections
+import threading
+
+Telegram = collections.namedtuple(
+    "Telegram", "timestamp direction cmdch dSidx args")
+MvuneChange = collections.namedtuple(
+    "MvuneChange", "timestamp fan flap window locked")
+FsmTransition = collections.namedtuple(
+    "FsmTransition", "timestamp previous state")
+
+DROP_NEWEST = "drop-newest"
+DROP_OLDEST = "drop-oldest"
+COALESCE = "coalesce"
+
+
+class Subscription:
+    def __init__(self, types, maxsize=256, policy=DROP_OLDEST, key=type):
+        if policy not in (DROP_NEWEST, DROP_OLDEST, COALESCE):
+            raise ValueError("unknown policy %r" % policy)
+        self.types = tuple(types)
+        self.maxsize = maxsize
+        self.policy = policy
+        self.key = key
+        self.dropped = 0
+        self.pending = collections.OrderedDict()  # COALESCE: key: record
+        self.records = collections.deque()
+        self.cond = threading.Condition()
+
+    def __len__(self):
+        return len(self.pending) + len(self.records)
+
+    def offer(self, record):
+        """ Buffer `record` according to the policy, without blocking
+        """
+        with self.cond:
+            if self.policy == COALESCE:
+                k = self.key(record)
+                if k in self.pending:
+                    self.dropped += 1
+                elif len(self.pending) >= self.maxsize:
+                    self.pending.popitem(last=False)
+                    self.dropped += 1
+                self.pending[k] = record
+            elif len(self.records) < self.maxsize:
+                self.records.append(record)
+            elif self.policy == DROP_OLDEST:
+                self.records.popleft()
+                self.records.append(record)
+                self.dropped += 1
+            else:
+                self.dropped += 1
+                return
+            self.cond.notify()
+
+    def get(self, timeout=None):
+        """ Return the next record, or None after `timeout` seconds
+        """
+        with self.cond:
+            if not len(self):
+                self.cond.wait(timeout)
+            if self.pending:
+                return self.pending.popitem(last=False)[1]
+            if self.records:
+                return self.records.popleft()
+            return None
+
+
+class Bus:
+    def __init__(self):
+        self.subscribers = {}  # record type: tuple of subscriptions
+        self._lock = threading.Lock()
+
+    def subscribe(self, types, maxsize=256, policy=DROP_OLDEST, key=type):
+        """ Return a Subscription to the records of `types`
+        """
+        sub = Subscription(types, maxsize, policy, key)
+        with self._lock:
+            for t in sub.types:
+                self.subscribers[t] = self.subscribers.get(t, ()) + (sub,)
+        return sub
+
+    def unsubscribe(self, sub):
+        with self._lock:
+            for t in sub.types:
+                subs = tuple(s for s in self.subscribers.get(t, ())
+                             if s is not sub)
+                if subs:
+                    self.subscribers[t] = subs
+                else:
+                    self.subscribers.pop(t, None)
+
+    def wants(self, record_type):
+        """ Whether records of `record_type` have a subscriber; lets the
+        publisher skip building them
+        """
+        return record_type in self.subscribers
+
+    def publish(self, record):
+        for sub in self.subscribers.get(type(record), ()):
+            sub.offer(record)
+
+
+BUS = Bus()
+
+
+def follow(sub, handle, name):
+    """ Call handle(record) for every record of `sub` in a daemon thread
+    """
+    def run():
+        while True:
+            record = sub.get()
+            if record is not None:
+                handle(record)
+
+    t = threading.Thread(target=run, name=name)
+    t.daemon = True
+    t.start()
+    return t
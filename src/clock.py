@@ -0,0 +1,220 @@
+"""Time source of the bridge
+
+The loops of main.py, the dstiny driver, Mvune and the emulators read the
+time, sleep, wait and start threads through a clock. `CLOCK` is the wall
+clock. A `VirtualClock` runs the same code in simulated time, see
+simulator.py.
+"""
+import collections
+import logging
+import Queue
+import threading
+import time
+
+
+class RealClock:
+    def time(self):
+        return time.time()
+
+    def sleep(self, seconds):
+        time.sleep(seconds)
+
+    def wait_until(self, cond, predicate, timeout=None):
+        """ Wait on the held Condition `cond` until `predicate()` holds or
+        `timeout` seconds have passed; return predicate()
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        while not predicate():
+            if deadline is None:
+                cond.wait()
+            else:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                cond.wait(remaining)
+        return bool(predicate())
+
+    def spawn(self, target, args=(), name=None):
+        """ Run target(*args) in a daemon thread, return the thread
+        """
+        t = threading.Thread(target=target, args=args, name=name)
+        t.daemon = True
+        t.start()
+        return t
+
+    def queue(self, maxsize=0):
+        return Queue.Queue(maxsize)
+
+
+CLOCK = RealClock()
+
+
+class _Task:
+    """ Thread started by VirtualClock.spawn
+    """
+
+    def __init__(self, clock, name):
+        self.clock = clock
+        self.name = name
+        self.done = False
+
+    def join(self):
+        self.clock.wait_until(None, lambda: self.done)
+
+
+class VirtualClock:
+    """ Simulated time for the threads started with `spawn`
+
+    Exactly one of these threads runs at a time. When it sleeps or waits,
+    the turn goes to the first waiter whose predicate holds, in the order
+    they started waiting, otherwise to the one with the earliest deadline,
+    and the time jumps to that deadline. Nothing runs outside of `run`, so
+    the schedule, and with it every timing, only depends on the simulated
+    times.
+
+    The threads must block only through the clock: sleep, wait_until,
+    queue() and the join of the tasks returned by spawn.
+    """
+
+    def __init__(self, start=0.0):
+        self.now = float(start)
+        self.limit = None  # run until this time
+        self._lock = threading.Lock()
+        self._blocked = {}  # seq: (deadline, gate, predicate)
+        self._running = False
+        self._alive = 0
+        self._seq = 0
+        self._controller = None
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self._block(self.now + seconds, None)
+
+    def wait_until(self, cond, predicate, timeout=None):
+        if predicate():
+            return True
+        if cond is not None:
+            cond.release()
+        try:
+            self._block(None if timeout is None else self.now + timeout,
+                        predicate)
+        finally:
+            if cond is not None:
+                cond.acquire()
+        return bool(predicate())
+
+    def spawn(self, target, args=(), name=None):
+        task = _Task(self, name)
+
+        def run():
+            self._block(self.now, None)
+            try:
+                target(*args)
+            except Exception:
+                logging.exception("Simulated thread %s failed", name)
+            finally:
+                with self._lock:
+                    task.done = True
+                    self._alive -= 1
+                    self._running = False
+                    self._next()
+
+        with self._lock:
+            self._alive += 1
+        t = threading.Thread(target=run, name=name)
+        t.daemon = True
+        t.start()
+        return task
+
+    def queue(self, maxsize=0):
+        return VirtualQueue(self, maxsize)
+
+    def run(self, until):
+        """ Let the spawned threads run until the simulated time `until`
+        """
+        gate = threading.Lock()
+        gate.acquire()
+        with self._lock:
+            self.limit = until
+            self._controller = gate
+            self._next()
+        gate.acquire()
+        with self._lock:
+            self.now = max(self.now, until)
+
+    def _block(self, deadline, predicate):
+        gate = threading.Lock()
+        gate.acquire()
+        with self._lock:
+            self._seq += 1
+            self._blocked[self._seq] = (deadline, gate, predicate)
+            self._running = False
+            self._next()
+        gate.acquire()
+
+    def _next(self):
+        """ Hand the turn to the next thread; called with _lock held
+        """
+        if self._running or self.limit is None \
+                or len(self._blocked) < self._alive:
+            return
+        chosen = None
+        for seq in sorted(self._blocked):
+            predicate = self._blocked[seq][2]
+            if predicate is not None and predicate():
+                chosen = seq
+                break
+        if chosen is None:
+            timed = [(deadline, seq) for seq, (deadline, _, _)
+                     in self._blocked.items() if deadline is not None]
+            if timed and min(timed)[0] <= self.limit:
+                deadline, chosen = min(timed)
+                self.now = max(self.now, deadline)
+        if chosen is None:  # nothing to do until the limit
+            if self._controller is not None:
+                self._controller.release()
+                self._controller = None
+            return
+        gate = self._blocked.pop(chosen)[1]
+        self._running = True
+        gate.release()
+
+
+class VirtualQueue:
+    """ The Queue.Queue methods used by the bridge, blocking in simulated
+    time
+    """
+
+    def __init__(self, clock, maxsize=0):
+        self.clock = clock
+        self.maxsize = maxsize
+        self.items = collections.deque()
+
+    def put(self, item, block=True, timeout=None):
+        if self.full():
+            raise Queue.Full
+        self.items.append(item)
+
+    def get(self, block=True, timeout=None):
+        if block:
+            self.clock.wait_until(None, lambda: self.items, timeout)
+        if not self.items:
+            raise Queue.Empty
+        return self.items.popleft()
+
+    def get_nowait(self):
+        return self.get(False)
+
+    def qsize(self):
+        return len(self.items)
+
+    def empty(self):
+        return not self.items
+
+    def full(self):
+        return 0 < self.maxsize <= len(self.items)
+
+    def task_done(self):
+        pass
@@ -1,8 +1,18 @@
 """Implements the dstiny driver
+
+crcmod, ConfigParser and the state API (with its HTTP server) are
+imported when first needed, to shorten the startup of the bridge (see
+startup.py).
 """
-import crcmod 
 import logging
-import ConfigParser
+
+import asynclog
+import bus
+import metrics
+import regstore
+from bus import BUS
+from clock import CLOCK
+from startup import STARTUP
 
 
 # definition of devices configured by the exhood's dStiny
@@ -76,75 +86,217 @@ light_scenes = {13: 0,
                 # 1:100,
                 14: 100}
 
+# zone scenes switching off every output of the hood (dS "deep off" and
+# "absent"), handled when received by the fan & flap device
+DS_SCENE_DEEP_OFF = 68
+DS_SCENE_ABSENT = 72
+off_scenes = (DS_SCENE_DEEP_OFF, DS_SCENE_ABSENT)
+
 
 ###############################################################
 # Support functions
 ###############################################################
 
 def init_crc():
+    import crcmod
     POLYNOMIAL = 0x1d5  # 0xd5 + leading 1
     crc = crcmod.mkCrcFun(poly=POLYNOMIAL, initCrc=0, rev=False)
     return crc
 
 
-class dSTel:
+_crc8 = None
+
+
+def crc8(data):
+    """ CRC of a telegram payload, built on the first call
+    """
+    global _crc8
+    if _crc8 is None:
+        _crc8 = init_crc()
+    return _crc8(data)
+
+
+def read_config(conffile):
+    """ Return the scene configuration as a ConfigParser
+    """
+    import ConfigParser
+    config = ConfigParser.ConfigParser()
+    with open(conffile) as f:
+        config.readfp(f)
+    return config
+
+
+NTRIES = 3  # number of times a command is retried
+
+
+class dSTel(object):
     """ Dstiny telegram
 
     args contains the positional arguments in the following order:
     bank, offset, val_lo, val_hi
     """
+    __slots__ = ('cmdch', 'dSidx', 'args', 'timestamp', 'wire')
 
     def __init__(self, cmdch, dSidx, args):
         self.cmdch = cmdch
         self.dSidx = dSidx
         self.args = args
-        self.NTRIES = 3  # number of times a  command is retried
-        self.crc8_function = init_crc()
+        self.timestamp = None  # reception time, set by dstiny.getTel
+        self.wire = None  # pre-encoded bytes of constant telegrams
 
     def get(self):
-        body = ''
-        for i in self.args:
-            body = body+'%02X' % i
+        if self.wire is not None:
+            return self.wire
+        s = "%c%1X%s" % (self.cmdch, self.dSidx,
+                         ''.join(['%02X' % i for i in self.args]))
+        return "%s%02X\r\n" % (s, crc8(s))
 
-        s = "%c%1X%s" % (self.cmdch, self.dSidx, body)
-        crc = self.crc8_function(s.encode(encoding='utf-8'))
-        s = "%s%02X\r\n" % (s, crc)
-        return s
+
+_constant_tels = {}
+
+
+def constTel(cmdch, dSidx, args):
+    """
+    Return a shared telegram for a command that never changes, encoded
+    only once. The returned telegram must not be modified.
+    """
+    key = (cmdch, dSidx, tuple(args))
+    Tel = _constant_tels.get(key)
+    if Tel is None:
+        Tel = dSTel(cmdch, dSidx, list(args))
+        Tel.wire = Tel.get()
+        _constant_tels[key] = Tel
+    return Tel
+
+
+class CRCError(ValueError):
+    pass
+
+
+def decodeTel(data, crc8_function):
+    """
+    Decode a received line (including the end of line characters) into a
+    telegram. Return None if the telegram carries no arguments, raise
+    CRCError if the CRC does not match.
+    """
+    mydata = data[:-2]  # remove end of line characters
+    recv_crc = int(mydata[-2:], 16)  # extract CRC,
+    payload = mydata[:-2]  # payload without CRC
+
+    if recv_crc != crc8_function(payload):
+        raise CRCError(data)
+
+    cmd = payload[0]
+    dsxid = int(payload[1], 16)
+    array = payload[2:]
+    if not array:
+        return None
+
+    args = []
+    i = 0
+    while i < len(array):
+        args.append(int(array[i:i+2], 16))
+        i = i+2
+    return dSTel(cmd, dsxid, args)
 
 
 class dstiny:
-    def __init__(self, port, mivune_ctr, logfile, conffile):
+    def __init__(self, port, mivune_ctr, logfile, conffile, regfile=None,
+                 config=None, clock=CLOCK):
+        """
+        `config` is the scene configuration if already read from
+        `conffile` (see read_config)
+        """
+        self.clock = clock
         self.port = port
         self.port.ser.close()
         self.port.ser.open()
         self.logger = logging.getLogger(logfile)
-        self.crc8_function = init_crc()
+        self.crc8_function = crc8
         self.conffile = conffile
-        self.config = ConfigParser.ConfigParser()
-        self.config.readfp(open(self.conffile))
+        if config is None:
+            config = read_config(conffile)
+        self.config = config
+        self.registers = None
+        if regfile:
+            self.registers = regstore.RegisterStore(regfile)
+            self.loadRegisters()
         self.mivune_ctr = mivune_ctr
         self.checkConfig()
-        self.NTRIES = 3
+        self.publishScenes()
+        self.NTRIES = NTRIES
         # self.memory_map=[]
 
     def checkConfig(self):
         for scene in fan_scenes_regs.keys():
             reg = fan_scenes_regs[scene]
-            if not self.config.has_option('Fan_Flap', str(reg)):
+            if not self.hasConfSceneLevel('Fan_Flap', reg):
                 value = fan_scenes_defaults[scene]
                 self.setConfSceneLevel('Fan_Flap', reg, value)
 
         for scene in flap_scenes_regs.keys():
             reg = flap_scenes_regs[scene]
-            if not self.config.has_option('Fan_Flap', str(reg)):
+            if not self.hasConfSceneLevel('Fan_Flap', reg):
                 value = flap_scenes_defaults[scene]
                 self.setConfSceneLevel('Fan_Flap', reg, value)
 
+    def loadRegisters(self):
+        """
+        Copy the scene levels of the configuration file into the
+        registers not set yet by any bridge process
+        """
+        if not self.config.has_section('Fan_Flap'):
+            return
+        values = {}
+        for reg, level in self.config.items('Fan_Flap'):
+            try:
+                reg, level = int(reg), int(level)
+            except ValueError:
+                continue
+            if 0 <= reg < regstore.NREGS and self.registers.get(reg) < 0:
+                values[reg] = level
+        if values:
+            self.registers.update(values)
+
+    def publishScenes(self):
+        """
+        Publish the scene table (scene: level) to the state API
+        """
+        from state_api import STATE
+        fan = dict((scene, self.getConfSceneLevel('Fan_Flap', reg))
+                   for scene, reg in fan_scenes_regs.items())
+        flap = dict((scene, self.getConfSceneLevel('Fan_Flap', reg))
+                    for scene, reg in flap_scenes_regs.items())
+        STATE.update(scenes={"fan": fan, "flap": flap,
+                             "light": dict(light_scenes)})
+
+    def publishSceneLevel(self, reg, level):
+        """
+        Publish a changed scene register without re-reading the others
+        """
+        from state_api import STATE
+        scenes = dict(STATE.get("scenes", {}))
+        for kind, regs in (("fan", fan_scenes_regs),
+                           ("flap", flap_scenes_regs)):
+            for scene, r in regs.items():
+                if r == reg:
+                    levels = dict(scenes.get(kind, {}))
+                    levels[scene] = level
+                    scenes[kind] = levels
+        STATE.update(scenes=scenes)
+
+    def hasConfSceneLevel(self, section, scene):
+        if self.registers is not None and section == 'Fan_Flap':
+            return self.registers.get(int(scene)) >= 0
+        return self.config.has_option(section, str(scene))
+
     def getConfSceneLevel(self, section, scene):
         """
         Return the corresponding configured value, or -1 if not
         present or improperly configured
         """
+        if self.registers is not None and section == 'Fan_Flap':
+            return self.registers.get(int(scene))
 
         scene = str(scene)
         if self.config.has_option(section, str(scene)):
@@ -155,17 +307,16 @@ class dstiny:
                 self.logger.exception(e)
                 return -1
         else:
-            self.logger.info("section does not exist:"+section+"->"+scene)
+            self.logger.info("section does not exist:%s->%s", section, scene)
             return -1
 
     def setConfSceneLevel(self, section, scene, value):
+        if self.registers is not None and section == 'Fan_Flap':
+            self.registers.set(int(scene), value)
+            return True
         try:
-            self.config.set(section, str(scene), str(value))
-            with open(self.conffile, 'w') as c:
-                self.config.write(c)
-                return True
-        except ConfigParser.NoSectionError:
-            self.config.add_section(section)
+            if not self.config.has_section(section):
+                self.config.add_section(section)
             self.config.set(section, str(scene), str(value))
             with open(self.conffile, 'w') as c:
                 self.config.write(c)
@@ -180,36 +331,25 @@ class dstiny:
         correct, then return the telegram.
         """
         try:
-            mydata = data[:-2]  # remove end of line characters
-            self.recv_crc = int(mydata[-2:], 16)  # extract CRC,
-            self.payload = mydata[:-2]  # payload without CRC
-            self.comp_crc = self.crc8_function(self.payload)
-
-            if self.recv_crc == self.comp_crc:
-                cmd = self.payload[0]
-                dsxid = int(self.payload[1], 16)
-                array = self.payload[2:]
-                args = []
-                i = 0
-                if array:
-                    while i < len(array):
-                        n = int(array[i:i+2], 16)
-                        i = i+2
-                        args.append(n)
-
-                    Tel = dSTel(cmd, dsxid, args)
-                    return Tel
-                else:
-                    return None
-            else:
-                self.logger.warning("CRC error in dstiny rx chain: %s" % data)
-                return None
+            Tel = decodeTel(data, self.crc8_function)
+            if Tel:
+                Tel.timestamp = self.clock.time()
+                if BUS.wants(bus.Telegram):
+                    BUS.publish(bus.Telegram(Tel.timestamp, 'rx', Tel.cmdch,
+                                             Tel.dSidx, tuple(Tel.args)))
+            return Tel
+        except CRCError:
+            metrics.CRC_ERRORS.inc()
+            self.logger.warning("CRC error in dstiny rx chain: %s", data)
+            return None
         except Exception as e:
             self.logger.exception(e)
             return None
 
     def read(self):
         s = self.port.ser.readline()
+        if s:
+            asynclog.trace_telegram(asynclog.CHANNEL_DSTINY_RX, s)
         return s
 
     def write_read_verify(self, Tel):
@@ -222,36 +362,43 @@ class dstiny:
         self.write(Tel)  # send telegram
         s = self.read()
         while not s and counter < self.NTRIES:
+            metrics.WRITE_RETRIES.inc()
             self.write(Tel)  # retry
             s = self.read()
             counter = counter+1
 
         if not s and counter >= self.NTRIES:
+            metrics.WRITE_TIMEOUTS.inc()
             self.logger.warning("No response received")
             return None
         else:
             tel = self.getTel(s)
             if tel:
-                self.logger.info("[pc <- dstiny]\t[answer]\t"+tel.get()[:-2])
+                self.logger.info("[pc <- dstiny]\t[answer]\t%s", s[:-2])
                 return tel
             else:
                 return None
 
     def write(self, Tel):
         s = Tel.get()
-        self.logger.info("[pc -> dstiny]\t[write]\t"+s.encode('utf-8')[:-2])
-        self.port.ser.write(s.encode('utf-8'))
+        self.logger.info("[pc -> dstiny]\t[write]\t%s", s[:-2])
+        self.port.ser.write(s)
+        asynclog.trace_telegram(asynclog.CHANNEL_DSTINY_TX, s)
+        if BUS.wants(bus.Telegram):
+            BUS.publish(bus.Telegram(self.clock.time(), 'tx', Tel.cmdch,
+                                     Tel.dSidx, tuple(Tel.args)))
 
     def readWord(self, bank, offset, dSidx):
         sendTel = dSTel('c', dSidx, [0x03, bank, offset, 0x00, 0x00])
         recvTel = self.write_read_verify(sendTel)
         return recvTel
 
-    def register(self, DSMS):
+    def register(self, DSMS, const=False):
         """
         Send registration command
         """
-        registerTel = dSTel('c', 0, [0x02, 0x40, 0x04, 0x01, DSMS])
+        make = constTel if const else dSTel
+        registerTel = make('c', 0, [0x02, 0x40, 0x04, 0x01, DSMS])
         ans = self.write_read_verify(registerTel)
         return ans
 
@@ -295,22 +442,28 @@ class dstiny:
         else:
             return None
 
-    def writeByte(self, dSidx, bank, offset, value):
-        Tel = dSTel('c', dSidx, [0x00, bank, offset, value, 0x00])
+    def writeByte(self, dSidx, bank, offset, value, const=False):
+        """
+        With `const`, the telegram is encoded once and kept (see constTel);
+        only for the fixed configuration writes
+        """
+        make = constTel if const else dSTel
+        Tel = make('c', dSidx, [0x00, bank, offset, value, 0x00])
         ans = self.write_read_verify(Tel)
         if ans:
             return ans
         else:
             return None
 
-    def activateDSCommands(self, dSidx, DSCMD):
+    def activateDSCommands(self, dSidx, DSCMD, const=False):
         """
         DSCMD (8 Bit) 0 = do not transfer telegrams (default) 1 =
         transfer telegrams for this device and activated group within
         this zone 2 = transfer telegrams for this device and all
         groups within this zone
         """
-        Tel = dSTel('c', dSidx, [0x00, 0x03, 0x32, DSCMD, 0x00])
+        make = constTel if const else dSTel
+        Tel = make('c', dSidx, [0x00, 0x03, 0x32, DSCMD, 0x00])
         ans = self.write_read_verify(Tel)
         if ans:
             return ans
@@ -342,14 +495,52 @@ class dstiny:
         else:
             return None
 
-    def genStatusPollEvent(self, dSidx, sensorID):
-        Tel = dSTel('g', dSidx, [0x07, sensorID, 0x00])
+    def genStatusPollEvent(self, dSidx, sensorID, const=False):
+        make = constTel if const else dSTel
+        Tel = make('g', dSidx, [0x07, sensorID, 0x00])
         ans = self.write_read_verify(Tel)
         if ans.cmdch == 'e':
             return ans
         else:
             return None
 
+    def observeSceneLatency(self, Tel):
+        """
+        Record the time from the reception of the scene telegram to the
+        mvune controller acknowledging it
+        """
+        STARTUP.mark("first_event")
+        if Tel.timestamp is not None:
+            metrics.E2E_LATENCY.observe(self.clock.time() - Tel.timestamp,
+                                        "ds_to_mvune")
+
+    def groupSceneCalls(self, dSidx, group, scene):
+        """
+        Return the mvune method calls (method, value) settling the outputs
+        addressed by a group scene. Fan and flap levels already reached
+        are skipped, since the controller would not echo them.
+        """
+        calls = []
+        fan = flap = -1
+        if dSidx == EXHOOD_LIGHT_dSxid:
+            if scene in light_scenes:
+                calls.append(("setIntensity", light_scenes[scene]))
+        elif dSidx == EXHOOD_FAN_FLAP_dSxid:
+            if scene in off_scenes:
+                fan = flap = 0
+                calls.append(("setIntensity", 0))
+            elif group == DS_GROUP_VENTILATION and scene in fan_scenes_regs:
+                fan = self.getConfSceneLevel('Fan_Flap',
+                                             fan_scenes_regs[scene])
+            elif group == DS_GROUP_VENTILATION and scene in flap_scenes_regs:
+                flap = self.getConfSceneLevel('Fan_Flap',
+                                              flap_scenes_regs[scene])
+        if fan >= 0 and fan != self.mivune_ctr.get_fan_current_level():
+            calls.append(("setExhaustAir", fan))
+        if flap >= 0 and flap != self.mivune_ctr.get_flap_current_level():
+            calls.append(("setSupplyAir", flap))
+        return calls
+
     def parse_dSCommand(self, Tel):
         cmdch = Tel.cmdch
         dSidx = Tel.dSidx
@@ -410,13 +601,15 @@ class dstiny:
                 if dSidx == 1:  # FAN & FLAP
                     if reg in fan_scenes_regs.values():  # scenes 0-4 -> fan
                         self.setConfSceneLevel('Fan_Flap', reg, value)
+                        self.publishSceneLevel(reg, value)
                         self.logger.info(
-                            "Configured ExHood->Fan register:%d to level:%d%%" % (reg, value))
+                            "Configured ExHood->Fan register:%d to level:%d%%", reg, value)
 
                     elif reg in flap_scenes_regs.values():  # scenes 20-24 -> flap
                         self.setConfSceneLevel('Fan_Flap', reg, value)
+                        self.publishSceneLevel(reg, value)
                         self.logger.info(
-                            "Configured ExHood->Flap register:%d to level:%d%%" % (reg, value))
+                            "Configured ExHood->Flap register:%d to level:%d%%", reg, value)
 
                     # success=mivune_ctr.set_exhaust_percent(value)
 
@@ -436,19 +629,29 @@ class dstiny:
                 if addr1 <= 15:  # addr1 is the zone and addr2 is the group
                     addr2 = addr & 0x3F  # group
                     self.logger.info(
-                        "Group scene: dsidx:"+str(dSidx)+"\tscene:"+str(scene)+"\tgroup:"+str(addr2))
-
-                    if dSidx == EXHOOD_LIGHT_dSxid:  # Light
-                        self.logger.info("Got light scene")
-                        if scene in light_scenes.keys():
-                            value = light_scenes[scene]
-                            success = self.mivune_ctr.setLightIntensity(
-                                value)  # Fan
+                        "Group scene: dsidx:%d\tscene:%d\tgroup:%d",
+                        dSidx, scene, addr2)
+
+                    calls = self.groupSceneCalls(dSidx, addr2, scene)
+                    if calls:
+                        success, results = self.mivune_ctr.dispatch(calls)
+                        if success:
+                            self.observeSceneLatency(Tel)
+                            self.logger.info(
+                                "Group scene send to mivune controller: %s",
+                                calls)
+                            # dispatch awaits the echoes of the fan
+                            # and flap calls, they are not meant to be
+                            # forwarded to the dSS
+                            from state_api import STATE
+                            for method, value in calls:
+                                if method == "setIntensity":
+                                    STATE.update(light=value)
 
                 else:
                     self.logger.info(
-                        "Individual addressing: dsidx:"+str(dSidx)
-                        + "\tscene:"+str(scene))
+                        "Individual addressing: dsidx:%d\tscene:%d",
+                        dSidx, scene)
                     # Implement the reaction to scenes only here
                     # React to scenes only when the device is addressed 
                     # as single device
@@ -460,8 +663,8 @@ class dstiny:
                             level = self.getConfSceneLevel("Fan_Flap", reg)
                             if level >= 0:
                                 self.logger.info(
-                                    "Retrieved fan scene:%d -> level:%d %%"
-                                    % (scene, level))
+                                    "Retrieved fan scene:%d -> level:%d %%",
+                                    scene, level)
 
                                 # update the level only if necessary,
                                 # otherwise the mivune system will not
@@ -469,15 +672,20 @@ class dstiny:
                                 # remain true.
                                 if level !=\
                                    self.mivune_ctr.get_fan_current_level():
+                                    # indicates to the mivune controller,
+                                    # that the next event is not meant to
+                                    # be forwarded to the dSS; awaited
+                                    # before the call, the long-poll in
+                                    # flight may return it first
+                                    self.mivune_ctr.set_lock(True)
                                     success = self.mivune_ctr.setExhaustAir(
                                         level)  # Fan
                                     if success:
+                                        self.observeSceneLatency(Tel)
                                         self.logger.info(
                                             "Scene send to mivune controller")
-                                        # indicates to the mivune controller,
-                                        # that the next event is not meant to
-                                        # be forwarded to the dSS
-                                        self.mivune_ctr.set_lock(True)
+                                    else:
+                                        self.mivune_ctr.echo_cancelled()
 
                         elif scene in flap_scenes_regs.keys():
                             reg = flap_scenes_regs[scene]
@@ -485,24 +693,26 @@ class dstiny:
                             if level >= 0:
 
                                 self.logger.info(
-                                    "Retrieved flap scene:%d -> level:%d %%" %
-                                    (scene, level))
+                                    "Retrieved flap scene:%d -> level:%d %%",
+                                    scene, level)
 
                                 # update the level only if necessary,
                                 # otherwise the mivune system will not
                                 # generate an event an the lock will
                                 # remain true.
 
-                                self.logger.info("level:%d\tcurrent_level:%d" 
-                                    % (level, 
-                                       self.mivune_ctr.get_flap_current_level()))
+                                self.logger.info(
+                                    "level:%d\tcurrent_level:%d", level,
+                                    self.mivune_ctr.get_flap_current_level())
 
                                 if level !=\
                                    self.mivune_ctr.get_flap_current_level():
+                                    # the echo is not meant to be
+                                    # forwarded to the dSS
+                                    self.mivune_ctr.set_lock(True)
                                     success = self.mivune_ctr.setSupplyAir(
                                         level)  # Flap
                                     if success:
-                                        # indicates to the mivune controller,
-                                        # that the next event is not meant to
-                                        # be forwarded to the dSS
-                                        self.mivune_ctr.set_lock(True)
+                                        self.observeSceneLatency(Tel)
+                                    else:
+                                        self.mivune_ctr.echo_cancelled()
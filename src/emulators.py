@@ -0,0 +1,383 @@
+"""Stand-ins for the dStiny and the mvune controller
+
+`DstinyEmulator` speaks the dStiny telegram protocol on a pseudo-terminal,
+so the bridge can open it like the real serial port. `MvuneStandIn` serves
+the subset of the mvune JSON interface used by mvune.Mvune on a local
+HTTP port, or in-process through a `StandInSession`. Both report the
+traffic they see to listener callbacks, which is what the benchmarks in
+benchmarks/ use to time the bridge. `BridgeProcess` runs main.py against a
+pair of them.
+
+Both take their time from a clock (see clock.py), so that simulator.py can
+run them in simulated time.
+"""
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tty
+import urlparse
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+
+import dstiny
+from clock import CLOCK
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class DstinyProtocol:
+    """ dStiny side of the telegram protocol
+
+    Answers the configuration ('c'), status poll ('g') and pass-through
+    reply ('q') telegrams of the bridge, and sends status ('s'), scene
+    ('i') and pass-through ('p') telegrams on request. Listeners are called
+    as listener(timestamp, Tel) for every telegram received from the
+    bridge. Subclasses implement write(line) towards the bridge.
+    """
+
+    def __init__(self, clock=CLOCK):
+        self.clock = clock
+        self.crc8_function = dstiny.crc8
+        self.registers = {}  # (dSidx, bank, offset): 16-bit value
+        self.listeners = []
+        self.state = "OFF"  # OFF -> INIT -> ONLINE
+        self.online = threading.Event()
+
+    def boot(self, interval=1.0):
+        """ Announce a reset until the bridge starts the configuration
+        """
+        def announce():
+            while self.state == "OFF":
+                self.send(dstiny.dSTel('s', 0, [0x00]))
+                self.clock.sleep(interval)
+
+        self.clock.spawn(announce, name="dstiny-boot")
+
+    def send(self, Tel):
+        self.write(Tel.get())
+
+    def scene(self, dSidx, scene, zone=16, group=0):
+        """ Send a scene call; zones 0-15 address a group
+        """
+        addr = (zone << 6) | (group & 0x3F)
+        self.send(dstiny.dSTel('i', dSidx, [addr & 0xFF, (addr >> 8) & 0xFF,
+                                            0x08, scene, 0x02]))
+
+    def passThrough(self, dSidx, cmd, reg, value=0):
+        self.send(dstiny.dSTel('p', dSidx, [cmd, 0x7F, reg, value & 0xFF,
+                                            (value >> 8) & 0xFF]))
+
+    def answer(self, Tel):
+        args = Tel.args
+        if Tel.cmdch == 'c':
+            op, bank, offset = args[0], args[1], args[2]
+            key = (Tel.dSidx, bank, offset)
+            if op == 0x03:  # read word
+                value = self.registers.get(key, 0)
+                return dstiny.dSTel('c', Tel.dSidx, [op, bank, offset,
+                                                     value & 0xFF,
+                                                     (value >> 8) & 0xFF])
+            if op == 0x00:  # write byte
+                self.registers[key] = args[3]
+            elif op == 0x02:  # write word
+                self.registers[key] = args[3] | (args[4] << 8)
+            return dstiny.dSTel('c', Tel.dSidx, list(args))
+        if Tel.cmdch == 'g':  # status poll -> event
+            return dstiny.dSTel('e', Tel.dSidx, list(args))
+        if Tel.cmdch == 'q':
+            return dstiny.dSTel('q', Tel.dSidx, list(args))
+        return None
+
+    def handle(self, Tel):
+        if self.state == "OFF":
+            self.state = "INIT"
+        ans = self.answer(Tel)
+        if ans:
+            self.send(ans)
+        # the registration command completes the configuration
+        if Tel.cmdch == 'c' and Tel.args[:3] == [0x02, 0x40, 0x04]:
+            self.state = "ONLINE"
+            self.send(dstiny.dSTel('s', 0, [0x20]))
+            self.online.set()
+        now = self.clock.time()
+        for listener in self.listeners:
+            listener(now, Tel)
+
+
+class DstinyEmulator(DstinyProtocol):
+    """ dStiny on a pseudo-terminal
+    """
+
+    def __init__(self, clock=CLOCK):
+        DstinyProtocol.__init__(self, clock)
+        self.master, self.slave = os.openpty()
+        tty.setraw(self.slave)
+        self.port = os.ttyname(self.slave)
+        self._write_lock = threading.Lock()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run,
+                                        name="dstiny-emulator")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def write(self, line):
+        with self._write_lock:
+            os.write(self.master, line)
+
+    def _run(self):
+        buf = ''
+        while True:
+            try:
+                data = os.read(self.master, 4096)
+            except OSError:
+                return
+            if not data:
+                return
+            buf += data
+            while '\n' in buf:
+                line, buf = buf.split('\n', 1)
+                try:
+                    Tel = dstiny.decodeTel(line + '\n', self.crc8_function)
+                except ValueError:
+                    continue
+                if Tel:
+                    self.handle(Tel)
+
+    def close(self):
+        for fd in (self.master, self.slave):
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+
+
+# service id: (service name, device name); device names are the defaults
+# of main.py
+STANDIN_SERVICES = {
+    "S1": ("exhaustAirDeviceService", "integrierter Haubenluefter"),
+    "S2": ("supplyAirDeviceService", "integrierter Haubenluefter"),
+    "S3": ("lightingDeviceService", "Licht1"),
+    "S4": ("windowContactDeviceService", "Zuluft FKS"),
+}
+
+# method: (service id, field echoed in the value change event)
+STANDIN_METHODS = {
+    "setExhaustAir": ("S1", "exhaustAirFromField"),
+    "setSupplyAir": ("S2", "supplyAirFromField"),
+    "setIntensity": ("S3", "intensity"),
+    "setIntensitySceneValue": ("S3", "intensitySceneValue"),
+}
+
+
+class _StandInHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = self.server.standin.get(self.path)
+        if body is None:
+            self.send_error(404)
+            return
+        data = json.dumps(body)
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class MvuneStandIn:
+    """ Local mvune controller
+
+    Implements getObjectModelAndAjaxSessionId, sendEvent (method calls) and
+    waitForEvents. A method call that changes a value is echoed as a
+    notification.OMValueChange event, like the controller does. Listeners
+    are called as listener(timestamp, method, value) for every method call.
+
+    `model` replaces the built-in object model by a recorded
+    getObjectModelAndAjaxSessionId response. `delay` is the time in seconds
+    a method call takes, like the round trip to a real controller. With
+    `port` None no HTTP server is opened, see StandInSession.
+    """
+
+    def __init__(self, address="127.0.0.1", port=0, poll_timeout=30.0,
+                 model=None, delay=0, clock=CLOCK):
+        self.sessionId = "standin-session"
+        self.poll_timeout = poll_timeout
+        self.delay = delay
+        self.model = model
+        self.clock = clock
+        self.values = {}  # service id: {field: value}
+        self.events = []
+        self.listeners = []
+        self.cond = threading.Condition()
+        self.server = None
+        self.address = None
+        if port is not None:
+            self.server = _ThreadingHTTPServer((address, port),
+                                               _StandInHandler)
+            self.server.standin = self
+            self.address = "%s:%d" % self.server.server_address
+
+    def start(self):
+        t = threading.Thread(target=self.server.serve_forever,
+                             name="mvune-standin")
+        t.daemon = True
+        t.start()
+
+    def close(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+
+    def get(self, url):
+        """ Return the JSON body answering a GET of `url`, or None
+        """
+        query = urlparse.parse_qs(urlparse.urlparse(url).query)
+        action = query.get("action", [""])[0].strip()
+        if action == "getObjectModelAndAjaxSessionId":
+            return self.objectModel()
+        elif action == "sendEvent":
+            args = [a.strip() for a in query.get("arg[]", [])]
+            return self.methodCall(*args[:3])
+        elif action == "waitForEvents":
+            return self.waitForEvents()
+        return None
+
+    def objectModel(self):
+        if self.model is not None:
+            model = dict(self.model)
+            model["ajaxSessionId"] = self.sessionId
+            return model
+        devices = {}
+        for sid, (name, device) in sorted(STANDIN_SERVICES.items()):
+            d = devices.setdefault(device, {"name": device, "serviceIds": []})
+            d["serviceIds"].append(sid)
+        return {
+            "ajaxSessionId": self.sessionId,
+            "objectModel": {
+                "devices": dict(("D%d" % i, d) for i, d in
+                                enumerate(sorted(devices.values()))),
+                "services": dict((sid, {"name": name}) for sid, (name, _)
+                                 in STANDIN_SERVICES.items()),
+            }}
+
+    def methodCall(self, sid=None, method=None, value=None):
+        if method not in STANDIN_METHODS:
+            return {"success": False}
+        try:
+            value = float(value)
+        except (TypeError, ValueError):
+            return {"success": False}
+        if value == int(value):
+            value = int(value)
+        if self.delay:
+            self.clock.sleep(self.delay)
+        now = self.clock.time()
+        for listener in self.listeners:
+            listener(now, method, value)
+        sid, field = STANDIN_METHODS[method]
+        if self.values.get(sid, {}).get(field) != value:
+            self.push(sid, field, value)
+        return {"success": True}
+
+    def pushEvents(self, events):
+        """ Emit a list of raw events, e.g. recorded from a controller
+        """
+        with self.cond:
+            self.events.extend(events)
+            self.cond.notify_all()
+
+    def push(self, sid, field, value):
+        """ Emit a value change of `field` of service `sid`
+        """
+        with self.cond:
+            self.values.setdefault(sid, {})[field] = value
+            self.events.append({"eventName": "notification.OMValueChange",
+                                "changedObjects": {sid: {field: value}}})
+            self.cond.notify_all()
+
+    def waitForEvents(self):
+        with self.cond:
+            self.clock.wait_until(self.cond, lambda: self.events,
+                                  self.poll_timeout)
+            events, self.events = self.events, []
+        return {"events": events}
+
+
+class StandInResponse:
+    """ The part of a requests.Response used by mvune.Mvune
+    """
+
+    def __init__(self, body):
+        self.status_code = 404 if body is None else 200
+        self.content = "" if body is None else json.dumps(body)
+
+    def json(self):
+        return json.loads(self.content)
+
+
+class StandInSession:
+    """ HTTP session of mvune.Mvune answered in-process by a
+    MvuneStandIn, each request taking `latency` seconds of its clock
+    """
+
+    def __init__(self, standin, latency=0):
+        self.standin = standin
+        self.latency = latency
+
+    def get(self, url):
+        if self.latency:
+            self.standin.clock.sleep(self.latency)
+        return StandInResponse(self.standin.get(url))
+
+
+class BridgeProcess:
+    """ main.py running against the emulators in a temporary directory
+    """
+
+    def __init__(self, extra_args=(), model=None):
+        self.tmp = tempfile.mkdtemp(prefix='ds-mvune-bench-')
+        conffile = os.path.join(self.tmp, 'scenes.conf')
+        shutil.copy(os.path.join(ROOT, '__scenes.conf'), conffile)
+        self.logfile = os.path.join(self.tmp, 'tiny.log')
+
+        self.mvune = MvuneStandIn(model=model)
+        self.mvune.start()
+        self.tiny = DstinyEmulator()
+        self.tiny.start()
+
+        args = [sys.executable, os.path.join(ROOT, 'src', 'main.py'),
+                '-c', self.mvune.address, '-p', self.tiny.port,
+                '-l', self.logfile, '-s', conffile, '-i', '0']
+        args.extend(extra_args)
+        self.devnull = open(os.devnull, 'w')
+        self.proc = subprocess.Popen(args, cwd=self.tmp,
+                                     stdout=self.devnull,
+                                     stderr=self.devnull)
+
+    def wait_online(self, timeout=30):
+        self.tiny.boot()
+        if not self.tiny.online.wait(timeout):
+            raise RuntimeError("bridge did not configure the dstiny")
+        time.sleep(0.5)  # let the FSM reach dSONLINE
+
+    def close(self):
+        if self.proc.poll() is None:
+            self.proc.terminate()
+            self.proc.wait()
+        self.devnull.close()
+        self.tiny.close()
+        self.mvune.close()
+        shutil.rmtree(self.tmp, ignore_errors=True)
@@ -0,0 +1,388 @@
+"""Shared-memory channels of the multi-process mode
+
+With `main.py --multiprocess` the dStiny serial link and the mvune HTTP
+session run in two processes, so that JSON decoding and `requests` in the
+HTTP process no longer compete with the serial thread for the GIL. The
+processes exchange fixed-size records over single-producer,
+single-consumer rings in anonymous shared memory, created before the fork.
+A byte written to a pipe wakes up the consumer.
+
+* events: Event records, HTTP process -> serial process (EventQueue)
+* calls / replies: mvune method calls of the serial process and their
+  results (MvuneProxy -> serve_calls)
+* SharedState: the mvune lock (echoes awaited) and the current fan and
+  flap levels
+* changes: the bus.MvuneChange records published in the HTTP process,
+  re-published on the bus of the serial process for the state API
+  (forward_changes -> publish_changes)
+"""
+import collections
+import errno
+import fcntl
+import logging
+import mmap
+import os
+import Queue
+import select
+import struct
+import threading
+import time
+
+import bus
+import mvune
+
+RING_HEADER = struct.Struct("<II")  # head (written), tail (read)
+COUNTER = struct.Struct("<I")
+FIELD = struct.Struct("<i")
+
+# timestamp, value, dSidx, sensor id, type
+EVENT = struct.Struct("<diBBB")
+EVENT_TYPES = ("Status", "Binary")
+
+MAX_CALLS = 4  # method calls per record
+# seq, kind, number of calls, method codes, values
+CALL = struct.Struct("<IBB%dB%dd" % (MAX_CALLS, MAX_CALLS))
+CALL_METHOD = 0  # a single Mvune method, e.g. setExhaustAir
+CALL_DISPATCH = 1  # Mvune.dispatch of mvune.METHODS
+# seq, success, success of each call
+REPLY = struct.Struct("<IB%dB" % MAX_CALLS)
+METHOD_CODES = ("setExhaustAir", "setSupplyAir", "setLightIntensity",
+                "setIntensity")
+CALL_TIMEOUT = 10.0  # seconds
+
+# timestamp, fan, flap, window, locked
+CHANGE = struct.Struct("<diiiB")
+
+# echoes expected by the serial and by the HTTP process, echoes received,
+# fan level, flap level
+SHARED_FIELDS = ("serial_expected", "http_expected", "received", "fan",
+                 "flap")
+SHARED = struct.Struct("<" + "i" * len(SHARED_FIELDS))
+
+
+class Ring:
+    """ Single-producer, single-consumer ring of `record` structs
+    """
+
+    def __init__(self, record, capacity=256):
+        assert capacity & (capacity - 1) == 0, "capacity must be 2**n"
+        self.record = record
+        self.capacity = capacity
+        self.map = mmap.mmap(-1, RING_HEADER.size + capacity * record.size)
+        self.rfd, self.wfd = os.pipe()
+        for fd in (self.rfd, self.wfd):
+            fcntl.fcntl(fd, fcntl.F_SETFL,
+                        fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+
+    def qsize(self):
+        head, tail = RING_HEADER.unpack_from(self.map, 0)
+        return (head - tail) & 0xFFFFFFFF
+
+    def put(self, *fields):
+        """ Append a record, return False if the ring is full
+        """
+        head, tail = RING_HEADER.unpack_from(self.map, 0)
+        if (head - tail) & 0xFFFFFFFF >= self.capacity:
+            return False
+        self.record.pack_into(self.map, RING_HEADER.size + (
+            head % self.capacity) * self.record.size, *fields)
+        COUNTER.pack_into(self.map, 0, (head + 1) & 0xFFFFFFFF)
+        try:
+            os.write(self.wfd, "x")
+        except OSError, e:  # the pipe is full, the consumer is awake
+            if e.errno != errno.EAGAIN:
+                raise
+        return True
+
+    def get(self, timeout=None):
+        """ Remove and return the oldest record as a tuple, or None after
+        `timeout` seconds
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        while True:
+            head, tail = RING_HEADER.unpack_from(self.map, 0)
+            if head != tail:
+                fields = self.record.unpack_from(self.map, RING_HEADER.size + (
+                    tail % self.capacity) * self.record.size)
+                COUNTER.pack_into(self.map, COUNTER.size,
+                                  (tail + 1) & 0xFFFFFFFF)
+                return fields
+            remaining = None
+            if deadline is not None:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return None
+            try:
+                select.select([self.rfd], [], [], remaining)
+                os.read(self.rfd, 4096)
+            except (OSError, select.error), e:
+                if e.args[0] not in (errno.EAGAIN, errno.EINTR):
+                    raise
+
+
+class EventQueue:
+    """ main.EventQueue interface over a Ring, as used by post_event and
+    dstiny_thread
+
+    The writer cannot replace the events in the ring. The reader moves
+    them to its own table of waiting events on each get, where a newer
+    event of the same (dSidx, SID) replaces the waiting one, so the ring
+    only holds the events that arrived since the last get.
+
+    `factory` builds an event from (dSidx, value, sid, type).
+    """
+
+    def __init__(self, factory, capacity=256):
+        self.ring = Ring(EVENT, capacity)
+        self.factory = factory
+        self.pending = collections.OrderedDict()  # of the reader
+
+    def put(self, e):
+        if not self.ring.put(e.timestamp, e.value, e.dSidx, e.SID,
+                             EVENT_TYPES.index(e.type)):
+            raise Queue.Full
+        return False
+
+    def _add(self, fields):
+        if fields is not None:
+            timestamp, value, dSidx, sid, event_type = fields
+            e = self.factory(dSidx, value, sid, EVENT_TYPES[event_type])
+            e.timestamp = timestamp
+            self.pending[(dSidx, sid)] = e
+        return fields
+
+    def get(self, block=True, timeout=None):
+        while self._add(self.ring.get(0)) is not None:
+            pass
+        if not self.pending and block:
+            self._add(self.ring.get(timeout))
+        if not self.pending:
+            raise Queue.Empty
+        return self.pending.popitem(last=False)[1]
+
+    def qsize(self):
+        return len(self.pending) + self.ring.qsize()
+
+    def empty(self):
+        return self.qsize() == 0
+
+    def full(self):
+        return self.ring.qsize() >= self.ring.capacity
+
+    def task_done(self):
+        pass
+
+
+class SharedState:
+    """ Mvune lock and current levels, visible to both processes
+    """
+
+    def __init__(self):
+        self.map = mmap.mmap(-1, SHARED.size)
+
+    def get(self):
+        """ Return the values of SHARED_FIELDS
+        """
+        return SHARED.unpack_from(self.map, 0)
+
+    def set(self, **values):
+        # each field is written alone, the processes update different ones
+        for name, value in values.items():
+            FIELD.pack_into(self.map, SHARED_FIELDS.index(name) * FIELD.size,
+                            value)
+
+
+class Channels:
+    """ Everything shared by the two processes; create before forking
+    """
+
+    def __init__(self, event_factory):
+        self.events = EventQueue(event_factory)
+        self.calls = Ring(CALL, 16)
+        self.replies = Ring(REPLY, 16)
+        self.shared = SharedState()
+        self.changes = Ring(CHANGE, 64)
+
+
+class _SharedLevels:
+    """ Lock and current levels of Mvune kept in a SharedState
+
+    Each process counts the echoes it awaits in its own field, `expected`;
+    the HTTP process, which decodes the long-poll, the received ones.
+    """
+    expected = None  # name of the field
+
+    def set_fan_current_level(self, level):
+        self.shared.set(fan=level)
+
+    def set_flap_current_level(self, level):
+        self.shared.set(flap=level)
+
+    def get_fan_current_level(self):
+        return self.shared.get()[3]
+
+    def get_flap_current_level(self):
+        return self.shared.get()[4]
+
+    def _echoes(self):
+        """ Return (awaited by this process, by both, received)
+        """
+        values = dict(zip(SHARED_FIELDS, self.shared.get()))
+        return (values[self.expected],
+                values["serial_expected"] + values["http_expected"],
+                values["received"])
+
+    def set_lock(self, status):
+        # correlation ids are not shared between the processes
+        self.lock_trace = None
+        own, expected, received = self._echoes()
+        if status:
+            self.shared.set(**{self.expected: own + 1})
+        else:
+            self.shared.set(received=expected)
+
+    def echo_received(self, n=1):
+        own, expected, received = self._echoes()
+        self.shared.set(received=min(received + n, expected))
+
+    def echo_cancelled(self, n=1):
+        own, expected, received = self._echoes()
+        self.shared.set(**{self.expected: max(own - n,
+                                              own - (expected - received))})
+
+    def get_lock(self):
+        own, expected, received = self._echoes()
+        return received < expected
+
+
+class SharedMvune(_SharedLevels, mvune.Mvune):
+    """ Mvune controller of the HTTP process
+    """
+
+    expected = "http_expected"
+
+    def __init__(self, shared, *args):
+        mvune.Mvune.__init__(self, *args)
+        self.shared = shared
+
+
+class MvuneProxy(_SharedLevels):
+    """ Mvune interface of the serial process
+
+    Method calls are run by the HTTP process (see serve_calls); the caller
+    waits for the result like for a direct HTTP request.
+    """
+    expected = "serial_expected"
+
+    def __init__(self, channels):
+        self.shared = channels.shared
+        self.calls = channels.calls
+        self.replies = channels.replies
+        self.lock_trace = None
+        self.seq = 0
+
+    def call(self, kind, calls):
+        """ Return the success and the success of each call
+        """
+        self.seq = (self.seq + 1) & 0xFFFFFFFF
+        pad = MAX_CALLS - len(calls)
+        if not self.calls.put(self.seq, kind, len(calls),
+                              *([METHOD_CODES.index(m) for m, v in calls]
+                                + [0] * pad
+                                + [v for m, v in calls] + [0.0] * pad)):
+            logging.error("mvune call queue full")
+            return False, []
+        deadline = time.time() + CALL_TIMEOUT
+        while True:
+            reply = self.replies.get(max(deadline - time.time(), 0))
+            if reply is None:
+                logging.error("No reply from the HTTP process")
+                return False, []
+            if reply[0] == self.seq:  # older replies timed out
+                return bool(reply[1]), [bool(r) for r in
+                                        reply[2:2 + len(calls)]]
+
+    def setExhaustAir(self, value):
+        return self.call(CALL_METHOD, [("setExhaustAir", value)])[0]
+
+    def setSupplyAir(self, value):
+        return self.call(CALL_METHOD, [("setSupplyAir", value)])[0]
+
+    def setLightIntensity(self, value):
+        return self.call(CALL_METHOD, [("setLightIntensity", value)])[0]
+
+    def dispatch(self, calls):
+        if len(calls) > MAX_CALLS:
+            raise ValueError("at most %d calls" % MAX_CALLS)
+        success, results = self.call(CALL_DISPATCH, calls)
+        return success, [(None, m, v, ok)
+                         for (m, v), ok in zip(calls, results)]
+
+
+def _value(v):
+    return int(v) if v == int(v) else v
+
+
+def forward_changes(source, ring):
+    """ Copy the MvuneChange records published on `source` into `ring`,
+    from a daemon thread; records that do not fit are dropped
+    """
+    sub = source.subscribe((bus.MvuneChange,))
+
+    def put(record):
+        ring.put(record.timestamp, record.fan, record.flap, record.window,
+                 1 if record.locked else 0)
+
+    return bus.follow(sub, put, "changes-forward")
+
+
+def publish_changes(ring, target):
+    """ Publish the records of `ring` on `target` from a daemon thread
+    """
+    def run():
+        while True:
+            timestamp, fan, flap, window, locked = ring.get()
+            target.publish(bus.MvuneChange(timestamp, fan, flap, window,
+                                           bool(locked)))
+
+    t = threading.Thread(target=run, name="changes-publish")
+    t.daemon = True
+    t.start()
+    return t
+
+
+def serve_calls(ctr, calls, replies):
+    """ Run the method calls of the serial process on `ctr`
+    """
+    while True:
+        record = calls.get()
+        seq, kind, n = record[:3]
+        methods = [METHOD_CODES[c] for c in record[3:3 + n]]
+        values = [_value(v) for v in record[3 + MAX_CALLS:3 + MAX_CALLS + n]]
+        try:
+            if kind == CALL_METHOD:
+                success = bool(getattr(ctr, methods[0])(values[0]))
+                results = [success]
+            else:
+                success, done = ctr.dispatch(zip(methods, values))
+                results = [all(r[3] for r in done if r[1:3] == (m, v))
+                           for m, v in zip(methods, values)]
+        except Exception, e:
+            logging.exception(e)
+            success, results = False, [False] * n
+        replies.put(seq, success, *(results + [False] * (MAX_CALLS - n)))
+
+
+def exit_with_parent(interval=1.0):
+    """ End this process when the process that forked it has ended
+    """
+    parent = os.getppid()
+
+    def watch():
+        while os.getppid() == parent:
+            time.sleep(interval)
+        os._exit(0)
+
+    t = threading.Thread(target=watch, name="parent-watch")
+    t.daemon = True
+    t.start()
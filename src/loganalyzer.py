@@ -0,0 +1,296 @@
+"""Offline analysis of the telegram traffic in __tiny.log
+
+Streams the log (optionally through mmap, gzip-compressed rotations are
+read transparently) in constant memory and reports:
+
+* telegram counts per direction, kind and command character
+* re-validated CRCs of the logged telegrams, and CRC error bursts
+* write retries and "No response received" rates of write_read_verify
+* gaps between consecutive telegrams received from the dstiny
+* latency from a scene telegram to the mvune acknowledgment and to the
+  next status poll answer
+
+Log timestamps have a resolution of one second, so do gaps and latencies.
+
+Usage: python src/loganalyzer.py [--mmap] [--json] __tiny.log [...]
+"""
+import gzip
+import json
+import mmap
+import sys
+import time
+from optparse import OptionParser
+
+import dstiny
+import metrics
+
+GAP_BUCKETS = (1, 2, 5, 10, 30, 60, 300, 900, 3600)
+LATENCY_BUCKETS = (0, 1, 2, 5, 10, 30)
+CRC_BURST_GAP = 5  # seconds between CRC errors of the same burst
+
+DIRECTIONS = {"<-": "rx", "->": "tx"}
+
+BLOCK_SIZE = 4 << 20
+
+
+class FrameCache:
+    """ Bounded memo of decoded frames
+
+    Telegram traffic is very repetitive, so most frames are decoded once.
+    The cache is dropped when full to keep the memory constant.
+    """
+
+    def __init__(self, size=4096):
+        self.size = size
+        self.crc8_function = dstiny.crc8
+        self.frames = {}
+
+    def decode(self, frame):
+        """ Return whether the frame passes the CRC check
+        """
+        try:
+            return self.frames[frame]
+        except KeyError:
+            pass
+        try:
+            dstiny.decodeTel(frame + '\r\n', self.crc8_function)
+            result = True
+        except dstiny.CRCError:
+            result = False
+        except (ValueError, IndexError):
+            result = True  # not a telegram, e.g. a truncated line
+        if len(self.frames) >= self.size:
+            self.frames.clear()
+        self.frames[frame] = result
+        return result
+
+
+class Analyzer:
+    def __init__(self):
+        self.bytes = 0
+        self.counts = {}  # (arrow, kind, cmdch): n
+        self.writes = 0
+        self.retries = 0
+        self.no_response = 0
+        self.crc_logged = 0  # reported by the bridge
+        self.crc_invalid = 0  # re-validation of the logged frames
+        self.crc_bursts = 0
+        self.crc_max_burst = 0
+        self.gaps = metrics.Histogram("gap", "", GAP_BUCKETS)
+        self.latency = metrics.Histogram("latency", "", LATENCY_BUCKETS,
+                                         label="stage")
+        self.cache = FrameCache()
+
+        self._ts_prefix = None
+        self._ts = 0
+        self._last_write = None
+        self._last_rx = None
+        self._last_crc = None
+        self._burst = 0
+        self._scene_mvune = None
+        self._scene_status = None
+
+    def timestamp(self, prefix):
+        if prefix != self._ts_prefix:
+            try:
+                self._ts = time.mktime(
+                    time.strptime(prefix, '%Y-%m-%d %H:%M:%S'))
+            except ValueError:
+                return None
+            self._ts_prefix = prefix
+        return self._ts
+
+    def feed(self, data):
+        """ Analyze a block of complete log lines
+        """
+        self.bytes += len(data)
+        counts = self.counts
+        decode = self.cache.decode
+        timestamp = self.timestamp
+        for line in data.split('\n'):
+            pos = line.find('[pc ')
+            if pos < 0:
+                # substring tests are much cheaper than a regex per line
+                if 'No response received' in line:
+                    self.no_response += 1
+                    self._last_write = None
+                elif 'CRC error' in line:
+                    self.crc_logged += 1
+                    self.crc_error(timestamp(line[:19]))
+                # "Scene send to mivune ..." or "Group scene send ..."
+                elif self._scene_mvune is not None \
+                        and 'cene send to mivune' in line:
+                    ts = timestamp(line[:19])
+                    if ts is not None:
+                        self.latency.observe(ts - self._scene_mvune,
+                                             "mvune")
+                    self._scene_mvune = None
+                continue
+
+            fields = line[pos:].split('\t')
+            if len(fields) < 3:
+                continue
+            arrow = fields[0][4:6]
+            kind = fields[1]
+            frame = fields[2].rstrip()
+            ts = timestamp(line[:19])
+
+            key = (arrow, kind, frame[:1])
+            counts[key] = counts.get(key, 0) + 1
+            if not decode(frame):
+                self.crc_invalid += 1
+                self.crc_error(ts)
+
+            if arrow == "->":
+                self.writes += 1
+                if frame == self._last_write:
+                    self.retries += 1
+                self._last_write = frame
+                continue
+
+            self._last_write = None
+            if ts is None:
+                continue
+            if kind == "[telegram]":
+                if self._last_rx is not None:
+                    self.gaps.observe(ts - self._last_rx)
+                self._last_rx = ts
+                if key[2] == 'i':
+                    self._scene_mvune = ts
+                    self._scene_status = ts
+            elif key[2] == 'e' and self._scene_status is not None:
+                self.latency.observe(ts - self._scene_status, "status")
+                self._scene_status = None
+
+    def crc_error(self, ts):
+        if ts is None:
+            return
+        if self._last_crc is None or ts - self._last_crc > CRC_BURST_GAP:
+            self.crc_bursts += 1
+            self._burst = 0
+        self._burst += 1
+        self.crc_max_burst = max(self.crc_max_burst, self._burst)
+        self._last_crc = ts
+
+    def report(self, elapsed):
+        def rate(n, d):
+            return float(n) / d if d else 0.0
+
+        return {
+            "megabytes": self.bytes / 1e6,
+            "mb_per_second": rate(self.bytes / 1e6, elapsed),
+            "telegrams": dict(("%s %s %s" % (DIRECTIONS.get(k[0], k[0]),
+                                              k[1].strip('[]'), k[2]),
+                               n) for k, n in self.counts.items()),
+            "writes": self.writes,
+            "retry_rate": rate(self.retries, self.writes),
+            "no_response_rate": rate(self.no_response, self.writes),
+            "crc_errors_logged": self.crc_logged,
+            "crc_invalid_frames": self.crc_invalid,
+            "crc_bursts": self.crc_bursts,
+            "crc_max_burst": self.crc_max_burst,
+            "gaps_seconds": histogram_dict(self.gaps, None),
+            "scene_to_mvune_seconds": histogram_dict(self.latency, "mvune"),
+            "scene_to_status_seconds": histogram_dict(self.latency,
+                                                      "status"),
+        }
+
+
+def histogram_dict(h, value):
+    """ Upper bucket bound (or "+Inf"): count, non-cumulative
+    """
+    s = h.series.get(value)
+    if s is None:
+        return {}
+    bounds = ["%g" % b for b in h.buckets] + ["+Inf"]
+    return dict((b, n) for b, n in zip(bounds, s[0]) if n)
+
+
+def iter_blocks(filename, use_mmap=False):
+    """ Yield blocks of complete lines of a log file
+    """
+    if use_mmap and filename != '-' and not filename.endswith('.gz'):
+        with open(filename, 'rb') as f:
+            try:
+                m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:  # empty file
+                return
+            try:
+                start = 0
+                while start < len(m):
+                    end = m.rfind('\n', start, start + BLOCK_SIZE) + 1
+                    if end <= start:  # no newline in the block
+                        end = min(start + BLOCK_SIZE, len(m))
+                    yield m[start:end]
+                    start = end
+            finally:
+                m.close()
+        return
+
+    if filename == '-':
+        f = sys.stdin
+    elif filename.endswith('.gz'):
+        f = gzip.open(filename)
+    else:
+        f = open(filename, 'rb')
+    try:
+        rest = ''
+        while True:
+            block = f.read(BLOCK_SIZE)
+            if not block:
+                break
+            end = block.rfind('\n') + 1
+            yield rest + block[:end]
+            rest = block[end:]
+        if rest:
+            yield rest + '\n'
+    finally:
+        if f is not sys.stdin:
+            f.close()
+
+
+def format_report(r, out):
+    out.write("%.1f MB (%.1f MB/s)\n" % (r["megabytes"], r["mb_per_second"]))
+    out.write("telegrams:\n")
+    for key, n in sorted(r["telegrams"].items()):
+        out.write("  %-24s %d\n" % (key, n))
+    out.write("writes: %d  retry rate: %.4f  no response rate: %.4f\n"
+              % (r["writes"], r["retry_rate"], r["no_response_rate"]))
+    out.write("CRC errors: %d logged, %d invalid frames, %d bursts "
+              "(longest %d)\n"
+              % (r["crc_errors_logged"], r["crc_invalid_frames"],
+                 r["crc_bursts"], r["crc_max_burst"]))
+    for name in ("gaps_seconds", "scene_to_mvune_seconds",
+                 "scene_to_status_seconds"):
+        buckets = sorted(r[name].items(), key=lambda b: float(b[0]))
+        out.write("%s: %s\n" % (name, "  ".join("<=%s:%d" % b
+                                                 for b in buckets)))
+
+
+def main(argv):
+    parser = OptionParser(usage="%prog [--mmap] [--json] LOG [LOG ...]")
+    parser.add_option("--mmap", dest="mmap", action="store_true",
+                      default=False, help="memory-map the log files")
+    parser.add_option("--json", dest="json", action="store_true",
+                      default=False, help="print the report as JSON")
+    (options, args) = parser.parse_args(argv)
+    if not args:
+        parser.error("no log file given")
+
+    analyzer = Analyzer()
+    start = time.time()
+    for filename in args:
+        for block in iter_blocks(filename, options.mmap):
+            analyzer.feed(block)
+    r = analyzer.report(time.time() - start)
+
+    if options.json:
+        json.dump(r, sys.stdout, indent=2, sort_keys=True,
+                  separators=(',', ': '))
+        sys.stdout.write("\n")
+    else:
+        format_report(r, sys.stdout)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
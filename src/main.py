@@ -5,31 +5,56 @@ and forwarding the incoming messages to the mvune system, and one doing the
 same forwarding in the other direction.
 """
 
+import collections
+import json
 import logging
 from optparse import OptionParser
+import os
 import Queue
-import requests
+import StringIO
 import sys
+import threading
 import time
 from threading import Thread
 
+import asynclog
+import bus
 import dstiny
+from bus import BUS
+from clock import CLOCK
+import ipc
+import metrics
 import mvune
-from serial_port import serial_port
+import profiler
+import state_api
+from startup import STARTUP
+from tracing import TRACER
+from watchdog import WATCHDOG
 
+# sensors with an event waiting for the dstiny thread (see EventQueue);
+# events of further sensors are dropped
+EVENT_QUEUE_SIZE = 256
 
-class Event:
+MIN_POLL_TIME = 0.1  # seconds between the starts of two long-polls
+MAX_POLL_BACKOFF = 32  # seconds
+
+
+class Event(object):
     """ Events exchanged between threads
 
     Define the events to be transmitted by the dstiny. This class is used
     to exchange events between different threads.
     """
+    __slots__ = ('dSidx', 'value', 'type', 'SID', 'timestamp', 'trace')
 
-    def __init__(self, dSidx, value, sid, event_type):
+    def __init__(self, dSidx, value, sid, event_type, trace=None,
+                 timestamp=None):
         self.dSidx = dSidx
         self.value = value
         self.type = event_type  # {"Status","Binary"}
         self.SID = sid
+        self.timestamp = CLOCK.time() if timestamp is None else timestamp
+        self.trace = trace  # correlation id, see tracing.py
 
     def __str__(self):
         return "dSidx:%d\tvalue:(%d,%d) (%04X)\ttype:%s"\
@@ -37,20 +62,164 @@ class Event:
                 self.value & 0xFF, self.value, self.type)
 
 
-def mvune_thread(mvune_ctr, _q):
+class EventQueue(object):
+    """ Events waiting for the dstiny thread, at most one per sensor
+
+    The dstiny thread forwards one event per event_interval. A newer event
+    of the same (dSidx, SID) replaces the waiting one and keeps its place
+    in line: only the latest value waits, and the dSS is not sent a
+    backlog of states that are no longer current.
+    """
+
+    def __init__(self, maxsize=EVENT_QUEUE_SIZE):
+        self.maxsize = maxsize
+        self.pending = collections.OrderedDict()  # (dSidx, SID): event
+        self._lock = threading.Lock()
+
+    def put(self, e):
+        """ Queue `e`, return whether it replaced a waiting event; raise
+        Queue.Full if it did not and the queue is full
+        """
+        key = (e.dSidx, e.SID)
+        with self._lock:
+            replaced = key in self.pending
+            if not replaced and len(self.pending) >= self.maxsize:
+                raise Queue.Full
+            self.pending[key] = e
+        return replaced
+
+    def get(self):
+        """ Remove and return the event waiting the longest; never blocks
+        """
+        with self._lock:
+            if not self.pending:
+                raise Queue.Empty
+            return self.pending.popitem(last=False)[1]
+
+    def oldest(self):
+        """ Timestamp of the oldest waiting value, None if none waits
+        """
+        with self._lock:
+            if not self.pending:
+                return None
+            return min(e.timestamp for e in self.pending.values())
+
+    def qsize(self):
+        return len(self.pending)
+
+    def empty(self):
+        return not self.pending
+
+    def full(self):
+        return len(self.pending) >= self.maxsize
+
+    def task_done(self):
+        pass
+
+
+def post_event(_q, e):
+    """ Hand an event over to the dstiny thread
+    """
+    try:
+        replaced = _q.put(e)
+    except Queue.Full:
+        metrics.QUEUE_EVENTS.inc("dropped")
+    else:
+        metrics.QUEUE_EVENTS.inc("coalesced" if replaced else "enqueued")
+    metrics.QUEUE_DEPTH.set(_q.qsize())
+
+
+def export_traces():
+    buf = StringIO.StringIO()
+    TRACER.export(buf)
+    return buf.getvalue()
+
+
+def mvune_fetch_thread(mvune_ctr, _responses, clock=CLOCK):
+    """ Keep a waitForEvents request in flight
+
+    Each response is handed to the decode stage (mvune_thread) together
+    with its arrival time, and the next long-poll is issued right away,
+    but not sooner than MIN_POLL_TIME after the previous one. After a
+    failed request or an answer that is not an events document (e.g. an
+    error once the controller restarted and dropped the session), the
+    next request waits for a backoff doubling up to MAX_POLL_BACKOFF,
+    then the object model is fetched again for a new session.
+    """
+    # the long-poll has no timeout, report only one hanging for minutes
+    watch = WATCHDOG.loop("mvune-fetch", 300.0, clock)
+    backoff = 0
+    while True:
+        watch.busy()
+        start = clock.time()
+        try:
+            r = mvune_ctr.waitForEvents()
+            if r.status_code == 200 and '"events"' in r.content:
+                error = None
+            else:
+                error = "HTTP %d: %.200s" % (r.status_code, r.content)
+        except Exception, e:
+            error = e
+        watch.idle()
+        if error is None:
+            backoff = 0
+            _responses.put((clock.time(), r.content))
+            elapsed = clock.time() - start
+            if elapsed < MIN_POLL_TIME:
+                clock.sleep(MIN_POLL_TIME - elapsed)
+            continue
+        backoff = min(max(2 * backoff, 1), MAX_POLL_BACKOFF)
+        logging.error("Long polling request failed, retrying in %ds: %s",
+                      backoff, error)
+        clock.sleep(backoff)
+        watch.busy()
+        try:
+            mvune_ctr.get_objectModel()
+            logging.info("mvune session id:\t%s", mvune_ctr.sessionId)
+        except Exception, e:
+            logging.error("Not able to renew the mvune session: %s", e)
+        watch.idle()
+
+
+def mvune_thread(mvune_ctr, _q, clock=CLOCK):
     logging.info("Getting object model and valid services ids")
-    mvune_ctr.get_objectModel()
+    with STARTUP.phase("object_model"):
+        mvune_ctr.get_objectModel()
+    STARTUP.mark("mvune_ready")
 
     logging.info("Starting long polling thread")
-    logging.info("mvune session id:\t"+mvune_ctr.sessionId)
-    r = requests.get(mvune_ctr.longpolling)
+    logging.info("mvune session id:\t%s", mvune_ctr.sessionId)
+    responses = clock.queue()
+    clock.spawn(mvune_fetch_thread, (mvune_ctr, responses, clock),
+                "mvune-fetch")
 
+    watch = WATCHDOG.loop("mvune", 1.0, clock)
     while True:
-        if r.json():
-            json_obj = r.json()
-            success, fan, flap, window = mvune_ctr.decodeEvent(json_obj)
+        watch.idle()
+        received, content = responses.get()
+        watch.busy()
+        try:
+            json_obj = json.loads(content)
+        except ValueError, e:
+            logging.error("Invalid long polling response")
+            logging.error(e)
+            continue
+
+        if json_obj:
+            asynclog.trace_telegram(asynclog.CHANNEL_MVUNE_EVENTS, content)
+            # an event caused by a scene continues the scene's trace
+            trace = mvune_ctr.lock_trace
+            if not mvune_ctr.get_lock() or trace is None:
+                trace = TRACER.new_trace()
+            TRACER.record(trace, "waitForEvents", received)
+            with TRACER.span("decodeEvent", trace):
+                success, fan, flap, window = mvune_ctr.decodeEvent(json_obj)
 
             if success:
+                now = clock.time()
+                BUS.publish(bus.MvuneChange(now, fan, flap, window,
+                                            mvune_ctr.get_lock()))
+
                 # if the controller is locked, it means that the
                 # content of this event is not meant to be transferred
                 # to the dSS. The message is the answer to a control
@@ -62,7 +231,7 @@ def mvune_thread(mvune_ctr, _q):
                     index = dstiny.DS_POLL_STATUS_INFO+1  # different index
 
                     logging.info(
-                        "Received flap value: %d, fan value:%d" % (flap, fan))
+                        "Received flap value: %d, fan value:%d", flap, fan)
                     if fan >= 0:
                         mvune_ctr.set_fan_current_level(fan)
 
@@ -71,9 +240,8 @@ def mvune_thread(mvune_ctr, _q):
 
                     status = (fan << 8) | flap
                     e = Event(dstiny.EXHOOD_FAN_FLAP_dSxid, status, index,
-                              "Status")  # see dstiny.py header
-                    if not _q.full():
-                        _q.put(e)
+                              "Status", trace, now)  # see dstiny.py header
+                    post_event(_q, e)
 
                 else:
                     index = dstiny.DS_POLL_STATUS_INFO
@@ -84,31 +252,29 @@ def mvune_thread(mvune_ctr, _q):
                         if flap < 0:
                             flap = 0
                         logging.info(
-                            "Received flap value: %d, fan value:%d" % (flap, fan))
+                            "Received flap value: %d, fan value:%d", flap, fan)
                         status = (fan << 8) | flap
+                        # see dstiny.py header
                         e = Event(dstiny.EXHOOD_FAN_FLAP_dSxid, status,
-                                  index, "Status")  # see dstiny.py header
-                        if not _q.full():
-                            _q.put(e)
+                                  index, "Status", trace, now)
+                        post_event(_q, e)
 
                 if window >= 0:  # if a change in window-conctact was received
-                    logging.info("Received window value: %d" % window)
+                    logging.info("Received window value: %d", window)
                     value = window & 0xFF
                     e = Event(dstiny.EXHOOD_FLAP_WINDOW_CONTACT_dSxid,
-                              value, index, "Status")
-                    if not _q.full():
-                        _q.put(e)
-
-            # unlock and relaunch controller
-            mvune_ctr.set_lock(False)
-
-            # re-launch long-polling request
-            r = requests.get(mvune_ctr.longpolling)
+                              value, index, "Status", trace, now)
+                    post_event(_q, e)
 
-        time.sleep(0.1)
+            # the fan and flap echoes of a group scene may come in
+            # separate responses, the controller stays locked until all
+            # of them arrived
+            if success:
+                mvune_ctr.echo_received(mvune_ctr.fan_flap_changes)
 
 
-def dstiny_thread(serport, mvune_ctr, logfile, conffile, _q):
+def dstiny_thread(serport, mvune_ctr, logfile, conffile, _q,
+                  event_interval=5, regfile=None, config=None, clock=CLOCK):
     DSMS = 0x07  # register devices 0 and 1, and 2
     heartbeat = 30  # in seconds
 
@@ -119,22 +285,36 @@ def dstiny_thread(serport, mvune_ctr, logfile, conffile, _q):
     DSCMD = 1
 ##############################
 
-    tiny = dstiny.dstiny(serport, mvune_ctr, logfile, conffile,)
+    with STARTUP.phase("driver"):
+        tiny = dstiny.dstiny(serport, mvune_ctr, logfile, conffile, regfile,
+                             config, clock)
     FSM_state = "dSINIT"
+    handshake = clock.time()
 
     logging.info("Starting dStiny thread")
 
     prev_telegram = ""
+    published_state = None
 
+    # a serial read times out after 0.5s, write_read_verify retries do not
+    # fit in the budget
+    watch = WATCHDOG.loop("dstiny", 1.0, clock)
     while True:
+        watch.busy()
+        if FSM_state != published_state:
+            BUS.publish(bus.FsmTransition(clock.time(), published_state,
+                                          FSM_state))
+            published_state = FSM_state
         if FSM_state == "dSINIT":
             s = tiny.read()
             if s:
                 tel = tiny.getTel(s)
                 if tel:
                     if tel.cmdch == 's' and tel.args[0] == 0x00:
-                        # configure heartbeat
-                        ans = tiny.writeByte(0, 0x03, 0x3A, heartbeat)
+                        # configure heartbeat; the configuration
+                        # telegrams never change and are encoded once
+                        ans = tiny.writeByte(0, 0x03, 0x3A, heartbeat,
+                                             const=True)
 
                         # Register dstiny subdevices. The dstiny can
                         # represent several indepedent logical devices
@@ -151,25 +331,30 @@ def dstiny_thread(serport, mvune_ctr, logfile, conffile, _q):
                         # ans=tiny.writeByte(1,0x03,0x01,0x0F) #set LTNUMGRP to 0x15
                         # set LTNUMGRP to 0x15 (1=light, 5=room push button)
                         ans = tiny.writeByte(
-                            dstiny.EXHOOD_LIGHT_dSxid, 0x03, 0x01, 0x15)
+                            dstiny.EXHOOD_LIGHT_dSxid, 0x03, 0x01, 0x15,
+                            const=True)
                         ans = tiny.joinGroup(
                             dstiny.EXHOOD_LIGHT_dSxid, 
                             dstiny.DS_GROUP_LIGHT)  # see dstiny.py
                         # set output to switched
                         ans = tiny.writeByte(
-                            dstiny.EXHOOD_LIGHT_dSxid, 0x03, 0x00, 0x10)
+                            dstiny.EXHOOD_LIGHT_dSxid, 0x03, 0x00, 0x10,
+                            const=True)
 
                         tiny.activateDSCommands(dstiny.EXHOOD_LIGHT_dSxid, 
-                                                DSCMD)
+                                                DSCMD, const=True)
                         tiny.activateDSCommands(dstiny.EXHOOD_FAN_FLAP_dSxid, 
-                                                DSCMD)
-                        ans = tiny.register(DSMS)
+                                                DSCMD, const=True)
+                        ans = tiny.register(DSMS, const=True)
 
                     elif tel.cmdch == 's' and tel.args[0] == 0x20:
                         FSM_state = "dSONLINE"
+                        if "dstiny_online" not in STARTUP.marks:
+                            STARTUP.record("dstiny_handshake", handshake,
+                                           clock.time())
+                            STARTUP.mark("dstiny_online")
 
-                    logging.info(
-                        "[pc <- dstiny]\t[telegram]\t" + tel.get()[:-2])
+                    logging.info("[pc <- dstiny]\t[telegram]\t%s", s[:-2])
 
         elif FSM_state == "RESTART":
             s = tiny.read()
@@ -177,7 +362,7 @@ def dstiny_thread(serport, mvune_ctr, logfile, conffile, _q):
                 tel = tiny.getTel(s)
                 if tel:
                     if tel.cmdch == 's' and tel.args[0] == 0x00:
-                        ans = tiny.register(DSMS)
+                        ans = tiny.register(DSMS, const=True)
                         if not ans:
                             FSM_state = "dSINIT"
                     elif tel.cmdch == 's' and tel.args[0] == 0x20:
@@ -189,13 +374,17 @@ def dstiny_thread(serport, mvune_ctr, logfile, conffile, _q):
             if s:
                 tel = tiny.getTel(s)
                 if tel:
-                    if tel.get()[:-2] != prev_telegram:  # log only updates
-                        logging.info(
-                            "[pc <- dstiny]\t[telegram]\t"+tel.get()[:-2])
-                        prev_telegram = tel.get()[:-2]
+                    if s != prev_telegram:  # log only updates
+                        logging.info("[pc <- dstiny]\t[telegram]\t%s", s[:-2])
+                        prev_telegram = s
                     if tel.cmdch == 's' and tel.args[0] == 0x00:
                         FSM_state = "RESTART"
                         logging.info("Restarting dstiny")
+                    elif tel.cmdch == 'i':  # scene, start a trace
+                        trace = TRACER.new_trace()
+                        TRACER.record(trace, "telegram", tel.timestamp)
+                        with TRACER.span("parse_dSCommand", trace):
+                            tiny.parse_dSCommand(tel)
                     else:
                         tiny.parse_dSCommand(tel)
             else:
@@ -203,20 +392,80 @@ def dstiny_thread(serport, mvune_ctr, logfile, conffile, _q):
                 # process has arrived
                 while not _q.empty():  # check that the queue isn't empty
                     e = _q.get()  # print the item from the queue
-                    logging.info("Tranmitting event:%s" % e)
+                    TRACER.record(e.trace, "queue", e.timestamp, clock.time())
+                    logging.info("Tranmitting event:%s", e)
                     if e.type == "Status":
-                        tiny.writeStatusValue(
-                            e.dSidx, dstiny.DS_STATUS_VALUES_START
-                            + e.SID, e.value)
-                        tiny.genStatusPollEvent(e.dSidx, e.SID)
+                        with TRACER.span("writeStatusValue", e.trace):
+                            tiny.writeStatusValue(
+                                e.dSidx, dstiny.DS_STATUS_VALUES_START
+                                + e.SID, e.value)
+                        with TRACER.span("genStatusPollEvent", e.trace):
+                            # the events only carry the fixed sensor
+                            # ids of mvune_thread
+                            ans = tiny.genStatusPollEvent(e.dSidx, e.SID,
+                                                          const=True)
+                        if ans:
+                            STARTUP.mark("first_event")
+                            metrics.E2E_LATENCY.observe(
+                                clock.time() - e.timestamp, "mvune_to_ds")
                     _q.task_done()  # specify that you are done with the item552
+                    metrics.QUEUE_DEPTH.set(_q.qsize())
                     # restrict the interval between consecutive events
-                    time.sleep(5)
+                    watch.idle()
+                    clock.sleep(event_interval)
+                    watch.busy()
+
+        watch.idle()
+        clock.sleep(0.1)
 
-        time.sleep(0.1)
+
+def http_process(options, channels):
+    """ Multi-process mode: run the mvune side in this (forked) process
+
+    It logs to its own file, next to the log file of the serial process.
+    """
+    ipc.exit_with_parent()
+    asynclog.setup(options.logfile + ".http",
+                   max_bytes=options.log_max_bytes,
+                   backups=options.log_backups)
+    WATCHDOG.start()
+    profiler.install_signals(profiler.Profiler(options.profile_file + ".http"))
+    mvune_ctr = ipc.SharedMvune(channels.shared, options.address,
+                                options.extractor_hood_service,
+                                options.window_contact_service,
+                                options.light_service, options.logfile)
+    if options.api_port:
+        # the state API runs in the serial process
+        ipc.forward_changes(BUS, channels.changes)
+    t = Thread(target=ipc.serve_calls, name="mvune-calls",
+               args=(mvune_ctr, channels.calls, channels.replies))
+    t.daemon = True
+    t.start()
+    t = Thread(target=mvune_thread, name="mvune",
+               args=(mvune_ctr, channels.events))
+    t.start()
+    while t.is_alive():  # signal handlers run in this thread
+        t.join(1.0)
+
+
+def startup_report(out, milestones):
+    """ Print the startup phases once all `milestones` are reached, then
+    the time of the first forwarded event
+    """
+    for name in milestones:
+        STARTUP.wait(name)
+    STARTUP.report(out)
+    if "first_event" not in STARTUP.marks:
+        STARTUP.wait("first_event")
+        out.write("%-20s %8.3fs\n" % ("first_event",
+                                       STARTUP.marks["first_event"]
+                                       - STARTUP.start))
+        out.flush()
 
 
 if __name__ == "__main__":
+    # interpreter start and module imports
+    STARTUP.record("imports", STARTUP.start, time.time())
 
     parser = OptionParser()
     parser.add_option("-c", "--connection", dest="address",
@@ -245,48 +494,168 @@ if __name__ == "__main__":
                       help="scenes configuration file", 
                       default="__scenes.conf")
 
+    parser.add_option("-r", "--register-file", dest="regfile",
+                      help="keep the scene levels in this memory-mapped "
+                      "register file, shared by all bridge processes using "
+                      "it (see regstore.py)", default=None)
+
+    parser.add_option("-i", "--event-interval", dest="event_interval",
+                      type="float", default=5,
+                      help="minimum interval in seconds between events "
+                      "transmitted to the dstiny")
+
+    parser.add_option("--log-max-bytes", dest="log_max_bytes", type="int",
+                      help="rotate the log file at this size",
+                      default=10 * 1024 * 1024)
+
+    parser.add_option("--log-backups", dest="log_backups", type="int",
+                      help="number of rotated log files kept", default=5)
+
+    parser.add_option("-t", "--telegram-trace", dest="telegram_trace",
+                      help="record the serial telegrams and mvune events "
+                      "to this binary trace file (see replay.py)",
+                      default=None)
+
+    parser.add_option("-m", "--metrics-port", dest="metrics_port",
+                      type="int", default=0,
+                      help="serve Prometheus metrics (/metrics) and trace "
+                      "spans (/traces) on this local port (0 disables it)")
+
+    parser.add_option("-a", "--api-port", dest="api_port",
+                      type="int", default=0,
+                      help="serve the bridge state (/state) on this local "
+                      "port (0 disables it)")
+
+    parser.add_option("-M", "--multiprocess", dest="multiprocess",
+                      action="store_true", default=False,
+                      help="run the mvune HTTP side in a separate process, "
+                      "logging to LOGFILE.http (see ipc.py); /metrics and "
+                      "/traces only cover the serial process")
+
+    parser.add_option("--startup-report", dest="startup_report",
+                      action="store_true", default=False,
+                      help="print the duration of the init phases once the "
+                      "bridge is online, then the time of the first "
+                      "forwarded event")
+
+    parser.add_option("--profile-file", dest="profile_file",
+                      default="__profile.folded",
+                      help="collapsed stacks written when the sampling "
+                      "profiler stops; SIGUSR1 toggles it, SIGUSR2 logs the "
+                      "stacks of all threads (see profiler.py)")
+
+    parser.add_option("--control-socket", dest="control_socket",
+                      default=None,
+                      help="unix socket accepting start, stop, dump and "
+                      "status for the profiler")
+
     (options, args) = parser.parse_args()
 
+    channels = None
+    if options.multiprocess:
+        channels = ipc.Channels(Event)
+        if os.fork() == 0:
+            try:
+                http_process(options, channels)
+            finally:
+                os._exit(0)
+
+    # the scene table is read while the serial port opens
+    scenes = {}
+
+    def load_scenes():
+        with STARTUP.phase("scene_table"):
+            try:
+                scenes["config"] = dstiny.read_config(options.conffile)
+            except Exception:
+                pass  # read again, and reported, by the dstiny driver
+
+    loader = Thread(target=load_scenes, name="scene-table")
+    loader.start()
+
     try:
-        p0n = options.serial_port
-        p0 = serial_port(port=p0n, baudrate=19200)
-
-        # set up logging to file - see previous section for more details
-        logging.basicConfig(level=logging.DEBUG,
-                            format='%(asctime)s %(name)-12s %(levelname)-8s\
-                             %(message)s',
-                            datefmt='%Y-%m-%d %H:%M:%S',
-                            filename=options.logfile,
-                            filemode='a')
-        # define a Handler which writes INFO messages or higher
-        # to the sys.stderr
-        console = logging.StreamHandler()
-        console.setLevel(logging.INFO)
-        # set a format which is simpler for console use
-        formatter = logging.Formatter(
-            '%(name)-12s: %(levelname)-8s %(message)s')
-        # tell the handler to use this format
-        console.setFormatter(formatter)
-        # add the handler to the root logger
-        logging.getLogger('').addHandler(console)
+        with STARTUP.phase("serial_open"):
+            from serial_port import serial_port
+            p0n = options.serial_port
+            p0 = serial_port(port=p0n, baudrate=19200)
+            dstiny.crc8('')  # import crcmod before the threads run
+
+        # log to file (DEBUG) and console (INFO) through a background
+        # writer, so that the serial and mvune threads never wait for I/O
+        asynclog.setup(options.logfile,
+                       max_bytes=options.log_max_bytes,
+                       backups=options.log_backups,
+                       telegram_trace=options.telegram_trace)
 
     except Exception, e:
         logging.error(e)
         sys.exit(-1)
 
-    try:
-        mvune_ctr = mvune.Mvune(options.address,
-                                options.extractor_hood_service,
-                                options.window_contact_service,
-                                options.light_service, options.logfile)
+    if options.metrics_port:
+        if channels:
+            logging.warning("The HTTP process of --multiprocess is not "
+                            "covered by /metrics and /traces")
+        try:
+            metrics.start_server(options.metrics_port, routes={
+                "/traces": ("application/x-ndjson", export_traces),
+                "/stalls": ("text/plain", WATCHDOG.export_stalls)})
+            logging.info("Serving metrics on port %d", options.metrics_port)
+        except Exception, e:
+            logging.error("Unable to start metrics server")
+            logging.error(e)
+
+    WATCHDOG.start()
+    sampler = profiler.Profiler(options.profile_file)
+    profiler.install_signals(sampler)
+    if options.control_socket:
+        try:
+            profiler.serve_control(options.control_socket, sampler)
+        except Exception, e:
+            logging.error("Unable to open control socket")
+            logging.error(e)
+
+    if options.api_port:
+        try:
+            state_api.follow_bus()
+            if channels:
+                ipc.publish_changes(channels.changes, BUS)
+            state_api.start_server(options.api_port)
+            logging.info("Serving state API on port %d", options.api_port)
+        except Exception, e:
+            logging.error("Unable to start state API server")
+            logging.error(e)
 
-        q = Queue.Queue()
+    try:
+        if channels:
+            mvune_ctr = ipc.MvuneProxy(channels)
+            q = channels.events
+        else:
+            mvune_ctr = mvune.Mvune(options.address,
+                                    options.extractor_hood_service,
+                                    options.window_contact_service,
+                                    options.light_service, options.logfile)
+            q = EventQueue()
+
+        if options.startup_report:
+            milestones = ["dstiny_online"]
+            if not channels:
+                milestones.append("mvune_ready")
+            t = Thread(target=startup_report, name="startup-report",
+                       args=(sys.stdout, milestones))
+            t.daemon = True
+            t.start()
+
+        loader.join()
         t1 = Thread(target=dstiny_thread, args=(
-            p0, mvune_ctr, options.logfile, options.conffile, q,))
-        t2 = Thread(target=mvune_thread, args=(mvune_ctr, q,))
+            p0, mvune_ctr, options.logfile, options.conffile, q,
+            options.event_interval, options.regfile, scenes.get("config"),))
         t1.start()
-        t2.start()
-        q.join()
+        if not channels:
+            t2 = Thread(target=mvune_thread, args=(mvune_ctr, q,))
+            t2.start()
+        # join with a timeout, so that signal handlers get to run
+        while t1.is_alive():
+            t1.join(1.0)
 
     except Exception, e:
         logging.error("Unable to start thread")
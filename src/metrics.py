@@ -0,0 +1,219 @@
+"""Instrumentation of the bridge hot paths
+
+Counters, gauges and fixed-bucket histograms kept in memory. Recording a
+value is a bisect plus an increment under a lock, so the serial and mvune
+threads can call them on every message. The registry is rendered in the
+Prometheus text format and can be served from a local port.
+"""
+import bisect
+import logging
+import threading
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+
+
+# upper bounds in seconds, +Inf is implicit
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25,
+                   0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+def _labels(label, value):
+    if label is None:
+        return ''
+    return '{%s="%s"}' % (label, value)
+
+
+class Counter:
+    """ Monotonic counter, optionally split by one label
+    """
+
+    def __init__(self, name, doc, label=None):
+        self.name = name
+        self.doc = doc
+        self.label = label
+        self.values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, value=None, amount=1):
+        with self._lock:
+            self.values[value] = self.values.get(value, 0) + amount
+
+    def get(self, value=None):
+        return self.values.get(value, 0)
+
+    def render(self):
+        lines = ["# HELP %s %s" % (self.name, self.doc),
+                 "# TYPE %s counter" % self.name]
+        if self.label is None and not self.values:
+            lines.append("%s 0" % self.name)
+        for key in sorted(self.values.keys()):
+            lines.append("%s%s %d" % (self.name, _labels(self.label, key),
+                                      self.values[key]))
+        return lines
+
+
+class Gauge:
+    """ Last observed value
+    """
+
+    def __init__(self, name, doc):
+        self.name = name
+        self.doc = doc
+        self.value = 0
+
+    def set(self, value):
+        self.value = value
+
+    def get(self):
+        return self.value
+
+    def render(self):
+        return ["# HELP %s %s" % (self.name, self.doc),
+                "# TYPE %s gauge" % self.name,
+                "%s %s" % (self.name, self.value)]
+
+
+class Histogram:
+    """ Fixed-bucket histogram, optionally split by one label
+
+    Buckets are stored non-cumulative and accumulated only when rendered.
+    """
+
+    def __init__(self, name, doc, buckets=LATENCY_BUCKETS, label=None):
+        self.name = name
+        self.doc = doc
+        self.buckets = tuple(buckets)
+        self.label = label
+        self.series = {}  # label value: [counts, sum]
+        self._lock = threading.Lock()
+
+    def observe(self, x, value=None):
+        idx = bisect.bisect_left(self.buckets, x)
+        with self._lock:
+            s = self.series.get(value)
+            if s is None:
+                s = [[0] * (len(self.buckets) + 1), 0.0]
+                self.series[value] = s
+            s[0][idx] += 1
+            s[1] += x
+
+    def count(self, value=None):
+        s = self.series.get(value)
+        if s is None:
+            return 0
+        return sum(s[0])
+
+    def render(self):
+        lines = ["# HELP %s %s" % (self.name, self.doc),
+                 "# TYPE %s histogram" % self.name]
+        for key in sorted(self.series.keys()):
+            with self._lock:
+                counts = list(self.series[key][0])
+                total = self.series[key][1]
+            prefix = '' if self.label is None else \
+                '%s="%s",' % (self.label, key)
+            acc = 0
+            for bound, n in zip(self.buckets, counts):
+                acc += n
+                lines.append('%s_bucket{%sle="%g"} %d'
+                             % (self.name, prefix, bound, acc))
+            acc += counts[-1]
+            lines.append('%s_bucket{%sle="+Inf"} %d' % (self.name, prefix, acc))
+            lines.append("%s_sum%s %f" % (self.name,
+                                          _labels(self.label, key), total))
+            lines.append("%s_count%s %d" % (self.name,
+                                            _labels(self.label, key), acc))
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for m in self.metrics:
+            lines.extend(m.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+# bridge metrics, see dstiny.py, mvune.py, main.py and watchdog.py
+E2E_LATENCY = REGISTRY.register(Histogram(
+    "bridge_e2e_latency_seconds",
+    "End-to-end latency (ds_to_mvune: scene telegram to mvune success, "
+    "mvune_to_ds: mvune event to status poll answer)",
+    label="direction"))
+WRITE_RETRIES = REGISTRY.register(Counter(
+    "dstiny_write_retries_total",
+    "Telegrams re-sent by write_read_verify"))
+WRITE_TIMEOUTS = REGISTRY.register(Counter(
+    "dstiny_write_timeouts_total",
+    "write_read_verify calls without an answer"))
+CRC_ERRORS = REGISTRY.register(Counter(
+    "dstiny_crc_errors_total",
+    "Telegrams received with a wrong CRC"))
+QUEUE_DEPTH = REGISTRY.register(Gauge(
+    "bridge_queue_depth",
+    "Events waiting to be transmitted to the dstiny"))
+QUEUE_EVENTS = REGISTRY.register(Counter(
+    "bridge_queue_events_total",
+    "Events handed from the mvune thread to the dstiny thread",
+    label="result"))
+HTTP_LATENCY = REGISTRY.register(Histogram(
+    "mvune_http_latency_seconds",
+    "Latency of the HTTP calls to the mvune controller",
+    label="method"))
+LOOP_ITERATION = REGISTRY.register(Histogram(
+    "bridge_loop_iteration_seconds",
+    "Busy time per iteration of the worker loops (see watchdog.py)",
+    label="loop"))
+LOOP_STALLS = REGISTRY.register(Counter(
+    "bridge_loop_stalls_total",
+    "Iterations of the worker loops exceeding their budget",
+    label="loop"))
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        route = self.server.routes.get(self.path.split('?')[0])
+        if route is None:
+            self.send_error(404)
+            return
+        content_type, render = route
+        body = render()
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logging.getLogger(__name__).debug(format, *args)
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def start_server(port, address="127.0.0.1", registry=REGISTRY, routes=None):
+    """ Serve the registry on http://address:port/metrics
+
+    `routes` maps further paths to (content type, render function) pairs.
+    The server runs in a daemon thread; the server object is returned so
+    that it can be shut down.
+    """
+    server = ThreadingHTTPServer((address, port), _MetricsHandler)
+    server.routes = {"/metrics": ("text/plain; version=0.0.4",
+                                  registry.render)}
+    if routes:
+        server.routes.update(routes)
+    t = threading.Thread(target=server.serve_forever, name="metrics")
+    t.daemon = True
+    t.start()
+    return server
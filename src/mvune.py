@@ -2,9 +2,30 @@
 
 Author: Diego Sandoval
 Date: 07.06.2017
+
+requests is slow to import and only imported when the first request is
+made, see startup.py.
 """
 import logging
-import requests
+import Queue
+import threading
+
+import asynclog
+import metrics
+from clock import CLOCK
+from startup import STARTUP
+from tracing import TRACER
+
+# method: (registered service name, argument format)
+METHODS = {"setExhaustAir": (u'exhaustAirDeviceService_haube', '%d'),
+           "setSupplyAir": (u'supplyAirDeviceService_haube', '%d'),
+           "setIntensity": (u'lightingDeviceService', '%f'),
+           }
+
+# methods whose change the long-poll echoes as a fan or flap value
+ECHOED_METHODS = ("setExhaustAir", "setSupplyAir")
+
+MAX_CONCURRENCY = 4  # simultaneous requests of a dispatch
 
 
 class Mvune:
@@ -12,11 +33,13 @@ class Mvune:
     Mvune controller
 
     `exhood` and `light` are the names of the extractor hood and light
-    devices, respectively.
+    devices, respectively. `session` replaces the HTTP session of
+    `requests`, e.g. by emulators.StandInSession; it then also issues the
+    long-poll.
     """
 
     def __init__(self, url, exhood_service, window_contact_service,
-                 light_service, logfile):
+                 light_service, logfile, session=None, clock=CLOCK):
 
         self.server = "http://"+url
         self.sessionId = None
@@ -26,9 +49,17 @@ class Mvune:
         self.window_contact_service = window_contact_service
         self.registered_services = {}
         self.logger = logging.getLogger(logfile)
-        self.lock = False
+        # method calls whose echo is awaited, and echoes received
+        self.echoes_expected = 0
+        self.echoes_received = 0
+        self.fan_flap_changes = 0  # of the last decoded response
+        self.lock_trace = None  # correlation id of the locking scene
         self.flap_current_level = 0
         self.fan_current_level = 0
+        self.session = session
+        self.poll_session = session
+        self.clock = clock
+        self._session_lock = threading.Lock()
 
     def set_fan_current_level(self, level):
         self.fan_current_level = level
@@ -43,16 +74,77 @@ class Mvune:
         return self.flap_current_level
 
     def set_lock(self, status):
-        self.lock = status
+        """ True: the value change echoing one more method call is not
+        meant for the dSS. False: no echo is awaited any more.
+        """
+        if status:
+            self.echoes_expected += 1
+            self.lock_trace = TRACER.current()
+        else:
+            self.echoes_received = self.echoes_expected
+            self.lock_trace = None
+
+    def echo_received(self, n=1):
+        """ Count `n` awaited echoes as received
+        """
+        self.echoes_received = min(self.echoes_received + n,
+                                   self.echoes_expected)
+        if not self.get_lock():
+            self.lock_trace = None
+
+    def echo_cancelled(self, n=1):
+        """ Stop awaiting `n` echoes, of calls that failed
+        """
+        self.echoes_expected = max(self.echoes_expected - n,
+                                   self.echoes_received)
+        if not self.get_lock():
+            self.lock_trace = None
 
     def get_lock(self):
-        return self.lock
+        return self.echoes_received < self.echoes_expected
+
+    def get_session(self):
+        """ Return the HTTP session, created on first use
+
+        Its pooled keep-alive connections are shared by concurrent calls.
+        """
+        with self._session_lock:
+            if self.session is None:
+                with STARTUP.phase("http_client"):
+                    import requests
+                    session = requests.Session()
+                    session.mount("http://", requests.adapters.HTTPAdapter(
+                        pool_connections=1, pool_maxsize=MAX_CONCURRENCY))
+                self.session = session
+            return self.session
+
+    def request(self, method, url):
+        """ Issue a GET to the controller, recording its latency under
+        `method`
+        """
+        session = self.session or self.get_session()
+        start = self.clock.time()
+        try:
+            with TRACER.span(method):
+                return session.get(url)
+        finally:
+            metrics.HTTP_LATENCY.observe(self.clock.time() - start, method)
+
+    def waitForEvents(self):
+        """ Issue the long-polling request, on its own connection
+        """
+        if self.poll_session is not None:
+            return self.poll_session.get(self.longpolling)
+        self.get_session()  # imports requests
+        import requests
+        return requests.get(self.longpolling)
 
     def get_objectModel(self):
         """ Get session Id and services
         """
         url = self.server+"/json/?action=getObjectModelAndAjaxSessionId"
-        r = requests.get(url)
+        r = self.request("getObjectModelAndAjaxSessionId", url)
+        asynclog.trace_telegram(asynclog.CHANNEL_MVUNE_MODEL, r.content)
         if r.json():
             json = r.json()
             try:
@@ -97,6 +189,8 @@ class Mvune:
             if self.objectModel and len(self.services_list) > 0:
                 try:
                     self.services = self.objectModel["services"]
+                    # rebuilt on every fetch, services may have gone
+                    registered = {}
                     for s_dict in self.services_list:
                         s = s_dict["serviceIds"]
                         name = s_dict["name"]
@@ -105,12 +199,13 @@ class Mvune:
                             name_service = self.services[ss]["name"]
                             if name == self.exhood_service:
                                 name_service = name_service + "_haube"
-                            self.registered_services[ss] = [name_service]
+                            registered[ss] = [name_service]
+                    self.registered_services = registered
                 except Exception, e:
                     self.logger.error(e)
 
-            self.logger.info("Registered services:" +
-                             str(self.registered_services))
+            self.logger.info("Registered services:%s",
+                             self.registered_services)
 
     def setExhaustAir(self, value):
         """ Sets the exhood fan level
@@ -131,7 +226,7 @@ class Mvune:
                 "/json/?event=objectmodel.MethodCall&arg[]=%s&arg[]=\
                     setExhaustAir&arg[]=%d&ajaxSessionId=%s&action=sendEvent"\
                     % (serviceId, value, self.sessionId)
-            r = requests.get(url)
+            r = self.request("setExhaustAir", url)
             if r.json():
                 return r.json()["success"]
             else:
@@ -159,7 +254,7 @@ class Mvune:
                 "/json/?event=objectmodel.MethodCall&arg[]=%s&arg[]=\
                     setSupplyAir&arg[]=%d&ajaxSessionId=%s&action=sendEvent"\
                          % (serviceId, value, self.sessionId)
-            r = requests.get(url)
+            r = self.request("setSupplyAir", url)
             if r.json():
                 return r.json()["success"]
             else:
@@ -185,7 +280,7 @@ class Mvune:
                 "/json/?event=objectmodel.MethodCall&arg[]=%s&arg[]=\
                     setIntensity&arg[]=%f&ajaxSessionId=%s&action=sendEvent"\
                         % (serviceId, value, self.sessionId)
-            r = requests.get(url)
+            r = self.request("setIntensity", url)
             if r.json():
                 return r.json()["success"]
             else:
@@ -210,7 +305,7 @@ class Mvune:
                 "/json/?event=objectmodel.MethodCall&arg[]=%s&arg[]=\
                     setIntensitySceneValue&arg[]=%f&ajaxSessionId=%s&action=sendEvent"\
                         % (serviceId, value, self.sessionId)
-            r = requests.get(url)
+            r = self.request("setIntensitySceneValue", url)
             if r.json():
                 return r.json()["success"]
             else:
@@ -219,12 +314,85 @@ class Mvune:
             self.logger.error("Request could not be processed")
             self.logger.error(e)
 
+    def serviceIds(self, name):
+        """ Return the ids of all registered services called `name`, e.g.
+        the fans of several hoods
+        """
+        return sorted(sid for sid, names in self.registered_services.items()
+                      if name in names)
+
+    def methodCall(self, serviceId, method, value):
+        """ Call `method` (see METHODS) of a service, return the success
+        """
+        url = self.server + \
+            ("/json/?event=objectmodel.MethodCall&arg[]=%s&arg[]=%s&arg[]="
+             + METHODS[method][1] + "&ajaxSessionId=%s&action=sendEvent") \
+            % (serviceId, method, value, self.sessionId)
+        try:
+            r = self.request(method, url)
+            ans = r.json()
+            return bool(ans and ans["success"])
+        except Exception, e:
+            self.logger.error("Request could not be processed")
+            self.logger.error(e)
+            return False
+
+    def dispatch(self, calls, max_concurrency=MAX_CONCURRENCY):
+        """ Issue method calls concurrently
+
+        `calls` is a list of (method, value) pairs; each one is sent to all
+        services the method applies to, at most `max_concurrency` requests
+        at a time. Return whether all of them succeeded, and the list of
+        (serviceId, method, value, success).
+
+        The echo of each fan and flap call is awaited (see set_lock) from
+        before the first request, since the long-poll in flight may return
+        it before the call does; the echoes of failed calls are not.
+        """
+        jobs = [(sid, method, value) for method, value in calls
+                for sid in self.serviceIds(METHODS[method][0])]
+        echoed = [job for job in jobs if job[1] in ECHOED_METHODS]
+        for _ in echoed:
+            self.set_lock(True)
+        results = [None] * len(jobs)
+        pending = Queue.Queue()
+        for i in range(len(jobs)):
+            pending.put(i)
+        trace = TRACER.current()
+
+        def worker():
+            while True:
+                try:
+                    i = pending.get_nowait()
+                except Queue.Empty:
+                    return
+                sid, method, value = jobs[i]
+                with TRACER.span("dispatch", trace, service=sid):
+                    results[i] = (sid, method, value,
+                                  self.methodCall(sid, method, value))
+
+        # the calling thread is one of the workers
+        workers = [self.clock.spawn(worker, name="mvune-dispatch")
+                   for _ in range(min(max_concurrency, len(jobs)) - 1)]
+        worker()
+        for w in workers:
+            w.join()
+        success = bool(results) and all(r[3] for r in results)
+        if not success:
+            self.logger.warning("Dispatch failed: %s", results)
+            failed = len([r for r in results
+                          if r[1] in ECHOED_METHODS and not r[3]])
+            if failed:
+                self.echo_cancelled(failed)
+        return success, results
+
     def decodeEvent(self, json_obj):
         """ Decodes incoming events
 
         Evaluates events coming from the mvune system (long polling).
         This function returns the overall status, and values for the
-        fan, flap, and window-contact
+        fan, flap, and window-contact. The number of fan and flap values
+        in the response, one per service, is kept in fan_flap_changes.
         """
 
         # hardcoded actions list
@@ -236,6 +404,7 @@ class Mvune:
         fan_value = INVALID_VALUE
         flap_value = INVALID_VALUE
         window_value = INVALID_VALUE
+        self.fan_flap_changes = 0
 
         try:
             events = json_obj["events"]  # list of events
@@ -247,12 +416,14 @@ class Mvune:
                         key = service  # self.registered_services[service]
                         if key in changedObjects:
                             self.logger.info(
-                                "Received field from %s service" % service)
+                                "Received field from %s service", service)
                             msg = changedObjects[key]
                             if FAN in msg.keys():
                                 fan_value = msg[FAN]
+                                self.fan_flap_changes += 1
                             if FLAP in msg.keys():
                                 flap_value = msg[FLAP]
+                                self.fan_flap_changes += 1
                             if WINDOW in msg.keys():
                                 window_value = msg[WINDOW]
 
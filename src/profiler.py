@@ -0,0 +1,165 @@
+"""Sampling profiler and stack dump of the running bridge
+
+While enabled, a background thread samples the stacks of all the other
+threads (sys._current_frames) every `interval` seconds and counts identical
+stacks. Stopping it writes them as collapsed stacks, one
+"thread;outermost;...;innermost count" line per stack, the input format of
+flamegraph.pl and speedscope.
+
+The bridge toggles the profiler on SIGUSR1 and logs a dump of all thread
+stacks on SIGUSR2. The same is available on a local control socket:
+
+    echo start | socat - UNIX-CONNECT:/tmp/bridge.sock
+    echo stop | socat - UNIX-CONNECT:/tmp/bridge.sock     (writes the file)
+    echo dump | socat - UNIX-CONNECT:/tmp/bridge.sock
+"""
+import logging
+import os
+import signal
+import socket
+import sys
+import threading
+import time
+import traceback
+
+
+def frame_name(frame):
+    code = frame.f_code
+    return "%s (%s:%d)" % (code.co_name, os.path.basename(code.co_filename),
+                           code.co_firstlineno)
+
+
+def dump_stacks():
+    """ Return the current stack of every thread as text
+    """
+    names = dict((t.ident, t.name) for t in threading.enumerate())
+    lines = []
+    for ident, frame in sorted(sys._current_frames().items()):
+        lines.append("Thread %s (%d):\n" % (names.get(ident, "?"), ident))
+        lines.extend(traceback.format_stack(frame))
+    return "".join(lines)
+
+
+class Profiler:
+    def __init__(self, filename, interval=0.01):
+        self.filename = filename
+        self.interval = interval
+        self.counts = {}  # collapsed stack: samples
+        self.samples = 0
+        self.started = None
+        self._stop = None
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def running(self):
+        return self._thread is not None
+
+    def start(self):
+        with self._lock:
+            if self._thread is not None:
+                return
+            self.counts = {}
+            self.samples = 0
+            self.started = time.time()
+            self._stop = threading.Event()
+            self._thread = threading.Thread(target=self._run,
+                                            name="profiler")
+            self._thread.daemon = True
+            self._thread.start()
+        logging.info("Profiler started, sampling every %gs", self.interval)
+
+    def stop(self):
+        """ Stop sampling and write the collapsed stacks to `filename`
+        """
+        with self._lock:
+            if self._thread is None:
+                return
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+        with open(self.filename, 'w') as f:
+            self.write(f)
+        logging.info("Profiler stopped: %d samples in %.1fs written to %s",
+                     self.samples, time.time() - self.started, self.filename)
+
+    def toggle(self):
+        if self.running():
+            self.stop()
+        else:
+            self.start()
+
+    def sample(self):
+        names = dict((t.ident, t.name) for t in threading.enumerate())
+        me = threading.current_thread().ident
+        for ident, frame in sys._current_frames().items():
+            if ident == me:
+                continue
+            stack = []
+            while frame is not None:
+                stack.append(frame_name(frame))
+                frame = frame.f_back
+            stack.append(names.get(ident, "thread-%d" % ident))
+            key = ";".join(reversed(stack))
+            self.counts[key] = self.counts.get(key, 0) + 1
+        self.samples += 1
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.sample()
+
+    def write(self, fp):
+        for key, n in sorted(self.counts.items()):
+            fp.write("%s %d\n" % (key, n))
+
+
+def install_signals(profiler):
+    """ SIGUSR1 toggles the profiler, SIGUSR2 logs the thread stacks
+
+    Handlers run in the main thread, which must not block without a
+    timeout.
+    """
+    signal.signal(signal.SIGUSR1, lambda signum, frame: profiler.toggle())
+    signal.signal(signal.SIGUSR2, lambda signum, frame: logging.warning(
+        "Thread stacks:\n%s", dump_stacks()))
+
+
+def serve_control(path, profiler):
+    """ Accept the commands start, stop, dump and status on the unix
+    socket `path`, one per connection
+    """
+    if os.path.exists(path):
+        os.unlink(path)
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(path)
+    os.chmod(path, 0o600)
+    server.listen(1)
+
+    def run():
+        while True:
+            conn, _ = server.accept()
+            try:
+                command = conn.makefile().readline().strip()
+                if command == "start":
+                    profiler.start()
+                    reply = "started\n"
+                elif command == "stop":
+                    profiler.stop()
+                    reply = "written to %s\n" % profiler.filename
+                elif command == "dump":
+                    reply = dump_stacks()
+                elif command == "status":
+                    reply = "%s, %d samples\n" % (
+                        "running" if profiler.running() else "stopped",
+                        profiler.samples)
+                else:
+                    reply = "unknown command %r\n" % command
+                conn.sendall(reply)
+            except Exception, e:
+                logging.error("Control socket: %s", e)
+            finally:
+                conn.close()
+
+    t = threading.Thread(target=run, name="control")
+    t.daemon = True
+    t.start()
+    return server
@@ -0,0 +1,152 @@
+"""Memory-mapped scene register file shared between processes
+
+Holds the pass-through registers of bank 0x7F (0x00-0xFF, see
+dstiny.parse_dSCommand) in a fixed-layout file that every bridge process
+and tool maps into memory. A write is visible to all of them immediately,
+without re-reading `__scenes.conf`.
+
+Layout (little endian):
+
+    offset 0   4s  magic "DSRS"
+    offset 4   H   layout version
+    offset 6   H   number of registers (256)
+    offset 8   I   sequence counter, odd while a write is in progress
+    offset 12  4x  reserved
+    offset 16  256 * H  registers, UNSET if never written
+
+Readers do not lock: they retry while the sequence counter is odd or
+changes under them. Writers serialize on an flock of the file. A counter
+left odd by a writer that died mid-write is made even again by the next
+writer, or by the next process opening the file; the registers keep
+what that write got to store.
+
+Usage: python src/regstore.py FILE [REGISTER [VALUE]]
+"""
+import fcntl
+import mmap
+import os
+import struct
+import sys
+import time
+
+MAGIC = "DSRS"
+LAYOUT_VERSION = 1
+NREGS = 256
+UNSET = 0xFFFF
+
+HEADER = struct.Struct("<4sHHI4x")
+SEQ_OFFSET = 8
+SEQ = struct.Struct("<I")
+REG = struct.Struct("<H")
+REGS_OFFSET = HEADER.size
+SIZE = REGS_OFFSET + NREGS * REG.size
+
+
+class RegisterStore:
+    def __init__(self, filename):
+        self.filename = filename
+        self.fd = os.open(filename, os.O_RDWR | os.O_CREAT, 0o644)
+        fcntl.flock(self.fd, fcntl.LOCK_EX)
+        self.map = None
+        try:
+            size = os.fstat(self.fd).st_size
+            if size == 0:
+                os.write(self.fd, HEADER.pack(MAGIC, LAYOUT_VERSION, NREGS, 0)
+                         + REG.pack(UNSET) * NREGS)
+                size = SIZE
+            if size >= SIZE:
+                self.map = mmap.mmap(self.fd, SIZE)
+                if self.valid() and self.sequence() & 1:
+                    SEQ.pack_into(self.map, SEQ_OFFSET,
+                                  (self.sequence() + 1) & 0xFFFFFFFF)
+        finally:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+
+        if self.map is None or not self.valid():
+            self.close()
+            raise ValueError("%s is not a register file of layout %d"
+                             % (filename, LAYOUT_VERSION))
+
+    def valid(self):
+        """ Whether the header matches this layout
+        """
+        return HEADER.unpack_from(self.map, 0)[:3] == (MAGIC, LAYOUT_VERSION,
+                                                      NREGS)
+
+    def sequence(self):
+        """ Counter incremented twice by every write
+        """
+        return SEQ.unpack_from(self.map, SEQ_OFFSET)[0]
+
+    def get(self, reg):
+        """ Return the value of register `reg`, or -1 if it is unset
+        """
+        offset = REGS_OFFSET + reg * REG.size
+        while True:
+            seq = self.sequence()
+            if not seq & 1:
+                value = REG.unpack_from(self.map, offset)[0]
+                if self.sequence() == seq:
+                    return -1 if value == UNSET else value
+            time.sleep(0)
+
+    def set(self, reg, value):
+        self.update({reg: value})
+
+    def update(self, values):
+        """ Write several registers as one change
+        """
+        fcntl.flock(self.fd, fcntl.LOCK_EX)
+        try:
+            # odd, even if an interrupted write left the counter odd
+            busy = self.sequence() | 1
+            SEQ.pack_into(self.map, SEQ_OFFSET, busy)
+            for reg, value in values.items():
+                REG.pack_into(self.map, REGS_OFFSET + reg * REG.size,
+                              UNSET if value < 0 else value)
+            SEQ.pack_into(self.map, SEQ_OFFSET, (busy + 1) & 0xFFFFFFFF)
+        finally:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+
+    def snapshot(self):
+        """ Return a consistent list of all registers (-1 if unset)
+        """
+        while True:
+            seq = self.sequence()
+            if not seq & 1:
+                values = struct.unpack_from("<%dH" % NREGS, self.map,
+                                            REGS_OFFSET)
+                if self.sequence() == seq:
+                    return [-1 if v == UNSET else v for v in values]
+            time.sleep(0)
+
+    def flush(self):
+        self.map.flush()
+
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+        os.close(self.fd)
+
+
+def main(argv):
+    if not 1 <= len(argv) <= 3:
+        sys.stderr.write(__doc__.split("Usage: ")[1])
+        sys.exit(2)
+    store = RegisterStore(argv[0])
+    try:
+        if len(argv) == 3:
+            store.set(int(argv[1], 0), int(argv[2], 0))
+        elif len(argv) == 2:
+            sys.stdout.write("%d\n" % store.get(int(argv[1], 0)))
+        else:
+            for reg, value in enumerate(store.snapshot()):
+                if value >= 0:
+                    sys.stdout.write("0x%02X %d\n" % (reg, value))
+    finally:
+        store.close()
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
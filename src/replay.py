@@ -0,0 +1,181 @@
+"""Record and replay of the bridge traffic
+
+Recording is done by the bridge itself: `main.py --telegram-trace FILE`
+writes every serial telegram and mvune payload to a binary trace (see
+asynclog.py). Traces can also be reconstructed from the telegrams logged in
+existing `__tiny.log` files, with a resolution of one second.
+
+Replaying feeds the frames sent by the dStiny and the mvune long-poll
+payloads of a trace into a bridge running against the emulators, at the
+recorded pace, N times faster or as fast as possible. Answers of the
+dStiny ('c', 'e', 'q') are not replayed: the emulator generates them.
+
+Usage:
+    python src/replay.py import __tiny.log traffic.trace
+    python src/replay.py replay traffic.trace [--speed N | --max]
+"""
+import json
+import sys
+import threading
+import time
+from optparse import OptionParser
+
+import asynclog
+import emulators
+
+# telegrams the dStiny sends on its own
+UNSOLICITED = ('i', 'p', 's')
+
+LOG_DIRECTIONS = {"[pc <- dstiny]": asynclog.CHANNEL_DSTINY_RX,
+                  "[pc -> dstiny]": asynclog.CHANNEL_DSTINY_TX}
+
+
+def import_log(lines):
+    """ Yield (timestamp, channel, frame) records for the telegrams logged
+    in `lines`
+
+    The log timestamps are local time with a resolution of one second.
+    """
+    for line in lines:
+        for marker, channel in LOG_DIRECTIONS.items():
+            pos = line.find(marker)
+            if pos >= 0:
+                break
+        else:
+            continue
+        try:
+            ts = time.mktime(time.strptime(line[:19], '%Y-%m-%d %H:%M:%S'))
+        except ValueError:
+            continue
+        frame = line[pos:].rstrip('\r\n').split('\t')[-1].strip()
+        if frame:
+            yield ts, channel, frame + '\r\n'
+
+
+def object_model(records):
+    """ Return the first recorded object model of the controller, or None
+    """
+    for ts, channel, data in records:
+        if channel == asynclog.CHANNEL_MVUNE_MODEL:
+            try:
+                return json.loads(data)
+            except ValueError:
+                return None
+    return None
+
+
+class Replayer:
+    """ Feed recorded traffic into the emulators
+
+    `speed` scales the recorded pace (1 = real time); 0 replays as fast as
+    possible.
+    """
+
+    def __init__(self, tiny, mvune, speed=1.0):
+        self.tiny = tiny
+        self.mvune = mvune
+        self.speed = speed
+        self.frames = 0
+        self.payloads = 0
+        self.expected = 0  # telegrams the bridge sent in the recording
+        self.stopped = threading.Event()
+
+    def run(self, records):
+        start = time.time()
+        first = None
+        for ts, channel, data in records:
+            if self.stopped.is_set():
+                break
+            if first is None:
+                first = ts
+            if self.speed:
+                delay = (ts - first) / self.speed - (time.time() - start)
+                if delay > 0:
+                    time.sleep(delay)
+
+            if channel == asynclog.CHANNEL_DSTINY_RX:
+                if data[:1] in UNSOLICITED:
+                    self.tiny.write(data)
+                    self.frames += 1
+            elif channel == asynclog.CHANNEL_DSTINY_TX:
+                self.expected += 1
+            elif channel == asynclog.CHANNEL_MVUNE_EVENTS:
+                try:
+                    events = json.loads(data).get("events", [])
+                except ValueError:
+                    continue
+                self.mvune.pushEvents(events)
+                self.payloads += 1
+        return time.time() - start
+
+
+def read_records(filename):
+    with open(filename, 'rb') as fp:
+        for record in asynclog.read_trace(fp):
+            yield record
+
+
+def cmd_import(args):
+    logfile, tracefile = args
+    n = 0
+    with open(logfile) as lines, open(tracefile, 'wb') as out:
+        out.write(asynclog.TRACE_MAGIC)
+        for record in import_log(lines):
+            asynclog.write_record(out, *record)
+            n += 1
+    sys.stdout.write("%d telegrams written to %s\n" % (n, tracefile))
+
+
+def cmd_replay(args, options):
+    model = object_model(read_records(args[0]))
+    bridge = emulators.BridgeProcess(model=model)
+    received = [0]
+    calls = [0]
+
+    def on_telegram(timestamp, Tel):
+        received[0] += 1
+
+    def on_call(timestamp, method, value):
+        calls[0] += 1
+
+    try:
+        bridge.wait_online()
+        bridge.tiny.listeners.append(on_telegram)
+        bridge.mvune.listeners.append(on_call)
+        replayer = Replayer(bridge.tiny, bridge.mvune,
+                            0 if options.max else options.speed)
+        elapsed = replayer.run(read_records(args[0]))
+        time.sleep(options.drain)
+        sys.stdout.write(
+            "replayed %d frames and %d mvune payloads in %.2fs "
+            "(%.1f frames/s)\n"
+            "bridge sent %d telegrams (%d in the recording) and %d mvune "
+            "calls\n"
+            % (replayer.frames, replayer.payloads, elapsed,
+               replayer.frames / max(elapsed, 1e-9), received[0],
+               replayer.expected, calls[0]))
+    finally:
+        bridge.close()
+
+
+def main(argv):
+    parser = OptionParser(usage=__doc__.split("Usage:")[1].rstrip())
+    parser.add_option("-x", "--speed", dest="speed", type="float",
+                      default=1.0, help="replay N times faster")
+    parser.add_option("--max", dest="max", action="store_true",
+                      default=False, help="replay as fast as possible")
+    parser.add_option("-d", "--drain", dest="drain", type="float",
+                      default=2.0,
+                      help="seconds to wait for the bridge after the replay")
+    (options, args) = parser.parse_args(argv)
+
+    if len(args) == 3 and args[0] == "import":
+        cmd_import(args[1:])
+    elif len(args) == 2 and args[0] == "replay":
+        cmd_replay(args[1:], options)
+    else:
+        parser.error("unknown command")
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,327 @@
+"""Virtual-time simulation of the bridge
+
+Runs the dStiny and mvune loops of main.py in this process against the
+dStiny emulator and the mvune stand-in of emulators.py, all on a
+VirtualClock (see clock.py). The serial line and the HTTP session are
+replaced by in-memory ones with fixed latencies, and every sleep, serial
+timeout and long-poll takes simulated time only: hours of traffic run in
+seconds, and the latencies are the same on every run.
+
+Like benchmarks/e2e.py it measures
+* ds_to_mvune: scene telegram sent by the dStiny -> method call received
+  by the mvune controller
+* mvune_to_ds: value change emitted by the mvune controller -> status
+  poll ('g' telegram) received by the dStiny
+* serial: pass-through read sent by the dStiny -> reply ('q' telegram)
+
+in simulated time, with the pacing of the bridge (-i) in effect.
+
+Usage: python src/simulator.py [-n EVENTS] [-i SECONDS] [-s SECONDS]
+"""
+import collections
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import time
+from optparse import OptionParser
+
+import dstiny
+import emulators
+import main as bridge
+import mvune
+from clock import VirtualClock
+from tracing import TRACER
+
+LOGGER = "simulator"
+
+
+class SimSerial:
+    """ serial_port of the bridge wired to a SimDstiny
+
+    Like the receive buffer of a tty, at most `buffer` bytes wait to be
+    read; telegrams arriving beyond are lost and counted in `overruns`.
+    """
+
+    def __init__(self, clock, tiny, timeout=0.5, buffer=4096):
+        self.ser = self  # the serial.Serial interface used by dstiny
+        self.clock = clock
+        self.tiny = tiny
+        self.timeout = timeout
+        self.buffer = buffer
+        self.buffered = 0
+        self.overruns = 0
+        self.rx = collections.deque()  # (arrival time, line)
+        self._buf = ''
+
+    def open(self):
+        pass
+
+    def close(self):
+        pass
+
+    def write(self, s):
+        self._buf += s
+        while '\n' in self._buf:
+            line, self._buf = self._buf.split('\n', 1)
+            try:
+                Tel = dstiny.decodeTel(line + '\n', dstiny.crc8)
+            except ValueError:
+                continue
+            if Tel:
+                self.tiny.handle(Tel)
+
+    def receive(self, arrival, line):
+        if self.buffered + len(line) > self.buffer:
+            self.overruns += 1
+            return
+        self.buffered += len(line)
+        self.rx.append((arrival, line))
+
+    def _arrived(self):
+        return self.rx and self.rx[0][0] <= self.clock.time()
+
+    def readline(self):
+        deadline = self.clock.time() + self.timeout
+        while True:
+            now = self.clock.time()
+            if self._arrived():
+                line = self.rx.popleft()[1]
+                self.buffered -= len(line)
+                return line
+            if now >= deadline:
+                return ''
+            wake = deadline
+            if self.rx:
+                wake = min(wake, self.rx[0][0])
+            # a telegram sent meanwhile may arrive before `wake`
+            pending = len(self.rx)
+            self.clock.wait_until(
+                None, lambda: self._arrived() or len(self.rx) != pending,
+                wake - now)
+
+
+class SimDstiny(emulators.DstinyProtocol):
+    """ Emulated dStiny whose telegrams reach the bridge after `latency`
+    seconds
+    """
+
+    def __init__(self, clock, latency):
+        emulators.DstinyProtocol.__init__(self, clock)
+        self.latency = latency
+        self.serial = SimSerial(clock, self)
+
+    def write(self, line):
+        self.serial.receive(self.clock.time() + self.latency, line)
+
+
+class Simulation:
+    """ Bridge, dStiny and mvune controller on one VirtualClock
+
+    `serial_latency` is the time a telegram of the dStiny takes to reach
+    the bridge, `http_latency` the round trip of a request to the mvune
+    controller.
+    """
+
+    def __init__(self, event_interval=5, serial_latency=0.008,
+                 http_latency=0.02, poll_timeout=30.0):
+        self.clock = VirtualClock()
+        self.tiny = SimDstiny(self.clock, serial_latency)
+        self.mvune = emulators.MvuneStandIn(port=None,
+                                            poll_timeout=poll_timeout,
+                                            clock=self.clock)
+        services = emulators.STANDIN_SERVICES
+        self.ctr = mvune.Mvune(
+            "mvune-standin", services["S1"][1], services["S4"][1],
+            services["S3"][1], LOGGER,
+            session=emulators.StandInSession(self.mvune, http_latency),
+            clock=self.clock)
+        self.event_interval = event_interval
+        self._tracer_clock = None
+        self.tmp = tempfile.mkdtemp(prefix='ds-mvune-sim-')
+        self.conffile = os.path.join(self.tmp, 'scenes.conf')
+        shutil.copy(os.path.join(emulators.ROOT, '__scenes.conf'),
+                    self.conffile)
+
+    def start(self):
+        # the spans of the bridge are timed in simulated time until close
+        self._tracer_clock = TRACER.clock
+        TRACER.clock = self.clock
+        self.queue = bridge.EventQueue()
+        self.clock.spawn(bridge.dstiny_thread, (
+            self.tiny.serial, self.ctr, LOGGER, self.conffile, self.queue,
+            self.event_interval, None, None, self.clock), "dstiny")
+        self.clock.spawn(bridge.mvune_thread, (self.ctr, self.queue,
+                                               self.clock), "mvune")
+        self.tiny.boot()
+
+    def run(self, target, args=(), step=60.0):
+        """ Run target(*args) as a simulated thread to its end, return its
+        result
+        """
+        result = []
+        task = self.clock.spawn(lambda: result.append(target(*args)),
+                                name="traffic")
+        while not task.done:
+            self.clock.run(self.clock.time() + step)
+        return result[0] if result else None
+
+    def wait_online(self, timeout=60.0):
+        clock = self.clock
+        if not clock.wait_until(None, lambda: self.tiny.state == "ONLINE",
+                                timeout):
+            raise RuntimeError("bridge did not configure the dstiny")
+        clock.sleep(0.5)  # let the FSM reach dSONLINE
+
+    def direction(self, n, trigger, timeout, settle):
+        """ Like e2e.run_direction, in simulated time
+        """
+        latencies = []
+        lost = 0
+        for k in range(n):
+            done = {}
+            start = self.clock.time()
+            trigger(k, done)
+            if self.clock.wait_until(None, lambda: done, timeout):
+                latencies.append(done["time"] - start)
+            else:
+                lost += 1
+            self.clock.sleep(settle)
+        return latencies, lost
+
+    def _answer(self, pending, key):
+        def answered(timestamp):
+            done = pending.pop(key, None)
+            if done is not None:
+                done["time"] = timestamp
+        return answered
+
+    def ds_to_mvune(self, n, timeout, settle):
+        pending = {}
+        answered = self._answer(pending, "call")
+
+        def on_call(timestamp, method, value):
+            if method == 'setExhaustAir':
+                answered(timestamp)
+
+        def trigger(k, done):
+            pending["call"] = done
+            # alternate scenes, the bridge skips calls that change nothing
+            self.tiny.scene(dstiny.EXHOOD_FAN_FLAP_dSxid, 1 + k % 2)
+
+        self.mvune.listeners.append(on_call)
+        try:
+            return self.direction(n, trigger, timeout, settle)
+        finally:
+            self.mvune.listeners.remove(on_call)
+
+    def mvune_to_ds(self, n, timeout, settle):
+        pending = {}
+        answered = self._answer(pending, "poll")
+
+        def on_telegram(timestamp, Tel):
+            if Tel.cmdch == 'g':
+                answered(timestamp)
+
+        def trigger(k, done):
+            pending["poll"] = done
+            sid, field = emulators.STANDIN_METHODS['setExhaustAir']
+            self.mvune.push(sid, field, 30 + k % 2 * 10)
+
+        self.tiny.listeners.append(on_telegram)
+        try:
+            return self.direction(n, trigger, timeout, settle)
+        finally:
+            self.tiny.listeners.remove(on_telegram)
+
+    def serial(self, n, timeout, settle):
+        pending = {}
+        answered = self._answer(pending, "reply")
+
+        def on_telegram(timestamp, Tel):
+            if Tel.cmdch == 'q':
+                answered(timestamp)
+
+        def trigger(k, done):
+            pending["reply"] = done
+            self.tiny.passThrough(dstiny.EXHOOD_FAN_FLAP_dSxid, 0x03,
+                                  dstiny.fan_scenes_regs[k % 10])
+
+        self.tiny.listeners.append(on_telegram)
+        try:
+            return self.direction(n, trigger, timeout, settle)
+        finally:
+            self.tiny.listeners.remove(on_telegram)
+
+    def traffic(self, n, timeout=30.0, settle=1.0):
+        """ Return [(direction, latencies, lost)] of n events per direction
+        """
+        self.wait_online()
+        results = []
+        for name, run in (("ds_to_mvune", self.ds_to_mvune),
+                          ("mvune_to_ds", self.mvune_to_ds),
+                          ("serial", self.serial)):
+            latencies, lost = run(n, timeout, settle)
+            results.append((name, latencies, lost))
+            # let the echoes of this phase drain
+            self.clock.sleep(self.event_interval + 1.0)
+        return results
+
+    def close(self):
+        if self._tracer_clock is not None:
+            TRACER.clock = self._tracer_clock
+        shutil.rmtree(self.tmp, ignore_errors=True)
+
+
+def percentile(values, p):
+    if not values:
+        return float('nan')
+    values = sorted(values)
+    return values[int(round(p * (len(values) - 1)))]
+
+
+def main(argv):
+    parser = OptionParser(usage="%prog [-n EVENTS] [-i SECONDS] "
+                          "[-s SECONDS]")
+    parser.add_option("-n", "--events", dest="events", type="int",
+                      default=1000, help="events per direction")
+    parser.add_option("-i", "--event-interval", dest="event_interval",
+                      type="float", default=5,
+                      help="pacing of the bridge between status pushes")
+    parser.add_option("-s", "--settle", dest="settle", type="float",
+                      default=1.0, help="simulated pause after each answer")
+    parser.add_option("--serial-latency", dest="serial_latency",
+                      type="float", default=0.008,
+                      help="time for a dStiny telegram to reach the bridge")
+    parser.add_option("--http-latency", dest="http_latency", type="float",
+                      default=0.02, help="round trip of a mvune request")
+    (options, args) = parser.parse_args(argv)
+
+    logging.getLogger().addHandler(logging.NullHandler())
+    logging.getLogger().setLevel(logging.WARNING)
+
+    sim = Simulation(options.event_interval, options.serial_latency,
+                     options.http_latency)
+    try:
+        start = time.time()
+        sim.start()
+        results = sim.run(sim.traffic, (options.events, 30.0,
+                                        options.settle))
+        elapsed = time.time() - start
+    finally:
+        sim.close()
+    for name, latencies, lost in results:
+        sys.stdout.write("%-12s n=%d lost=%d p50=%.2fms p99=%.2fms "
+                         "max=%.2fms\n"
+                         % (name, len(latencies), lost,
+                            percentile(latencies, 0.5) * 1000,
+                            percentile(latencies, 0.99) * 1000,
+                            max(latencies or [float('nan')]) * 1000))
+    sys.stdout.write("simulated %.0fs in %.1fs (x%.0f)\n"
+                     % (sim.clock.time(), elapsed,
+                        sim.clock.time() / elapsed))
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
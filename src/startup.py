@@ -0,0 +1,80 @@
+"""Timings of the bridge startup
+
+The init phases (imports, serial port, scene table, dStiny handshake,
+object-model fetch, ...) record themselves in `STARTUP`, and milestones
+such as the first forwarded event are marked once. `main.py
+--startup-report` prints them, measured from the start of the process.
+"""
+import contextlib
+import os
+import threading
+import time
+
+
+def process_start():
+    """ Return the start time of this process, or None if unknown
+    """
+    try:
+        with open('/proc/self/stat') as f:
+            ticks = int(f.read().rsplit(')', 1)[1].split()[19])
+        with open('/proc/uptime') as f:
+            uptime = float(f.read().split()[0])
+    except (IOError, IndexError, ValueError):
+        return None
+    return time.time() - uptime + ticks / float(os.sysconf('SC_CLK_TCK'))
+
+
+class Startup:
+    def __init__(self):
+        self.imported = time.time()  # when this module was imported
+        self.start = process_start() or self.imported
+        self.phases = []  # (name, thread, start, end)
+        self.marks = {}  # name: time
+        self._events = {}
+        self._lock = threading.Lock()
+
+    def record(self, name, start, end):
+        with self._lock:
+            self.phases.append((name, threading.current_thread().name,
+                                start, end))
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """ Record the enclosed block as an init phase
+        """
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.record(name, start, time.time())
+
+    def _event(self, name):
+        with self._lock:
+            return self._events.setdefault(name, threading.Event())
+
+    def mark(self, name):
+        """ Record the first time milestone `name` is reached
+        """
+        if name in self.marks:
+            return
+        with self._lock:
+            self.marks.setdefault(name, time.time())
+        self._event(name).set()
+
+    def wait(self, name, timeout=None):
+        return self._event(name).wait(timeout)
+
+    def report(self, out):
+        out.write("%-20s %9s %9s %9s  %s\n"
+                  % ("phase", "start", "end", "duration", "thread"))
+        for name, thread, start, end in sorted(self.phases,
+                                               key=lambda p: p[2]):
+            out.write("%-20s %8.3fs %8.3fs %7.1fms  %s\n"
+                      % (name, start - self.start, end - self.start,
+                         (end - start) * 1000, thread))
+        for name, t in sorted(self.marks.items(), key=lambda m: m[1]):
+            out.write("%-20s %8.3fs\n" % (name, t - self.start))
+        out.flush()
+
+
+STARTUP = Startup()
@@ -0,0 +1,163 @@
+"""Read-only HTTP API serving the bridge state from memory
+
+`STATE` holds what the bridge learns: the output levels of the hood fan,
+flap and window contact and the dStiny FSM state, followed from the bus
+(see follow_bus and bus.py), and the light level and scene table, set by
+the dstiny driver. Clients read it from the bridge instead of polling the
+mvune controller:
+
+    GET /state                  current state as JSON, with an ETag
+    GET /state?wait=SECONDS     long-poll: with If-None-Match, answers as
+                                soon as the state changes, or 304 after
+                                SECONDS (at most MAX_WAIT)
+
+A request whose If-None-Match matches the current ETag is answered with
+304 Not Modified.
+
+Limits: `light` is the level of the last light scene the bridge sent to
+the mvune controller; a change made on the mvune side is not seen. The
+scene table is re-read only when this bridge configures a register, so
+registers written by another process sharing --register-file show up
+after the next restart.
+"""
+import json
+import logging
+import threading
+import time
+import urlparse
+from BaseHTTPServer import BaseHTTPRequestHandler
+
+import bus
+import metrics
+from bus import BUS
+
+MAX_WAIT = 60.0  # seconds
+
+_MISSING = object()
+
+
+class State:
+    """ Versioned set of named values
+
+    Every update changing a value increments the version and wakes up the
+    long-polling clients.
+    """
+
+    def __init__(self):
+        self.version = 0
+        self.epoch = int(time.time())  # ETags do not survive a restart
+        self.values = {}
+        self.cond = threading.Condition()
+        self._body = None  # JSON of the current version
+
+    def update(self, **fields):
+        with self.cond:
+            changed = False
+            for name, value in fields.items():
+                if self.values.get(name, _MISSING) != value:
+                    self.values[name] = value
+                    changed = True
+            if changed:
+                self.version += 1
+                self._body = None
+                self.cond.notify_all()
+
+    def get(self, name, default=None):
+        return self.values.get(name, default)
+
+    def etag(self, version):
+        return '"%x-%d"' % (self.epoch, version)
+
+    def snapshot(self):
+        """ Return the ETag and the JSON document of the current state
+        """
+        with self.cond:
+            if self._body is None:
+                doc = dict(self.values)
+                doc["version"] = self.version
+                self._body = json.dumps(doc, sort_keys=True)
+            return self.etag(self.version), self._body
+
+    def wait(self, etag, timeout):
+        """ Wait up to `timeout` seconds for a state newer than `etag`
+        """
+        deadline = time.time() + timeout
+        with self.cond:
+            while self.etag(self.version) == etag:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                self.cond.wait(remaining)
+        return self.snapshot()
+
+
+STATE = State()
+
+
+def apply_record(state, record):
+    """ Update `state` from a MvuneChange or FsmTransition
+    """
+    if isinstance(record, bus.FsmTransition):
+        state.update(fsm=record.state)
+        return
+    outputs = {}
+    for name in ("fan", "flap", "window"):
+        value = getattr(record, name)
+        if value >= 0:
+            outputs[name] = value
+    state.update(**outputs)
+
+
+def follow_bus(state=STATE, source=BUS):
+    """ Keep `state` up to date with the records published on `source`
+    """
+    sub = source.subscribe((bus.MvuneChange, bus.FsmTransition))
+    return bus.follow(sub, lambda record: apply_record(state, record),
+                      "state-follow")
+
+
+class _StateHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        url = urlparse.urlparse(self.path)
+        if url.path != "/state":
+            self.send_error(404)
+            return
+        try:
+            wait = float(urlparse.parse_qs(url.query).get("wait", [0])[0])
+        except ValueError:
+            self.send_error(400)
+            return
+        state = self.server.state
+        client_etag = self.headers.getheader("If-None-Match")
+        if client_etag and wait > 0:
+            etag, body = state.wait(client_etag, min(wait, MAX_WAIT))
+        else:
+            etag, body = state.snapshot()
+
+        if etag == client_etag:
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("ETag", etag)
+        self.send_header("Cache-Control", "no-cache")
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logging.getLogger(__name__).debug(format, *args)
+
+
+def start_server(port, address="127.0.0.1", state=STATE):
+    """ Serve `state` on http://address:port/state, like
+    metrics.start_server
+    """
+    server = metrics.ThreadingHTTPServer((address, port), _StateHandler)
+    server.state = state
+    t = threading.Thread(target=server.serve_forever, name="state-api")
+    t.daemon = True
+    t.start()
+    return server
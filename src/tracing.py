@@ -0,0 +1,86 @@
+"""Correlation of the work triggered by a single message
+
+Each trigger (a dS scene telegram or an mvune event) gets a correlation id.
+Every stage handling it records a timestamped span in a ring buffer, so the
+chain telegram -> parse_dSCommand -> HTTP call -> long-poll echo -> queue ->
+status poll can be reconstructed and exported as JSON lines.
+
+The current correlation id is kept per thread: code running inside
+`TRACER.span` does not need to pass it around, e.g. `Mvune.request`
+attaches its HTTP span to the scene being parsed.
+
+Spans are timed with the tracer's clock, the one the loops of main.py
+run on (see clock.py).
+"""
+import collections
+import contextlib
+import itertools
+import json
+import threading
+
+from clock import CLOCK
+
+
+class Tracer:
+    def __init__(self, size=4096, clock=CLOCK):
+        self.enabled = True
+        self.clock = clock
+        self.spans = collections.deque(maxlen=size)  # oldest spans drop out
+        self._ids = itertools.count(1)
+        self._local = threading.local()
+
+    def new_trace(self):
+        """ Return a new correlation id
+        """
+        return next(self._ids)
+
+    def current(self):
+        """ Correlation id of the span running in this thread, or None
+        """
+        return getattr(self._local, 'trace', None)
+
+    def record(self, trace, stage, start, end=None, **attrs):
+        """ Record a span; `end` defaults to `start` (a point in time)
+        """
+        if not self.enabled or trace is None:
+            return
+        if end is None:
+            end = start
+        self.spans.append((trace, stage, start, end,
+                           threading.current_thread().name, attrs))
+
+    @contextlib.contextmanager
+    def span(self, stage, trace=None, **attrs):
+        """ Record the enclosed block as a span of `trace`
+
+        Without `trace`, the block is attached to the current correlation id
+        of the thread, if any.
+        """
+        if trace is None:
+            trace = self.current()
+        prev = self.current()
+        self._local.trace = trace
+        start = self.clock.time()
+        try:
+            yield trace
+        finally:
+            self._local.trace = prev
+            self.record(trace, stage, start, self.clock.time(), **attrs)
+
+    def export(self, fp, trace=None):
+        """ Write the buffered spans to `fp`, one JSON object per line
+        """
+        for s in list(self.spans):
+            if trace is not None and s[0] != trace:
+                continue
+            fp.write(json.dumps(self.to_dict(s)) + "\n")
+
+    def to_dict(self, s):
+        trace, stage, start, end, thread, attrs = s
+        d = {"trace": trace, "stage": stage, "start": start,
+             "duration": end - start, "thread": thread}
+        d.update(attrs)
+        return d
+
+
+TRACER = Tracer()
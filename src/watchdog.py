@@ -0,0 +1,160 @@
+"""Stall watchdog of the worker loops
+
+Each loop owns a `Loop` and marks where its work starts (`busy`) and
+where it deliberately waits (`idle`: the pacing sleeps, the wait for the
+next long-poll response). The time between the two is the iteration
+duration; the loop's heartbeat is the last of these calls.
+
+A watchdog thread checks the busy loops every `interval` seconds. A loop
+busy for longer than its budget is reported once per iteration as a
+stall: logged with the stack of the blocked thread, counted in
+bridge_loop_stalls_total and kept for /stalls. The rolling max and p99
+of the last WINDOW iterations are exported next to the iteration
+histogram.
+
+Loops read the time from the clock of their worker loop, so a loop run
+by simulator.py is timed in simulated time.
+"""
+import collections
+import logging
+import sys
+import thread
+import threading
+import time
+import traceback
+
+import metrics
+from clock import CLOCK
+
+WINDOW = 1000  # iterations in the rolling statistics
+MAX_STALLS = 20  # stall reports kept for /stalls
+
+
+class Loop:
+    def __init__(self, name, budget, clock=CLOCK):
+        self.name = name
+        self.budget = budget
+        self.clock = clock
+        self.ident = None
+        self.started = None  # start of the current iteration, None if idle
+        self.heartbeat = clock.time()
+        self.durations = collections.deque(maxlen=WINDOW)
+        self.stalled = False  # the current iteration has been reported
+
+    def busy(self):
+        now = self.clock.time()
+        if self.started is None:
+            self.ident = thread.get_ident()
+            self.started = now
+        self.heartbeat = now
+
+    def idle(self):
+        now = self.clock.time()
+        started = self.started
+        if started is not None:
+            self.started = None
+            self.durations.append(now - started)
+            metrics.LOOP_ITERATION.observe(now - started, self.name)
+            if self.stalled:
+                logging.warning("Loop %s resumed after %.3fs", self.name,
+                                now - started)
+                self.stalled = False
+        self.heartbeat = now
+
+    def stats(self):
+        """ Return (max, p99) of the iterations in the window
+        """
+        durations = sorted(self.durations)
+        if not durations:
+            return 0.0, 0.0
+        return durations[-1], durations[int(0.99 * (len(durations) - 1))]
+
+
+class Watchdog:
+    def __init__(self, interval=0.25, clock=CLOCK):
+        self.interval = interval
+        self.clock = clock
+        self.loops = []
+        self.stalls = collections.deque(maxlen=MAX_STALLS)
+        self._thread = None
+
+    def loop(self, name, budget, clock=None):
+        """ Return the Loop to be marked by the worker loop `name`, timed
+        by `clock` (default: the clock of the watchdog)
+
+        A loop started again under the same name, e.g. by each
+        simulator.Simulation, gets the Loop of its predecessor back.
+        """
+        clock = clock or self.clock
+        for loop in self.loops:
+            if loop.name == name:
+                loop.budget = budget
+                loop.clock = clock
+                loop.started = None
+                loop.stalled = False
+                loop.heartbeat = clock.time()
+                return loop
+        loop = Loop(name, budget, clock)
+        self.loops.append(loop)
+        return loop
+
+    def check(self, now=None):
+        """ Report the loops over budget, at `now` (default: the time of
+        the clock of each loop)
+        """
+        at = now
+        for loop in self.loops:
+            started = loop.started
+            now = loop.clock.time() if at is None else at
+            if started is None or loop.stalled \
+                    or now - started <= loop.budget:
+                continue
+            loop.stalled = True
+            frame = sys._current_frames().get(loop.ident)
+            stack = "".join(traceback.format_stack(frame)) if frame else ""
+            self.stalls.append((now, loop.name, now - started, stack))
+            metrics.LOOP_STALLS.inc(loop.name)
+            logging.warning("Loop %s stalled, busy for %.3fs (budget "
+                            "%.3fs) in:\n%s", loop.name, now - started,
+                            loop.budget, stack)
+
+    def start(self):
+        def run():
+            while True:
+                self.clock.sleep(self.interval)
+                self.check()
+
+        self._thread = threading.Thread(target=run, name="watchdog")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def render(self):
+        """ Rolling statistics in the Prometheus text format
+        """
+        lines = []
+        for metric, doc, value in (
+                ("bridge_loop_iteration_max_seconds",
+                 "Longest of the last %d iterations" % WINDOW,
+                 lambda l, now: l.stats()[0]),
+                ("bridge_loop_iteration_p99_seconds",
+                 "99th percentile of the last %d iterations" % WINDOW,
+                 lambda l, now: l.stats()[1]),
+                ("bridge_loop_heartbeat_age_seconds",
+                 "Time since the loop last marked itself",
+                 lambda l, now: now - l.heartbeat)):
+            lines.append("# HELP %s %s" % (metric, doc))
+            lines.append("# TYPE %s gauge" % metric)
+            for loop in self.loops:
+                lines.append('%s{loop="%s"} %f' % (
+                    metric, loop.name, value(loop, loop.clock.time())))
+        return lines
+
+    def export_stalls(self):
+        """ Recent stalls as text, newest last
+        """
+        return "".join("%s loop=%s busy=%.3fs\n%s\n" % (
+            time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(t)), name,
+            busy, stack) for t, name, busy, stack in list(self.stalls))
+
+
+WATCHDOG = metrics.REGISTRY.register(Watchdog())
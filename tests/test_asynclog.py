@@ -0,0 +1,34 @@
+import logging
+import os
+import Queue
+
+from src import asynclog
+
+
+def test_queue_handler_defers_formatting():
+    q = Queue.Queue(1)
+    handler = asynclog.QueueHandler(q)
+    logger = logging.getLogger('test_asynclog')
+    logger.propagate = False
+    logger.addHandler(handler)
+    logger.warning("telegram %s", "g107030031")
+    logger.warning("dropped")
+    logger.removeHandler(handler)
+
+    record = q.get_nowait()
+    assert record.args == ("g107030031",)
+    assert record.getMessage() == "telegram g107030031"
+    assert handler.dropped == 1
+
+
+def test_telegram_trace_roundtrip(tmpdir):
+    filename = os.path.join(str(tmpdir), 'trace.bin')
+    trace = asynclog.TelegramTrace(filename)
+    trace.record(asynclog.CHANNEL_DSTINY_TX, 'g107030031\r\n', 1.5)
+    trace.record(asynclog.CHANNEL_DSTINY_RX, 's02013\r\n', 2.0)
+    trace.close()
+
+    with open(filename, 'rb') as fp:
+        records = list(asynclog.read_trace(fp))
+    assert records == [(1.5, asynclog.CHANNEL_DSTINY_TX, 'g107030031\r\n'),
+                       (2.0, asynclog.CHANNEL_DSTINY_RX, 's02013\r\n')]
@@ -0,0 +1,26 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), 'benchmarks'))
+
+import micro  # noqa: E402
+import soak  # noqa: E402
+
+
+def test_hot_paths_within_baseline():
+    threshold = float(os.environ.get('BENCH_THRESHOLD', micro.THRESHOLD))
+    results = micro.run(duration=0.02, repeat=3)
+    regressions = micro.compare(results, micro.load_baseline(), threshold)
+    assert not regressions, "slower than baseline: %s" % regressions
+
+
+def test_soak_memory_flat():
+    # paced like the bridge, events wait for the dstiny thread
+    sim, results, (depth, staleness) = soak.run(hours=1.0, snapshots=2,
+                                                rate=1.0, event_interval=5)
+    counts0, counts1 = results[0][2], results[-1][2]
+    assert sum(counts1.values()) - sum(counts0.values()) < 1000
+    # at most one event per sensor and status index waits
+    assert depth <= 4
+    assert staleness < 4 * 5 + 1.0
@@ -0,0 +1,35 @@
+from src import bus
+from src import state_api
+
+
+def change(fan, flap=-1, window=-1):
+    return bus.MvuneChange(0.0, fan, flap, window, False)
+
+
+def test_policies():
+    b = bus.Bus()
+    newest = b.subscribe([bus.MvuneChange], 2, bus.DROP_NEWEST)
+    oldest = b.subscribe([bus.MvuneChange], 2, bus.DROP_OLDEST)
+    latest = b.subscribe([bus.MvuneChange, bus.FsmTransition], 2,
+                         bus.COALESCE)
+    b.publish(bus.FsmTransition(0.0, None, "dSINIT"))
+    for fan in (10, 20, 30):
+        b.publish(change(fan))
+    assert [newest.get(0).fan for _ in range(2)] == [10, 20]
+    assert [oldest.get(0).fan for _ in range(2)] == [20, 30]
+    assert latest.get(0).state == "dSINIT"
+    assert latest.get(0).fan == 30
+    assert latest.get(0) is None
+    assert (newest.dropped, oldest.dropped, latest.dropped) == (1, 1, 2)
+
+    b.unsubscribe(newest)
+    b.unsubscribe(oldest)
+    assert b.wants(bus.MvuneChange) and not b.wants(bus.Telegram)
+
+
+def test_state_follows_records():
+    state = state_api.State()
+    state_api.apply_record(state, change(33, window=1))
+    state_api.apply_record(state, bus.FsmTransition(1.0, "dSINIT",
+                                                    "dSONLINE"))
+    assert state.values == {"fan": 33, "window": 1, "fsm": "dSONLINE"}
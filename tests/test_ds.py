@@ -1,4 +1,10 @@
+import os
+import shutil
+
 from src import dstiny
+from src import mvune
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 
 
 def test_calculate_answer():
@@ -6,3 +12,102 @@ def test_calculate_answer():
     res = 'g107030031\r\n'
     assert res == Tel.get()
 
+
+def test_constant_telegram_is_encoded_once():
+    Tel = dstiny.constTel('g', 1, [0x07, 3, 0x00])
+    assert Tel.get() == 'g107030031\r\n'
+    assert dstiny.constTel('g', 1, [0x07, 3, 0x00]) is Tel
+    assert not hasattr(Tel, '__dict__')
+
+
+class LoopbackSerial:
+    def __init__(self):
+        self.ser = self
+        self.last = ''
+
+    def open(self):
+        pass
+
+    def close(self):
+        pass
+
+    def write(self, data):
+        self.last = data
+
+    def readline(self):
+        return self.last
+
+
+class CannedResponse:
+    def __init__(self, success):
+        self.body = {"success": success}
+
+    def json(self):
+        return self.body
+
+
+class TwoHoodsMvune(mvune.Mvune):
+    """ Controller with two hood fans whose setSupplyAir calls fail
+    """
+
+    def __init__(self):
+        mvune.Mvune.__init__(self, '127.0.0.1', 'hood', 'window', 'light',
+                             'test_ds')
+        self.registered_services = {
+            "S1": [u"exhaustAirDeviceService_haube"],
+            "S5": [u"exhaustAirDeviceService_haube"],
+            "S2": [u"supplyAirDeviceService_haube"],
+            "S3": [u"lightingDeviceService"]}
+        self.awaited = []  # echoes awaited at each request
+
+    def request(self, method, url):
+        self.awaited.append(self.echoes_expected - self.echoes_received)
+        return CannedResponse(method != "setSupplyAir")
+
+
+def driver(tmpdir, ctr):
+    conffile = os.path.join(str(tmpdir), 'scenes.conf')
+    shutil.copy(os.path.join(ROOT, '__scenes.conf'), conffile)
+    return dstiny.dstiny(LoopbackSerial(), ctr, 'test_ds', conffile)
+
+
+def test_group_scene_calls(tmpdir):
+    ctr = TwoHoodsMvune()
+    tiny = driver(tmpdir, ctr)
+    fan_flap, ventilation = (dstiny.EXHOOD_FAN_FLAP_dSxid,
+                             dstiny.DS_GROUP_VENTILATION)
+    assert tiny.groupSceneCalls(fan_flap, ventilation, 1) == [
+        ("setExhaustAir", 11)]
+    assert tiny.groupSceneCalls(fan_flap, ventilation, 21) == [
+        ("setSupplyAir", 25)]
+    assert tiny.groupSceneCalls(dstiny.EXHOOD_LIGHT_dSxid,
+                                dstiny.DS_GROUP_LIGHT, 14) == [
+        ("setIntensity", 100)]
+    ctr.set_fan_current_level(11)
+    assert tiny.groupSceneCalls(fan_flap, ventilation, 1) == []
+    assert tiny.groupSceneCalls(fan_flap, ventilation,
+                                dstiny.DS_SCENE_DEEP_OFF) == [
+        ("setIntensity", 0), ("setExhaustAir", 0)]
+
+
+def test_group_scene_awaits_one_echo_per_service(tmpdir):
+    ctr = TwoHoodsMvune()
+    tiny = driver(tmpdir, ctr)
+    # group scene 1 of the ventilation group: both fans
+    tiny.parse_dSCommand(dstiny.dSTel('i', dstiny.EXHOOD_FAN_FLAP_dSxid, [
+        dstiny.DS_GROUP_VENTILATION, 0x00, 0x08, 1, 0x02]))
+    assert ctr.awaited == [2, 2]  # before the first request
+    assert ctr.get_lock()
+    ctr.echo_received(1)
+    assert ctr.get_lock()
+    ctr.echo_received(1)
+    assert not ctr.get_lock()
+
+    # the echo of the failed flap call is not awaited
+    ctr.awaited = []
+    success, results = ctr.dispatch([("setExhaustAir", 22),
+                                     ("setSupplyAir", 25)])
+    assert not success
+    assert ctr.awaited == [3, 3, 3]
+    ctr.echo_received(2)
+    assert not ctr.get_lock()
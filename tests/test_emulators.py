@@ -0,0 +1,28 @@
+from src import dstiny
+from src import emulators
+
+
+def test_dstiny_emulator_answers():
+    tiny = emulators.DstinyEmulator()
+    try:
+        tiny.answer(dstiny.dSTel('c', 1, [0x02, 0x01, 0x10, 0x01, 0x04]))
+        ans = tiny.answer(dstiny.dSTel('c', 1, [0x03, 0x01, 0x10, 0, 0]))
+        assert ans.get() == dstiny.dSTel(
+            'c', 1, [0x03, 0x01, 0x10, 0x01, 0x04]).get()
+        ans = tiny.answer(dstiny.dSTel('g', 1, [0x07, 0x09, 0x00]))
+        assert ans.cmdch == 'e'
+    finally:
+        tiny.close()
+
+
+def test_mvune_standin_echoes_changes():
+    mvune = emulators.MvuneStandIn(poll_timeout=0)
+    try:
+        assert mvune.methodCall("S1", "setExhaustAir", "22")["success"]
+        assert mvune.methodCall("S1", "setExhaustAir", "22")["success"]
+        events = mvune.waitForEvents()["events"]
+        assert len(events) == 1
+        assert events[0]["changedObjects"] == {
+            "S1": {"exhaustAirFromField": 22}}
+    finally:
+        mvune.server.server_close()
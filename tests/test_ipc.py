@@ -0,0 +1,55 @@
+import os
+
+from src import bus
+from src import ipc
+from src import main
+
+
+def test_ring_wraps_and_reports_full():
+    ring = ipc.Ring(ipc.REPLY, 4)
+    for k in range(10):
+        assert ring.put(k, 1, 1, 0, 0, 0)
+        assert ring.get(0)[0] == k
+    for k in range(4):
+        assert ring.put(k, 1, 1, 0, 0, 0)
+    assert not ring.put(4, 1, 1, 0, 0, 0)
+    assert ring.qsize() == 4
+    assert [ring.get(0)[0] for _ in range(4)] == [0, 1, 2, 3]
+    assert ring.get(0) is None
+
+
+def test_ring_between_processes():
+    ring = ipc.Ring(ipc.REPLY, 16)
+    shared = ipc.SharedState()
+    pid = os.fork()
+    if pid == 0:
+        try:
+            shared.set(fan=55)
+            for k in range(100):  # more than the capacity
+                while not ring.put(k, 1, 0, 0, 0, 0):
+                    pass
+        finally:
+            os._exit(0)
+    assert [ring.get(5)[0] for _ in range(100)] == range(100)
+    os.waitpid(pid, 0)
+    assert shared.get()[3] == 55
+
+
+def test_event_queue_keeps_latest_value_per_sensor():
+    events = ipc.EventQueue(main.Event, capacity=8)
+    for value in (1, 2, 3):
+        events.put(main.Event(1, value, 7, "Status", timestamp=value))
+    events.put(main.Event(2, 10, 7, "Status", timestamp=4))
+    assert events.get().value == 3
+    assert events.get().value == 10
+    assert events.empty()
+
+
+def test_changes_reach_the_other_bus():
+    source, target = bus.Bus(), bus.Bus()
+    sub = target.subscribe((bus.MvuneChange,))
+    ring = ipc.Ring(ipc.CHANGE, 8)
+    ipc.forward_changes(source, ring)
+    ipc.publish_changes(ring, target)
+    source.publish(bus.MvuneChange(1.5, 40, -1, 1, True))
+    assert sub.get(5.0) == bus.MvuneChange(1.5, 40, -1, 1, True)
@@ -0,0 +1,39 @@
+from src import dstiny
+from src import loganalyzer
+
+PREFIX = "2017-06-07 10:00:%02d __tiny.log   INFO     "
+
+
+def line(second, message):
+    return PREFIX % second + message + "\n"
+
+
+def test_analyzer_statistics():
+    scene = dstiny.dSTel('i', 1, [0x00, 0x04, 0x08, 0x01, 0x02]).get()[:-2]
+    poll = dstiny.dSTel('g', 1, [0x07, 0x09, 0x00]).get()[:-2]
+    event = dstiny.dSTel('e', 1, [0x07, 0x09, 0x00]).get()[:-2]
+    log = "".join([
+        line(0, "[pc <- dstiny]\t[telegram]\t" + scene),
+        line(1, "Scene send to mivune controller"),
+        line(2, "[pc -> dstiny]\t[write]\t" + poll),
+        line(2, "[pc -> dstiny]\t[write]\t" + poll),
+        line(3, "[pc <- dstiny]\t[answer]\t" + event),
+        line(4, "[pc -> dstiny]\t[write]\t" + poll),
+        line(5, "No response received"),
+        line(9, "[pc <- dstiny]\t[telegram]\t" + scene[:-2] + "00"),
+        line(9, "[pc <- dstiny]\t[telegram]\t" + scene),
+        line(11, "Group scene send to mivune controller: 2"),
+    ])
+    analyzer = loganalyzer.Analyzer()
+    analyzer.feed(log)
+    r = analyzer.report(1.0)
+
+    assert r["telegrams"] == {"rx telegram i": 3, "tx write g": 3,
+                              "rx answer e": 1}
+    assert r["writes"] == 3
+    assert r["retry_rate"] == 1 / 3.0
+    assert r["no_response_rate"] == 1 / 3.0
+    assert r["crc_invalid_frames"] == 1
+    assert r["gaps_seconds"] == {"1": 1, "10": 1}
+    assert r["scene_to_mvune_seconds"] == {"1": 1, "2": 1}
+    assert r["scene_to_status_seconds"] == {"5": 1}
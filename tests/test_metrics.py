@@ -0,0 +1,15 @@
+from src import metrics
+
+
+def test_histogram_render():
+    h = metrics.Histogram('lat', 'latency', buckets=(0.1, 1.0),
+                          label='method')
+    h.observe(0.05, 'get')
+    h.observe(0.5, 'get')
+    h.observe(5.0, 'get')
+    text = "\n".join(h.render())
+    assert 'lat_bucket{method="get",le="0.1"} 1' in text
+    assert 'lat_bucket{method="get",le="1"} 2' in text
+    assert 'lat_bucket{method="get",le="+Inf"} 3' in text
+    assert 'lat_count{method="get"} 3' in text
+    assert h.count('get') == 3
@@ -0,0 +1,44 @@
+import logging
+import time
+
+from src import emulators
+from src import mvune
+
+
+def test_dispatch_runs_calls_concurrently():
+    standin = emulators.MvuneStandIn(poll_timeout=0, delay=0.3)
+    standin.start()
+    calls = []
+    standin.listeners.append(lambda ts, method, value:
+                             calls.append((method, value)))
+    logging.getLogger('test_mvune').addHandler(logging.NullHandler())
+    try:
+        ctr = mvune.Mvune(standin.address, "integrierter Haubenluefter",
+                          "Zuluft FKS", "Licht1", 'test_mvune')
+        ctr.get_objectModel()
+        start = time.time()
+        success, results = ctr.dispatch([("setExhaustAir", 40),
+                                         ("setSupplyAir", 20),
+                                         ("setIntensity", 0)])
+        elapsed = time.time() - start
+        assert success and len(results) == 3
+        assert sorted(calls) == [("setExhaustAir", 40), ("setIntensity", 0),
+                                 ("setSupplyAir", 20)]
+        assert elapsed < 0.6  # about one call, not the sum of three
+    finally:
+        standin.close()
+
+
+def test_lock_waits_for_each_echo():
+    ctr = mvune.Mvune("127.0.0.1", "hood", "window", "light", 'test_mvune')
+    ctr.set_lock(True)  # fan
+    ctr.set_lock(True)  # flap
+    ctr.echo_received(1)
+    assert ctr.get_lock()
+    ctr.echo_received(0)  # e.g. a response with the window contact only
+    assert ctr.get_lock()
+    ctr.echo_received(1)
+    assert not ctr.get_lock()
+    ctr.echo_received(2)  # an echo more than awaited does not count
+    ctr.set_lock(True)
+    assert ctr.get_lock()
@@ -0,0 +1,51 @@
+import os
+import socket
+import tempfile
+import threading
+import time
+
+from src import profiler
+
+
+def spin(stop):
+    while not stop.is_set():
+        sum(xrange(100))
+
+
+def test_collapsed_stacks():
+    stop = threading.Event()
+    t = threading.Thread(target=spin, args=(stop,), name="spinner")
+    t.start()
+    fd, filename = tempfile.mkstemp()
+    os.close(fd)
+    try:
+        p = profiler.Profiler(filename, interval=0.001)
+        p.start()
+        time.sleep(0.1)
+        p.stop()
+        lines = open(filename).read().splitlines()
+    finally:
+        stop.set()
+        t.join()
+        os.unlink(filename)
+    assert p.samples > 0
+    spinner = [l for l in lines if l.startswith("spinner;")]
+    assert spinner and "spin (test_profiler.py" in spinner[0]
+    assert all(int(l.rsplit(" ", 1)[1]) > 0 for l in lines)
+
+
+def test_control_socket():
+    path = tempfile.mktemp()
+    p = profiler.Profiler(path + ".folded")
+    server = profiler.serve_control(path, p)
+    try:
+        conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        conn.connect(path)
+        conn.sendall("dump\n")
+        reply = conn.makefile().read()
+        conn.close()
+    finally:
+        server.close()
+        os.unlink(path)
+    assert "Thread MainThread" in reply
+    assert "test_control_socket" in reply
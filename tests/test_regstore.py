@@ -0,0 +1,47 @@
+import os
+
+import pytest
+
+from src import regstore
+
+
+def test_register_file_shared_between_mappings(tmpdir):
+    filename = os.path.join(str(tmpdir), 'registers')
+    a = regstore.RegisterStore(filename)
+    b = regstore.RegisterStore(filename)
+    try:
+        assert a.get(0x12) == -1
+        seq = b.sequence()
+        a.update({0x12: 22, 0x13: 33})
+        assert b.get(0x12) == 22
+        assert b.snapshot()[0x13] == 33
+        assert b.sequence() == seq + 2
+    finally:
+        a.close()
+        b.close()
+
+
+def test_register_file_rejects_other_files(tmpdir):
+    filename = os.path.join(str(tmpdir), 'scenes.conf')
+    with open(filename, 'w') as f:
+        f.write("[Fan_Flap]\n" + "16 = 0\n" * 64)
+    with pytest.raises(ValueError):
+        regstore.RegisterStore(filename)
+
+
+def test_register_file_recovers_from_interrupted_write(tmpdir):
+    filename = os.path.join(str(tmpdir), 'registers')
+    a = regstore.RegisterStore(filename)
+    # a writer killed between the two updates of the counter
+    regstore.SEQ.pack_into(a.map, regstore.SEQ_OFFSET, 5)
+    b = regstore.RegisterStore(filename)
+    try:
+        assert b.sequence() == 6
+        assert b.get(0x12) == -1
+        regstore.SEQ.pack_into(a.map, regstore.SEQ_OFFSET, 7)
+        a.set(0x12, 22)
+        assert a.sequence() == 8
+        assert b.get(0x12) == 22
+    finally:
+        a.close()
+        b.close()
@@ -0,0 +1,18 @@
+from src import asynclog
+from src import replay
+
+
+def test_import_log():
+    lines = [
+        "2017-06-07 10:00:01 root         INFO     "
+        "[pc <- dstiny]\t[telegram]\ti1000408010249\n",
+        "2017-06-07 10:00:01 __tiny.log   INFO     "
+        "Individual addressing: dsidx:1\tscene:1\n",
+        "2017-06-07 10:00:02 __tiny.log   INFO     "
+        "[pc -> dstiny]\t[write]\tg1070A00AD\n",
+    ]
+    records = list(replay.import_log(lines))
+    assert [(c, f) for _, c, f in records] == [
+        (asynclog.CHANNEL_DSTINY_RX, 'i1000408010249\r\n'),
+        (asynclog.CHANNEL_DSTINY_TX, 'g1070A00AD\r\n')]
+    assert records[1][0] - records[0][0] == 1
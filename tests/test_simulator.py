@@ -0,0 +1,100 @@
+from src import clock
+from src import dstiny
+from src import emulators
+from src import main
+from src import simulator
+
+
+def simulate():
+    sim = simulator.Simulation(event_interval=0, serial_latency=0.008,
+                               http_latency=0.02)
+    try:
+        sim.start()
+        return sim.run(sim.traffic, (5, 10.0, 0.2))
+    finally:
+        sim.close()
+
+
+def test_simulation_is_deterministic():
+    results = simulate()
+    assert results == simulate()
+    latencies = dict((name, l) for name, l, lost in results)
+    assert all(lost == 0 for name, l, lost in results)
+    # serial line and one HTTP round trip
+    p50 = dict((name, simulator.percentile(l, 0.5))
+               for name, l in latencies.items())
+    assert abs(p50["ds_to_mvune"] - 0.028) < 1e-6
+    assert abs(p50["serial"] - 0.008) < 1e-6
+
+
+class FailingMvune:
+    """ Controller answering every long-poll at once with an error
+    """
+
+    def __init__(self, clock):
+        self.clock = clock
+        self.polls = 0
+        self.sessions = 0
+
+    def waitForEvents(self):
+        self.polls += 1
+        self.clock.sleep(0.001)
+        return emulators.StandInResponse({"error": "no session"})
+
+    def get_objectModel(self):
+        self.sessions += 1
+        self.sessionId = self.sessions
+
+
+def test_long_poll_backs_off_on_errors():
+    vclock = clock.VirtualClock()
+    ctr = FailingMvune(vclock)
+    responses = vclock.queue()
+    vclock.spawn(main.mvune_fetch_thread, (ctr, responses, vclock))
+    vclock.run(120.0)
+    # 1 + 2 + 4 + 8 + 16 + 32 + 32 + 32 seconds
+    assert ctr.polls == 8
+    # a new session before every retry
+    assert ctr.sessions == 7
+    assert responses.empty()
+
+
+class LateReplySession:
+    """ Session whose replies come back `latency` seconds after the
+    controller handled the call
+    """
+
+    def __init__(self, standin, latency):
+        self.standin = standin
+        self.latency = latency
+
+    def get(self, url):
+        body = self.standin.get(url)
+        self.standin.clock.sleep(self.latency)
+        return emulators.StandInResponse(body)
+
+
+def test_group_scene_echo_is_not_forwarded():
+    sim = simulator.Simulation(event_interval=1)
+    sim.ctr.session = LateReplySession(sim.mvune, 0.02)
+    polls = []
+    sim.tiny.listeners.append(
+        lambda timestamp, Tel: Tel.cmdch == 'g' and polls.append(Tel.args[1]))
+
+    def scenario():
+        sim.wait_online()
+        sim.tiny.scene(dstiny.EXHOOD_FAN_FLAP_dSxid, 2, zone=0,
+                       group=dstiny.DS_GROUP_VENTILATION)
+        sim.clock.sleep(5)
+        sid, field = emulators.STANDIN_METHODS['setExhaustAir']
+        sim.mvune.push(sid, field, 77)  # changed at the hood
+        sim.clock.sleep(5)
+
+    try:
+        sim.start()
+        sim.run(scenario)
+    finally:
+        sim.close()
+    echo = dstiny.DS_POLL_STATUS_INFO + 1
+    assert polls == [echo, dstiny.DS_POLL_STATUS_INFO]
+    assert not sim.ctr.get_lock()
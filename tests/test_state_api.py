@@ -0,0 +1,43 @@
+import json
+import threading
+import time
+import urllib2
+
+from src import state_api
+
+
+def get(server, path, etag=None):
+    url = "http://%s:%d%s" % (server.server_address + (path,))
+    request = urllib2.Request(url)
+    if etag:
+        request.add_header("If-None-Match", etag)
+    try:
+        r = urllib2.urlopen(request)
+        return r.getcode(), r.info().getheader("ETag"), json.loads(r.read())
+    except urllib2.HTTPError as e:
+        return e.code, e.info().getheader("ETag"), None
+
+
+def test_state_etag_and_long_poll():
+    state = state_api.State()
+    state.update(fan=33, fsm="dSONLINE")
+    server = state_api.start_server(0, state=state)
+    try:
+        code, etag, doc = get(server, "/state")
+        assert code == 200
+        assert doc["fan"] == 33 and doc["fsm"] == "dSONLINE"
+
+        assert get(server, "/state", etag)[0] == 304
+        state.update(fan=33)  # unchanged value, same version
+        assert get(server, "/state?wait=0.1", etag)[0] == 304
+
+        timer = threading.Timer(0.2, state.update, kwargs={"flap": 11})
+        timer.start()
+        start = time.time()
+        code, new_etag, doc = get(server, "/state?wait=10", etag)
+        assert code == 200 and new_etag != etag
+        assert doc["flap"] == 11
+        assert time.time() - start < 5
+    finally:
+        server.shutdown()
+        server.server_close()
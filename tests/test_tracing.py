@@ -0,0 +1,30 @@
+import json
+import StringIO
+
+from src import clock
+from src import tracing
+
+
+def test_nested_spans_share_trace():
+    tracer = tracing.Tracer(size=8)
+    trace = tracer.new_trace()
+    with tracer.span("parse_dSCommand", trace):
+        with tracer.span("setExhaustAir"):
+            assert tracer.current() == trace
+    assert tracer.current() is None
+    with tracer.span("untraced"):
+        pass
+
+    buf = StringIO.StringIO()
+    tracer.export(buf)
+    spans = [json.loads(l) for l in buf.getvalue().splitlines()]
+    assert [s["stage"] for s in spans] == ["setExhaustAir", "parse_dSCommand"]
+    assert all(s["trace"] == trace for s in spans)
+
+
+def test_spans_use_the_tracer_clock():
+    tracer = tracing.Tracer(size=8, clock=clock.VirtualClock(100.0))
+    with tracer.span("decodeEvent", tracer.new_trace()):
+        pass
+    trace, stage, start, end, thread, attrs = tracer.spans[0]
+    assert start == end == 100.0
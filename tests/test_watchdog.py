@@ -0,0 +1,65 @@
+import threading
+import time
+
+from src import clock
+from src import watchdog
+
+
+def test_stall_reports_blocking_stack():
+    dog = watchdog.Watchdog()
+    loop = dog.loop("worker", 1.0)
+    blocked = threading.Event()
+    release = threading.Event()
+
+    def stuck_in_call():
+        loop.busy()
+        blocked.set()
+        release.wait()
+        loop.idle()
+
+    t = threading.Thread(target=stuck_in_call)
+    t.start()
+    blocked.wait()
+    dog.check(time.time())
+    assert not dog.stalls  # within budget
+    dog.check(time.time() + 2.0)
+    dog.check(time.time() + 3.0)  # reported once
+    release.set()
+    t.join()
+
+    assert len(dog.stalls) == 1
+    when, name, busy, stack = dog.stalls[0]
+    assert name == "worker" and busy > 1.0
+    assert "stuck_in_call" in stack
+    assert "loop=worker busy=" in dog.export_stalls()
+    assert loop.started is None and len(loop.durations) == 1
+    text = "\n".join(dog.render())
+    assert 'bridge_loop_iteration_max_seconds{loop="worker"}' in text
+
+
+def test_loop_is_reused_by_name():
+    dog = watchdog.Watchdog()
+    first = dog.loop("mvune", 1.0)
+    first.busy()
+    again = dog.loop("mvune", 2.0)
+    assert again is first and len(dog.loops) == 1
+    assert again.budget == 2.0 and again.started is None
+
+
+def test_loop_timed_by_its_clock():
+    vclock = clock.VirtualClock(1000.0)
+    dog = watchdog.Watchdog()
+    loop = dog.loop("dstiny", 1.0, vclock)
+    loop.busy()
+    vclock.now += 0.5
+    dog.check()
+    assert not dog.stalls
+    vclock.now += 1.0
+    dog.check()
+    assert [(t, name) for t, name, busy, stack in dog.stalls] == \
+        [(1001.5, "dstiny")]
+    loop.idle()
+    assert list(loop.durations) == [1.5]
+    text = "\n".join(dog.render())
+    assert 'bridge_loop_heartbeat_age_seconds{loop="dstiny"} 0.000000' \
+        in text